@@ -0,0 +1,110 @@
+"""
+Cold start benchmark for the dip package.
+
+Short-lived processes which only look at the local state of a DIP (adding files,
+checking the deposit state) should not pay for importing the network, XML or
+packaging dependencies.  This starts a fresh interpreter a number of times,
+imports dip and runs set_file and get_state on a throwaway DIP, and reports how
+long that took over and above a bare interpreter start.
+
+It exits with a non-zero status if any of the heavy dependencies were imported
+along the way, or if the best cold start was slower than the budget:
+
+    python benchmarks/import_time.py --budget-ms 60
+
+The budget is 60ms unless another is given; --budget-ms 0 turns it off.
+
+(python -X importtime would give a per-module breakdown, but it is only available
+from Python 3.7, so we time whole interpreter runs instead.)
+"""
+
+import os, sys, json, time, shutil, tempfile, subprocess, argparse
+
+# the cold start budget, in milliseconds, over and above a bare interpreter start
+BUDGET_MS = 60.0
+
+# modules which must not be imported by local-only operations
+HEAVY_MODULES = ["sword2", "httplib2", "lxml", "multiprocessing", "zipfile", "uuid",
+                 "hashlib", "ssl", "socket", "tempfile"]
+
+# run in the child interpreter: argv[1] is the DIP directory, argv[2] a file to add
+LOCAL_OPS = """
+import sys
+import dip
+d = dip.DIP(sys.argv[1])
+d.set_file(sys.argv[2])
+d.get_state()
+"""
+
+REPORT = """
+import json
+print(json.dumps(sorted([m for m in sys.modules if sys.modules[m] is not None])))
+"""
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def loaded_modules(dip_dir, path, python=sys.executable):
+    """
+    Run the local operations in a fresh interpreter, and return the names of all
+    the modules it had imported by the end
+    """
+    out = subprocess.check_output([python, "-c", LOCAL_OPS + REPORT, dip_dir, path], cwd=PACKAGE_ROOT)
+    return json.loads(out.strip().splitlines()[-1])
+
+def heavy_modules(modules):
+    """
+    The top level names of any of the HEAVY_MODULES amongst the supplied module names
+    """
+    return sorted(set([m.split(".")[0] for m in modules if m.split(".")[0] in HEAVY_MODULES]))
+
+def _best_of(command, runs):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call(command, cwd=PACKAGE_ROOT)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def cold_start(dip_dir, path, runs=10, python=sys.executable):
+    """
+    The best wall clock time, in milliseconds, to start an interpreter and run the
+    local operations, less the best time to start an interpreter and do nothing
+    """
+    baseline = _best_of([python, "-c", "pass"], runs)
+    local_ops = _best_of([python, "-c", LOCAL_OPS, dip_dir, path], runs)
+    return max(local_ops - baseline, 0.0) * 1000
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="dip cold start benchmark")
+    parser.add_argument("--runs", type=int, default=10, help="interpreter starts to take the best of")
+    parser.add_argument("--budget-ms", type=float, default=BUDGET_MS,
+                        help="fail if the cold start takes longer than this (default %(default)sms; 0 for no budget)")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix="dip-import-time-")
+    try:
+        dip_dir = os.path.join(work_dir, "dip")
+        path = os.path.join(work_dir, "file.txt")
+        with open(path, "wb") as f:
+            f.write("some content")
+
+        heavy = heavy_modules(loaded_modules(dip_dir, path))
+        ms = cold_start(dip_dir, path, args.runs)
+    finally:
+        shutil.rmtree(work_dir)
+
+    print json.dumps({"cold_start_ms" : round(ms, 1), "heavy_modules" : heavy, "budget_ms" : args.budget_ms})
+
+    failed = False
+    if len(heavy) > 0:
+        print >> sys.stderr, "local operations imported " + ", ".join(heavy)
+        failed = True
+    if args.budget_ms and ms > args.budget_ms:
+        print >> sys.stderr, "cold start of %.1fms is over the budget of %.1fms" % (ms, args.budget_ms)
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,332 @@
+"""
+Benchmark suite for the main DIP operations.
+
+Each scenario runs one operation against a freshly built synthetic DIP, in its own
+interpreter, and records the wall time, throughput and peak RSS of that process.
+The scenarios are every combination of:
+
+    operation   - set_file, get_state, package (SimpleZip) and deposit (SimpleZip,
+                  to a dip.standin server running in this process, which can
+                  be slowed down with --latency and --bandwidth-kb)
+    size        - the number of files in the DIP (1000, 10000 and 100000 by default)
+    mix         - "small" (every file is --small-kb) or "large" (the small files,
+                  plus --large-count files of --large-mb each)
+    endpoints   - "one" endpoint, or "many" (8), all of which the files have
+                  been deposited to
+
+The results are written as JSON, and two sets of results can be compared:
+
+    python benchmarks/suite.py --sizes 1000,10000 --output before.json
+    python benchmarks/suite.py --sizes 1000,10000 --output after.json
+    python benchmarks/suite.py --compare before.json after.json
+
+A scenario which takes longer than --timeout seconds is stopped and recorded as
+timed out, so that anything which scales badly shows up without hanging the run.
+"""
+
+import os, sys, json, time, shutil, signal, hashlib, datetime, tempfile, argparse, subprocess
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PACKAGE_ROOT)
+
+from dip.standin import StandInServer
+
+OPERATIONS = ["set_file", "get_state", "package", "deposit"]
+SIZES = [1000, 10000, 100000]
+MIXES = ["small", "large"]
+ENDPOINTS = {"one" : 1, "many" : 8}
+
+SIMPLE_ZIP = "http://purl.org/net/sword/package/SimpleZip"
+
+# the number of new files added by the set_file scenario, one set_file at a time
+SET_FILE_SAMPLE = 100
+
+# files per directory in the synthetic corpus
+DIRECTORY_SIZE = 1000
+
+########################################################
+## Synthetic DIPs
+########################################################
+
+def build_corpus(work_dir, size, mix, small_kb=4, large_count=4, large_mb=16):
+    """
+    Write the files for a DIP of the given size and mix (unless they are already
+    there), and return the corpus directory.  The corpus holds a manifest.json of
+    [path, md5, size] for each file, and a "new" directory of files which are not
+    in the DIP, for set_file to add.
+    """
+    corpus_dir = os.path.join(work_dir, "corpus-" + str(size) + "-" + mix)
+    manifest_path = os.path.join(corpus_dir, "manifest.json")
+    if os.path.exists(manifest_path):
+        return corpus_dir
+
+    sizes = [small_kb * 1024] * size
+    if mix == "large":
+        for i in range(min(large_count, size)):
+            sizes[i * (size / large_count)] = large_mb * 1024 * 1024
+
+    manifest = []
+    for i, file_size in enumerate(sizes):
+        path = os.path.join(corpus_dir, "files", str(i / DIRECTORY_SIZE), "file-" + str(i) + ".bin")
+        manifest.append([path] + _write_random(path, file_size))
+    for i in range(SET_FILE_SAMPLE):
+        _write_random(os.path.join(corpus_dir, "new", "file-" + str(i) + ".bin"), small_kb * 1024)
+
+    with open(manifest_path, "wb") as f:
+        json.dump(manifest, f)
+    return corpus_dir
+
+def _write_random(path, size):
+    # random content, so that packaging gets no help from compression
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    md5 = hashlib.md5()
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining > 0:
+            chunk = os.urandom(min(remaining, 1024 * 1024))
+            md5.update(chunk)
+            f.write(chunk)
+            remaining -= len(chunk)
+    return [md5.hexdigest(), size]
+
+def build_dip(dip_dir, corpus_dir, endpoints, server):
+    """
+    Create a DIP at dip_dir containing every file in the corpus, with the given number
+    of endpoints (on the stand-in server), and the files marked as deposited to all of
+    them.  The deposit.json is written directly, as set_file-ing 100000 files one at a
+    time is itself one of the things being measured.
+    """
+    import dip
+    with open(os.path.join(corpus_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    d = dip.DIP(dip_dir)
+    raw = d.deposit_info_raw
+
+    for i in range(endpoints):
+        raw["endpoints"].append({
+            "id" : "endpoint-" + str(i),
+            "sd_iri" : server.sd_iri,
+            "col_iri" : server.col_iri(str(i)),
+            "package" : SIMPLE_ZIP
+        })
+
+    # stamp the files after they were written, so get_state doesn't think they have changed
+    now = datetime.datetime.now() + datetime.timedelta(seconds=2)
+    updated = now.strftime("%Y-%m-%dT%H:%M:%SZ")
+    last_deposit = now.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    base = os.path.realpath(dip_dir)
+    for path, md5, size in manifest:
+        raw["files"].append({
+            "path" : os.path.relpath(os.path.realpath(path), base),
+            "md5" : md5,
+            "added" : updated,
+            "updated" : updated,
+            "endpoints" : [{"id" : e["id"], "last_deposit" : last_deposit} for e in raw["endpoints"]]
+        })
+
+    d.deposit_info_raw = raw
+    return d
+
+########################################################
+## Scenarios
+########################################################
+
+def run_operation(scenario):
+    """
+    Carry out the scenario's operation on its (already built) DIP, in this process,
+    and return the timings
+    """
+    import dip
+
+    d = dip.DIP(scenario["dip_dir"])
+    op = scenario["operation"]
+    items = 0
+    size = 0
+
+    start = time.time()
+    if op == "set_file":
+        new_dir = os.path.join(scenario["corpus_dir"], "new")
+        for name in sorted(os.listdir(new_dir)):
+            path = os.path.join(new_dir, name)
+            d.set_file(path)
+            items += 1
+            size += os.path.getsize(path)
+    elif op == "get_state":
+        ds = d.get_state()
+        items = len(ds.states)
+        size = sum([os.path.getsize(f.path) for f in d.get_files()])
+    elif op == "package":
+        info = d.package(package_format=SIMPLE_ZIP)
+        items = len(info.file_paths)
+        size = os.path.getsize(info.path)
+    elif op == "deposit":
+        for e in d.get_endpoints():
+            cm, receipt = d.deposit(e.id)
+            items += 1
+            size += cm.throughput["bytes"]
+    else:
+        raise ValueError("unknown operation " + op)
+    seconds = time.time() - start
+
+    return {"seconds" : seconds, "items" : items, "bytes" : size}
+
+def run_scenario(scenario, timeout):
+    """
+    Run the scenario in a fresh interpreter, and return its result, including the
+    peak RSS of that interpreter
+    """
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker", json.dumps(scenario)],
+                            cwd=scenario["dip_dir"], stdout=subprocess.PIPE)
+    started = time.time()
+    while True:
+        # wait4 gives us the resource usage of this child alone
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        if time.time() - started > timeout:
+            os.kill(proc.pid, signal.SIGKILL)
+            pid, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = -signal.SIGKILL
+            return dict(scenario, status="timeout", seconds=None, peak_rss_kb=usage.ru_maxrss)
+        time.sleep(0.05)
+    proc.returncode = status
+    output = proc.stdout.read()
+
+    result = dict(scenario, peak_rss_kb=usage.ru_maxrss)
+    if status != 0 or output.strip() == "":
+        result.update({"status" : "error", "seconds" : None})
+        return result
+    timings = json.loads(output.strip().splitlines()[-1])
+    result.update(timings)
+    result["status"] = "ok"
+    result["items_per_second"] = timings["items"] / timings["seconds"] if timings["seconds"] > 0 else None
+    result["bytes_per_second"] = timings["bytes"] / timings["seconds"] if timings["seconds"] > 0 else None
+    return result
+
+def scenario_name(scenario):
+    return "%(operation)s/%(size)s/%(mix)s/%(endpoints)s" % scenario
+
+def run_suite(work_dir, operations, sizes, mixes, endpoints, timeout=600, progress=None,
+              latency=0, bandwidth=None, **corpus_args):
+    """
+    Run every combination of the supplied operations, sizes, mixes and endpoint
+    counts, returning the results document.  latency and bandwidth are passed on
+    to the stand-in server.
+    """
+    collections = [str(i) for i in range(max(ENDPOINTS.values()))]
+    server = StandInServer(collections=collections, latency=latency, bandwidth=bandwidth).start()
+    results = []
+    try:
+        for size in sizes:
+            for mix in mixes:
+                corpus_dir = build_corpus(work_dir, size, mix, **corpus_args)
+                for ep in endpoints:
+                    for op in operations:
+                        scenario = {"operation" : op, "size" : size, "mix" : mix, "endpoints" : ep}
+                        scenario["name"] = scenario_name(scenario)
+                        scenario["corpus_dir"] = corpus_dir
+                        scenario["dip_dir"] = os.path.join(work_dir, "dip-" + scenario["name"].replace("/", "-"))
+                        build_dip(scenario["dip_dir"], corpus_dir, ENDPOINTS[ep], server)
+                        try:
+                            result = run_scenario(scenario, timeout)
+                        finally:
+                            shutil.rmtree(scenario["dip_dir"])
+                        del result["corpus_dir"]
+                        del result["dip_dir"]
+                        results.append(result)
+                        if progress is not None:
+                            progress(result)
+    finally:
+        server.stop()
+
+    return {
+        "started" : datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "python" : sys.version.split()[0],
+        "commit" : _commit(),
+        "results" : results
+    }
+
+def _commit():
+    try:
+        with open(os.devnull, "wb") as null:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=PACKAGE_ROOT, stderr=null).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(before, after):
+    """
+    Pair up the results of two runs by scenario, returning a list of
+    (name, seconds before, seconds after, ratio, peak rss before, peak rss after)
+    """
+    previous = dict([(r["name"], r) for r in before["results"]])
+    rows = []
+    for r in after["results"]:
+        b = previous.get(r["name"])
+        if b is None:
+            continue
+        ratio = r["seconds"] / b["seconds"] if r["seconds"] is not None and b["seconds"] else None
+        rows.append((r["name"], b["seconds"], r["seconds"], ratio, b.get("peak_rss_kb"), r.get("peak_rss_kb")))
+    return rows
+
+def _seconds(s):
+    return "timeout/error" if s is None else "%.3fs" % s
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="dip benchmark suite")
+    parser.add_argument("--operations", default=",".join(OPERATIONS))
+    parser.add_argument("--sizes", default=",".join([str(s) for s in SIZES]))
+    parser.add_argument("--mixes", default=",".join(MIXES))
+    parser.add_argument("--endpoints", default=",".join(sorted(ENDPOINTS.keys(), reverse=True)))
+    parser.add_argument("--small-kb", type=int, default=4)
+    parser.add_argument("--large-count", type=int, default=4)
+    parser.add_argument("--large-mb", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0, help="seconds the stand-in server waits per request")
+    parser.add_argument("--bandwidth-kb", type=int, default=None, help="stand-in server bandwidth, in kB/s")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds after which a scenario is stopped")
+    parser.add_argument("--work-dir", default=None, help="where to build the synthetic DIPs (kept if given)")
+    parser.add_argument("--output", default=None, help="file to write the JSON results to (default stdout)")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two sets of results")
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker is not None:
+        print json.dumps(run_operation(json.loads(args.worker)))
+        return 0
+
+    if args.compare is not None:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        for name, b, a, ratio, b_rss, a_rss in compare(before, after):
+            print "%-32s %14s %14s %8s %10s -> %s KB" % (name, _seconds(b), _seconds(a),
+                                                      "x%.2f" % ratio if ratio is not None else "-", b_rss, a_rss)
+        return 0
+
+    def progress(result):
+        print >> sys.stderr, "%-32s %-8s %14s %10s KB" % (result["name"], result["status"],
+                                                          _seconds(result["seconds"]), result["peak_rss_kb"])
+
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix="dip-benchmark-")
+    try:
+        doc = run_suite(os.path.abspath(work_dir), args.operations.split(","),
+                        [int(s) for s in args.sizes.split(",")], args.mixes.split(","), args.endpoints.split(","),
+                        timeout=args.timeout, progress=progress, latency=args.latency,
+                        bandwidth=args.bandwidth_kb * 1024 if args.bandwidth_kb is not None else None,
+                        small_kb=args.small_kb, large_count=args.large_count, large_mb=args.large_mb)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+    out = json.dumps(doc, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, "wb") as f:
+            f.write(out)
+    else:
+        print out
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
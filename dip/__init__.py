@@ -1 +1,10 @@
-from dip import DIP, Endpoint, InitialiseException, DepositFile, EndpointRecord, DepositState, DepositException, CommsMeta
+from dip import DIP, Endpoint, InitialiseException, DepositFile, EndpointRecord, DepositState, DepositException, CommsMeta, DepositHistory
+from history import HistoryStore, HistoryPolicy, HistoryWriter, HistoryException
+from metadata import MetadataException
+from metrics import Metrics, CollectingMetrics, PrometheusTextfileMetrics
+from tracing import Tracer, Span, SpanExporter, CollectingExporter, OTLPJsonFileExporter
+from profiling import Profiler, ProfileRun
+from cache import PackageCache, PackageCachePolicy
+from httpcache import ResponseCache, HttpCachePolicy, CachingHttpLayer
+from packagers import PackagerFactory, PackagerException, PackageInfo, Packager, PackageWriter
+from bulk import BulkImporter, ImportReport
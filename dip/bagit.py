@@ -0,0 +1,218 @@
+########################################################
+## BagIt implementation
+########################################################
+#
+# Makes a BagIt (RFC 8493) bag of the DIP, streamed straight into a zip or tar
+# archive:
+#
+# bag/bagit.txt
+# bag/data/<deposit files>
+# bag/manifest-md5.txt
+# bag/bag-info.txt
+# bag/metadata/<metadata files>
+# bag/tagmanifest-md5.txt
+#
+# The payload manifest and the Payload-Oxum are written after the payload, from
+# the md5s and sizes of the files as they were written into the bag, so they
+# describe what the bag holds even if a file has changed since it was recorded.
+# Each file is only stat'd before it is written, to check that it is still there
+# and whether its record is current, and if the verify packager argument is set, a
+# file whose record is current but which doesn't match it, as it is written, stops
+# the packaging.  A file modified since it was last hashed has its record brought
+# up to date from the md5 of the file as it was written, so it is read only once.  The bag is built by a PackageWriter, so it can be
+# built alongside other packages from a single read of each file, and the archive
+# is written in order and hashed as it goes.
+
+import os, datetime, hashlib
+from packagers import Packager, PackageWriter, PackageInfo, PackagerException, HashingReader, HashingWriter, \
+     StreamingZipFile, TarEntryWriter, current_record, write_zip_entry
+
+BAGIT = "http://purl.org/net/sword/package/BagIt"
+
+BAGIT_VERSION = "1.0"
+
+# archive type -> (file extension, mimetype)
+ARCHIVES = {
+    "zip" : (".zip", "application/zip"),
+    "tar" : (".tar", "application/x-tar"),
+    "tgz" : (".tar.gz", "application/gzip")
+}
+
+class BagItPackager(Packager):
+    """
+    Packager which makes a BagIt bag out of the files in the dip
+
+    The packager args can be any of the following:
+
+    archive - "zip", "tar" or "tgz" - the archive to put the bag in (default "zip")
+    bag_name - the name of the bag's top level directory (default "bag")
+    metadata_files - True/False - should the packager include all of the metadata files (as tag files)
+    deposit_files - True/False - should the packager include all of the dip's files (as the payload)
+    verify - True/False - fail if a file doesn't match its record as it is written (default False)
+    remove_package - True/False - on completion of deposit, should the created package be removed
+
+    """
+    def writer(self, dip, out_dir, **packager_args):
+        # sort out the arguments/paths to use
+        archive = packager_args.get("archive", "zip")
+        if archive not in ARCHIVES:
+            raise PackagerException("BagItPackager archive must be one of " + ", ".join(sorted(ARCHIVES.keys())))
+        do_md = packager_args.get("metadata_files", True)
+        do_files = packager_args.get("deposit_files", True)
+
+        # check that some packaging is going to be done
+        if not do_md and not do_files:
+            raise PackagerException("BagItPackager must be instructed to deposit either metadata files, deposit files or both")
+
+        return BagItWriter(dip, out_dir, archive, packager_args.get("bag_name", "bag"), do_md, do_files,
+                           packager_args.get("verify", False))
+
+    def cleanup(self, dip, package_dir, package_info, **packager_args):
+        remove_package = packager_args.get("remove_package", False)
+        if not remove_package:
+            return
+        if os.path.isfile(package_info.path):
+            os.unlink(package_info.path)
+
+class BagItWriter(PackageWriter):
+    def __init__(self, dip, out_dir, archive, bag, metadata_files, deposit_files, verify):
+        super(BagItWriter, self).__init__(deposit_files)
+        self.dip = dip
+        self.archive = archive
+        self.extension, self.mimetype = ARCHIVES[archive]
+        self.filename = "BagIt" + self.extension
+        self.out_file = os.path.join(out_dir, self.filename)
+        self.bag = bag
+        self.metadata_files = metadata_files
+        self.verify = verify
+
+        # work out the payload from the file records, before we write anything
+        self.payload = []
+        names = set()
+        if deposit_files:
+            for df in dip.get_files():
+                # the md5 to verify against, unless the file has been modified since
+                # it was hashed, and so can't be expected to match
+                record = current_record(df)
+                name = os.path.basename(df.path)
+                if name in names:
+                    raise PackagerException("BagItPackager can't include two files called " + name)
+                names.add(name)
+                self.payload.append((df.path, record.md5 if record is not None else None, "data/" + name))
+
+        # use these to record the objects that get packaged, and the md5s and
+        # size of the payload as it is written
+        self.file_paths = []
+        self.metadata_formats = []
+        self.manifest = []
+        self.octets = 0
+        self.tag_md5s = []
+
+        self._file = None
+        self._entry = None
+        self.writer = None
+
+    def start(self):
+        self._file = open(self.out_file, "wb")
+        self.out = HashingWriter(self._file)
+        self.writer = _writer(self.archive, self.out)
+        self.tag_md5s.append(self.writer.add_bytes(self.bag + "/bagit.txt",
+                             "BagIt-Version: " + BAGIT_VERSION + "\nTag-File-Character-Encoding: UTF-8\n"))
+
+    def start_file(self, deposit_file, st):
+        path, self._md5, self._arcname = self.payload[len(self.file_paths)]
+        self._entry = self.writer.entry(self.bag + "/" + self._arcname, st)
+        self.file_paths.append(path)
+
+    def write(self, data):
+        self._entry.write(data)
+        self.octets += len(data)
+
+    def end_file(self, md5):
+        self._entry.close()
+        if self.verify and self._md5 is not None and md5 != self._md5:
+            raise PackagerException(self.file_paths[-1] + " has changed since it was last recorded (md5 " + md5 +
+                                    ", expected " + self._md5 + ")")
+        self.manifest.append((md5, self._arcname))
+
+    def finish(self):
+        bag = self.bag
+        manifest = "".join([md5 + "  " + arcname + "\n" for md5, arcname in self.manifest])
+        self.tag_md5s.append(self.writer.add_bytes(bag + "/manifest-md5.txt", manifest))
+
+        info = "Bagging-Date: " + datetime.date.today().isoformat() + "\n"
+        info += "Payload-Oxum: " + str(self.octets) + "." + str(len(self.manifest)) + "\n"
+        self.tag_md5s.append(self.writer.add_bytes(bag + "/bag-info.txt", info))
+
+        if self.metadata_files:
+            for mf in self.dip.get_metadata_files():
+                self.metadata_formats.append(mf.format)
+                self.tag_md5s.append(self.writer.add_file(bag + "/metadata/" + os.path.basename(mf.path), mf.path))
+
+        tagmanifest = "".join([md5 + "  " + arcname[len(bag) + 1:] + "\n" for arcname, md5 in self.tag_md5s])
+        self.writer.add_bytes(bag + "/tagmanifest-md5.txt", tagmanifest)
+        self.writer.close()
+        self._file.close()
+
+        return PackageInfo(self.out_file, self.file_paths, self.metadata_formats, self.filename, self.mimetype,
+                           md5=self.out.hexdigest())
+
+    def abort(self):
+        if self.writer is not None:
+            try:
+                self.writer.close()
+            except Exception:
+                pass    # the package is being thrown away anyway
+        if self._file is not None:
+            self._file.close()
+
+def _writer(archive, out):
+    if archive == "zip":
+        return _ZipWriter(out)
+    return _TarWriter(out, "w|gz" if archive == "tgz" else "w|")
+
+class _ZipWriter(object):
+    # add_file and add_bytes return (arcname, md5); everything is written in order
+    def __init__(self, out):
+        self.z = StreamingZipFile(out)
+
+    def add_file(self, arcname, path):
+        return arcname, write_zip_entry(self.z, path, arcname)
+
+    def add_bytes(self, arcname, data):
+        self.z.writestr(arcname, data)
+        return arcname, hashlib.md5(data).hexdigest()
+
+    def entry(self, arcname, st):
+        return self.z.entry(arcname, st)
+
+    def close(self):
+        self.z.close()
+
+class _TarWriter(object):
+    def __init__(self, out, mode):
+        import tarfile
+        self.tarfile = tarfile
+        self.t = tarfile.open(mode=mode, fileobj=out)
+
+    def add_file(self, arcname, path):
+        info = self.t.gettarinfo(path, arcname)
+        with open(path, "rb") as f:
+            reader = HashingReader(f)
+            self.t.addfile(info, reader)
+        return arcname, reader.hexdigest()
+
+    def add_bytes(self, arcname, data):
+        from StringIO import StringIO
+        import time
+        info = self.tarfile.TarInfo(arcname)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        self.t.addfile(info, StringIO(data))
+        return arcname, hashlib.md5(data).hexdigest()
+
+    def entry(self, arcname, st):
+        return TarEntryWriter(self.t, arcname, st)
+
+    def close(self):
+        self.t.close()
@@ -0,0 +1,290 @@
+########################################################
+## Bulk import of metadata and files into many DIPs
+########################################################
+#
+# Rows are streamed from a CSV or JSON-lines file, and each row is applied
+# to the DIP it names (creating the DIP if necessary) inside a DIP.batch(),
+# so that all of the row's dublin core and files are written to disk once.
+#
+# CSV files have a header row, whose columns may be:
+#
+# dip               - the path to the DIP directory (required)
+# file              - a file to add to the DIP; the column may be repeated
+# dcterms:<term>    - a value for the dcterms field <term>; the column may be
+#                     repeated, and may be given a language with
+#                     dcterms:<term>@<lang>
+#
+# CSV files are read in the importer's encoding (UTF-8 by default).
+#
+# Any cell may hold several values, separated by the importer's separator
+# ("|" by default).  Empty cells are ignored.
+#
+# A DIP may be named by many rows.  Rows are read a chunk at a time, and the
+# rows of a chunk which name the same DIP are applied one after another, in the
+# order they appear, by the same worker, since two workers writing the same
+# deposit.json would lose each other's changes.
+#
+# JSON-lines files have one object per line, of the form:
+#
+# {"dip" : "path/to/dip", "files" : ["a.pdf", ...],
+#  "dcterms" : [["title", "A title", "en"], ["creator", "Richard"], ...]}
+
+import os, csv, json, time, itertools, logging
+
+from dip import DIP
+
+log = logging.getLogger(__name__)
+
+DCTERMS_PREFIX = "dcterms:"
+
+class ImportReport(object):
+    """
+    The outcome of a bulk import: how many rows were imported, how quickly, and
+    the errors for any rows which failed
+    """
+    def __init__(self):
+        self.rows = 0
+        self.succeeded = 0
+        self.errors = []
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def failed(self):
+        return len(self.errors)
+
+    @property
+    def elapsed(self):
+        end = self.finished if self.finished is not None else time.time()
+        return end - self.started
+
+    @property
+    def rows_per_second(self):
+        elapsed = self.elapsed
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def add_result(self, line, dip_path, error):
+        self.rows += 1
+        if error is None:
+            self.succeeded += 1
+        else:
+            self.errors.append((line, dip_path, error))
+
+class BulkImporter(object):
+    """
+    Imports dublin core and file registrations into many DIPs from a CSV or
+    JSON-lines file, optionally across a pool of processes
+    """
+    def __init__(self, base_dir=None, processes=None, separator="|", replace=False, chunk_size=1000,
+                 encoding="utf-8"):
+        """
+        Keyword Arguments:
+        base_dir    - the directory against which relative DIP and file paths are resolved
+                        (defaults to the current working directory)
+        processes   - the number of worker processes to use; None uses one per cpu, and 1
+                        imports everything in this process
+        separator   - the separator between multiple values in a single CSV cell
+        replace     - replace the existing values of each dcterms field in the row, rather
+                        than adding to them
+        chunk_size  - the number of rows to read ahead and hand out to the workers at once
+        encoding    - the character encoding of CSV files
+        """
+        # multiprocessing is only imported by bulk imports, not by everyone who imports dip
+        import multiprocessing
+        self.base_dir = base_dir if base_dir is not None else os.getcwd()
+        self.processes = processes if processes is not None else multiprocessing.cpu_count()
+        self.separator = separator
+        self.replace = replace
+        self.chunk_size = chunk_size
+        self.encoding = encoding
+
+    def import_file(self, path, progress=None):
+        """
+        Import the supplied file, treating it as JSON-lines if its name ends in .jsonl
+        or .json, and as CSV otherwise.
+
+        Keyword Arguments:
+        progress    - a function to call with the ImportReport after each chunk of rows
+
+        Returns an ImportReport
+        """
+        if path.endswith(".jsonl") or path.endswith(".json"):
+            return self.import_jsonl(path, progress)
+        return self.import_csv(path, progress)
+
+    def import_csv(self, path, progress=None):
+        """
+        Import the supplied CSV file, returning an ImportReport
+        """
+        with open(path, "rb") as f:
+            return self._import(self._csv_rows(f), progress)
+
+    def import_jsonl(self, path, progress=None):
+        """
+        Import the supplied JSON-lines file, returning an ImportReport
+        """
+        with open(path, "rb") as f:
+            return self._import(self._jsonl_rows(f), progress)
+
+    def _import(self, rows, progress):
+        import multiprocessing
+        report = ImportReport()
+        pool = multiprocessing.Pool(self.processes) if self.processes > 1 else None
+        try:
+            while True:
+                # read ahead a chunk at a time, so memory use does not depend on
+                # the size of the file
+                chunk = list(itertools.islice(rows, self.chunk_size))
+                if len(chunk) == 0:
+                    break
+                groups = _group_by_dip(chunk)
+                if pool is not None:
+                    results = pool.imap_unordered(_import_rows, groups)
+                else:
+                    results = itertools.imap(_import_rows, groups)
+                for group in results:
+                    for line, dip_path, error in group:
+                        report.add_result(line, dip_path, error)
+                log.info("imported " + str(report.rows) + " rows (" + str(report.failed) + " failed) at " +
+                            str(int(report.rows_per_second)) + " rows/s")
+                if progress is not None:
+                    progress(report)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        report.finished = time.time()
+        return report
+
+    def _csv_rows(self, f):
+        reader = csv.reader(f)
+        header = [column.decode(self.encoding) for column in reader.next()]
+        if len(header) > 0:
+            # spreadsheets often start a UTF-8 file with a byte order mark
+            header[0] = header[0].lstrip(u"\ufeff")
+        for line, cells in enumerate(reader, 2):
+            row = {"line" : line, "dip" : None, "files" : [], "dcterms" : []}
+            try:
+                cells = [cell.decode(self.encoding) for cell in cells]
+            except UnicodeDecodeError as e:
+                # hand the problem on to be reported like any other row error
+                row["error"] = "invalid " + self.encoding + ": " + str(e)
+                yield self._resolve(row)
+                continue
+            for column, cell in zip(header, cells):
+                column = column.strip()
+                values = [v.strip() for v in cell.split(self.separator) if v.strip() != ""] if self.separator else [cell]
+                if column == "dip":
+                    row["dip"] = cell.strip()
+                elif column == "file":
+                    row["files"] += values
+                elif column.startswith(DCTERMS_PREFIX):
+                    term = column[len(DCTERMS_PREFIX):]
+                    lang = None
+                    if "@" in term:
+                        term, lang = term.split("@", 1)
+                    row["dcterms"] += [(term, v, lang) for v in values]
+            yield self._resolve(row)
+
+    def _jsonl_rows(self, f):
+        for line, text in enumerate(f, 1):
+            if text.strip() == "":
+                continue
+            # hand any problem with the line on, to be reported like any other row error
+            try:
+                obj = json.loads(text)
+            except ValueError as e:
+                row = _error_row(line, "invalid json: " + str(e))
+            else:
+                try:
+                    row = _jsonl_row(line, obj)
+                except ValueError as e:
+                    row = _error_row(line, "invalid row: " + str(e))
+            yield self._resolve(row)
+
+    def _resolve(self, row):
+        if row["dip"]:
+            row["dip"] = os.path.join(self.base_dir, row["dip"])
+        else:
+            row["dip"] = None
+        row["files"] = [os.path.join(self.base_dir, p) for p in row["files"]]
+        row["replace"] = self.replace
+        return row
+
+def _error_row(line, error):
+    return {"line" : line, "dip" : None, "files" : [], "dcterms" : [], "error" : error}
+
+def _jsonl_row(line, obj):
+    # make a row of a JSON-lines object, raising a ValueError if it isn't of the
+    # expected form
+    if not isinstance(obj, dict):
+        raise ValueError("expected an object, not " + type(obj).__name__)
+    dip = obj.get("dip")
+    if dip is not None and not isinstance(dip, basestring):
+        raise ValueError("dip must be a string")
+    files = obj.get("files", [])
+    if not isinstance(files, list) or not all([isinstance(p, basestring) for p in files]):
+        raise ValueError("files must be a list of strings")
+    dcterms = obj.get("dcterms", [])
+    if not isinstance(dcterms, list):
+        raise ValueError("dcterms must be a list")
+    for v in dcterms:
+        if (not isinstance(v, list) or len(v) not in [2, 3] or not isinstance(v[0], basestring) or
+                not isinstance(v[1], basestring) or (len(v) == 3 and v[2] is not None and not isinstance(v[2], basestring))):
+            raise ValueError("each dcterms value must be a [term, value] or [term, value, lang] list of strings, not " +
+                             json.dumps(v))
+    return {
+        "line" : line,
+        "dip" : dip,
+        "files" : files,
+        "dcterms" : [tuple(v) for v in dcterms]
+    }
+
+def _group_by_dip(rows):
+    # the rows for each DIP, in the order the DIPs first appear; rows which don't
+    # name a DIP touch nothing, so go on their own
+    groups = []
+    by_dip = {}
+    for row in rows:
+        if row["dip"] is None:
+            groups.append([row])
+        elif row["dip"] in by_dip:
+            by_dip[row["dip"]].append(row)
+        else:
+            by_dip[row["dip"]] = [row]
+            groups.append(by_dip[row["dip"]])
+    return groups
+
+def _import_rows(rows):
+    # apply the rows for a single DIP, in order
+    return [_import_row(row) for row in rows]
+
+def _import_row(row):
+    # apply a single row to its DIP.  This runs in the worker processes, so it
+    # reports any problem rather than raising it
+    try:
+        if row.get("error") is not None:
+            raise ValueError(row["error"])
+        if row["dip"] is None:
+            raise ValueError("row does not name a dip")
+        d = DIP(row["dip"])
+        with d.batch():
+            if row["replace"]:
+                terms = []
+                for v in row["dcterms"]:
+                    key = (v[0], v[2] if len(v) > 2 else None)
+                    if key not in terms:
+                        terms.append(key)
+                # a field without a language replaces the values in every language,
+                # so do those before the ones for a particular language
+                terms.sort(key=lambda k: k[1] is not None)
+                for term, lang in terms:
+                    values = [v[1] for v in row["dcterms"] if v[0] == term and (v[2] if len(v) > 2 else None) == lang]
+                    d.replace_dublin_core(term, values, lang)
+            else:
+                d.add_dublin_core_many(row["dcterms"])
+            for path in row["files"]:
+                d.set_file(path)
+        return row["line"], row["dip"], None
+    except Exception as e:
+        return row["line"], row["dip"], str(e)
@@ -0,0 +1,283 @@
+########################################################
+## Content-addressed package cache
+########################################################
+#
+# Packages are kept in packages/<base64 package format>/<key>/, where the key is
+# a hash of everything which goes into them: the package format, the packager
+# arguments, the path, md5, size and modification time of each file, and the
+# fingerprint of each metadata file.  So an identical package asked for again
+# (for another endpoint with the same package format, or for a retried deposit)
+# is the one which was built before, and a changed DIP gets a new one rather
+# than overwriting a package which may still be being sent.
+#
+# Each entry directory holds whatever the packager wrote, plus package.json,
+# which records the PackageInfo and is only written once the package is
+# complete.  Its modification time is the entry's last use, for the LRU
+# eviction which a PackageCachePolicy governs.
+
+import os, json, time, shutil, threading, glob
+
+INFO_FILE = "package.json"
+
+# how old a half-built entry (left behind by a process which died) must be before it is removed
+STALE_BUILD_SECONDS = 24 * 60 * 60
+
+class PackageCachePolicy(object):
+    """
+    Policy for the package cache, from the raw dictionary stored in deposit.json.
+    Settings are:
+
+    enabled         - True/False - reuse packages at all (default True)
+    max_packages    - int - keep at most N packages (default 4)
+    max_bytes       - int - keep at most this many bytes of packages (default no limit)
+    max_age_days    - number - remove packages which haven't been used for N days (default no limit)
+
+    The package most recently asked for is always kept, whatever the limits.
+    """
+    def __init__(self, raw=None):
+        self.raw = raw if raw is not None else {}
+
+    @property
+    def enabled(self):
+        return self.raw.get("enabled", True)
+
+    @property
+    def max_packages(self):
+        return self.raw.get("max_packages", 4)
+
+    @property
+    def max_bytes(self):
+        return self.raw.get("max_bytes")
+
+    @property
+    def max_age_days(self):
+        return self.raw.get("max_age_days")
+
+class CacheEntry(object):
+    """
+    A package in the cache
+    """
+    def __init__(self, entry_dir):
+        self.entry_dir = entry_dir
+        self.key = os.path.basename(entry_dir)
+
+    @property
+    def info_file(self):
+        return os.path.join(self.entry_dir, INFO_FILE)
+
+    @property
+    def last_used(self):
+        return os.path.getmtime(self.info_file)
+
+    @property
+    def size(self):
+        total = 0
+        for root, dirs, files in os.walk(self.entry_dir):
+            for f in files:
+                total += os.path.getsize(os.path.join(root, f))
+        return total
+
+class PackageCache(object):
+    """
+    The packages of a single DIP, by key
+    """
+    def __init__(self, cache_dir, base_dir, policy=None):
+        """
+        Arguments:
+        cache_dir   - the directory the packages are kept in (the DIP's packages directory)
+        base_dir    - the DIP's directory, which the file paths in package.json are relative to
+
+        Keyword Arguments:
+        policy      - the PackageCachePolicy to evict packages by
+        """
+        self.cache_dir = cache_dir
+        self.base_dir = base_dir
+        self.policy = policy if policy is not None else PackageCachePolicy()
+        self._lock = threading.Lock()
+
+    def get(self, subdir, key):
+        """
+        The PackageInfo of the package with the supplied key, if there is one in the
+        cache (and it is still all there), or None
+        """
+        entry_dir = os.path.join(self.cache_dir, subdir, key)
+        info_file = os.path.join(entry_dir, INFO_FILE)
+        try:
+            with open(info_file) as f:
+                raw = json.load(f)
+        except (IOError, ValueError):
+            return None
+        info = self._from_raw(raw, entry_dir)
+        if not os.path.isfile(info.path):
+            # someone has cleaned up the package itself, so the entry is no good
+            self._remove_dir(entry_dir)
+            return None
+        os.utime(info_file, None)
+        return info
+
+    def build(self, subdir, key, build):
+        """
+        Build the package with the supplied key, by calling build with the directory
+        to write it in (which must return its PackageInfo), and add it to the cache,
+        evicting older packages as the policy requires.  If another process or thread
+        builds the same package at the same time, whichever finishes second uses the
+        first's.
+
+        Returns the PackageInfo of the cached package
+        """
+        tmp_dir = self.reserve(subdir, key)
+        try:
+            info = build(tmp_dir)
+        except:
+            self.discard(tmp_dir)
+            raise
+        info = self.commit(subdir, key, tmp_dir, info, evict=False)
+        self.evict(keep=os.path.join(self.cache_dir, subdir, key))
+        return info
+
+    def reserve(self, subdir, key):
+        """
+        The directory to build the package with the supplied key in, for building it
+        outside of build; the package must then be either committed or discarded
+        """
+        entry_dir = os.path.join(self.cache_dir, subdir, key)
+        tmp_dir = entry_dir + ".tmp." + str(os.getpid()) + "." + str(threading.current_thread().ident)
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        return tmp_dir
+
+    def commit(self, subdir, key, tmp_dir, info, evict=True):
+        """
+        Add the package built in the reserved tmp_dir, whose PackageInfo is info, to the
+        cache (evicting older packages as the policy requires, unless evict is False)
+
+        Returns the PackageInfo of the cached package
+        """
+        entry_dir = os.path.join(self.cache_dir, subdir, key)
+        try:
+            if info is None:
+                shutil.rmtree(tmp_dir)
+                return None
+            with open(os.path.join(tmp_dir, INFO_FILE), "wb") as f:
+                f.write(json.dumps(self._to_raw(info, tmp_dir), sort_keys=True, indent=2))
+
+            # an entry without a package.json is one which was being built when its
+            # process died, so it can go
+            if os.path.isdir(entry_dir) and not os.path.isfile(os.path.join(entry_dir, INFO_FILE)):
+                self._remove_dir(entry_dir)
+            try:
+                os.rename(tmp_dir, entry_dir)
+            except OSError:
+                # beaten to it
+                existing = self.get(subdir, key)
+                if existing is None:
+                    raise
+                shutil.rmtree(tmp_dir)
+                return existing
+        except:
+            self.discard(tmp_dir)
+            raise
+
+        if evict:
+            self.evict(keep=entry_dir)
+        return self.get(subdir, key)
+
+    def discard(self, tmp_dir):
+        """
+        Throw away a package being built in a reserved tmp_dir
+        """
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+
+    def remove(self, info):
+        """
+        Remove the package with the supplied PackageInfo from the cache
+        """
+        entry_dir = getattr(info, "package_dir", None)
+        if entry_dir is not None and os.path.isfile(os.path.join(entry_dir, INFO_FILE)):
+            self._remove_dir(entry_dir)
+
+    def entries(self):
+        """
+        All the complete packages in the cache, most recently used first
+        """
+        entries = [CacheEntry(os.path.dirname(p)) for p in glob.glob(os.path.join(self.cache_dir, "*", "*", INFO_FILE))]
+        timed = []
+        for e in entries:
+            try:
+                timed.append((e.last_used, e))
+            except OSError:
+                pass    # removed from under us
+        timed.sort(key=lambda t: t[0], reverse=True)
+        return [e for t, e in timed]
+
+    def evict(self, keep=None, now=None):
+        """
+        Remove packages as the policy requires, least recently used first.
+
+        Keyword Arguments:
+        keep    - the directory of an entry which must not be removed (or a list of them)
+        now     - the time (in seconds since the epoch) to measure ages against
+
+        Returns the keys of the packages removed
+        """
+        if now is None:
+            now = time.time()
+        if not isinstance(keep, list):
+            keep = [keep]
+        removed = []
+        with self._lock:
+            self._remove_stale_builds(now)
+            entries = self.entries()
+            kept = []
+            total = 0
+            for e in entries:
+                if e.entry_dir in keep:
+                    kept.append(e)
+                    total += e.size
+                    continue
+                too_old = self.policy.max_age_days is not None and now - e.last_used > self.policy.max_age_days * 86400
+                too_many = self.policy.max_packages is not None and len(kept) >= self.policy.max_packages
+                size = e.size
+                too_big = self.policy.max_bytes is not None and total + size > self.policy.max_bytes
+                if too_old or too_many or too_big:
+                    self._remove_dir(e.entry_dir)
+                    removed.append(e.key)
+                else:
+                    kept.append(e)
+                    total += size
+        return removed
+
+    def _remove_stale_builds(self, now):
+        for tmp_dir in glob.glob(os.path.join(self.cache_dir, "*", "*.tmp.*")):
+            try:
+                if now - os.path.getmtime(tmp_dir) > STALE_BUILD_SECONDS:
+                    shutil.rmtree(tmp_dir)
+            except OSError:
+                pass
+
+    def _remove_dir(self, entry_dir):
+        # take package.json out first, so that nobody picks up a half-removed entry
+        try:
+            os.unlink(os.path.join(entry_dir, INFO_FILE))
+        except OSError:
+            pass
+        shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def _to_raw(self, info, entry_dir):
+        raw = dict(info.__dict__)
+        raw.pop("package_dir", None)
+        raw["path"] = os.path.relpath(info.path, entry_dir)
+        raw["file_paths"] = [os.path.relpath(p, self.base_dir) for p in info.file_paths]
+        return raw
+
+    def _from_raw(self, raw, entry_dir):
+        from packagers import PackageInfo
+        raw = dict(raw)
+        info = PackageInfo(os.path.join(entry_dir, raw.pop("path")),
+                           [os.path.abspath(os.path.join(self.base_dir, p)) for p in raw.pop("file_paths")],
+                           raw.pop("metadata_formats"), raw.pop("filename"), raw.pop("mimetype"))
+        info.__dict__.update(raw)
+        info.package_dir = entry_dir
+        return info
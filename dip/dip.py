@@ -1,6 +1,13 @@
-import os, datetime, json, uuid, hashlib, logging, sword2, base64
-from lxml import etree
-import packagers
+import os, time, datetime, json, logging, base64, threading, contextlib
+from StringIO import StringIO
+import packagers, history, metadata, profiling, cache, httpcache
+from metrics import Metrics
+from tracing import Tracer
+
+# sword2 (and the http stack behind it), lxml, hashlib and uuid are all slow to
+# import relative to the work done by a short-lived process which only looks
+# at the local state of a DIP (e.g. set_file or get_state), so they are imported
+# where they are needed rather than here.  tests/test_import.py keeps us honest.
 
 log = logging.getLogger(__name__)
 
@@ -18,9 +25,64 @@ def _absolute_path(rel_path, from_path):
     path = os.path.normpath(os.path.join(from_path, rel_path))
     return os.path.abspath(path)
 
+def _new_md5():
+    # hashing files is all a local operation needs hashlib for, and hashlib loads
+    # OpenSSL where it can, so use the interpreter's own md5 where there is one
+    try:
+        import _md5
+        return _md5.new()
+    except ImportError:
+        import hashlib
+        return hashlib.md5()
+
+def _utf8(value):
+    # endpoint details come back from deposit.json as unicode, but httplib needs
+    # the request line and headers as byte strings if it is to send a binary body
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
 class DIP(object):
     
-    def __init__(self, base_dir):
+    def __init__(self, base_dir, background_history=False, history_queue_size=1000, metrics=None, tracer=None, profile=None,
+                 http_layer=None):
+        """
+        Construct a DIP around the supplied directory, initialising it if necessary
+        
+        Arguments:
+        base_dir    -   path to the DIP directory, relative to the executing script or absolute
+        
+        Keyword Arguments:
+        background_history  -   write the history of communications with endpoints on a background
+                                thread, rather than before and after each request.  The thread
+                                runs until the DIP is closed (see close)
+        history_queue_size  -   the number of history records which may be waiting to be written
+                                before a deposit has to wait for them
+        metrics             -   a metrics.Metrics object to report hashing, packaging, upload and
+                                history timings to (by default they go nowhere)
+        tracer              -   a tracing.Tracer to make spans of each deposit, delete and statement
+                                request with (by default nothing is traced)
+        profile             -   profile each deposit, package and get_state, writing the results
+                                alongside the history (see profiling.py).  If this is None, the
+                                DIP_PROFILE environment variable decides
+        http_layer          -   a callable which takes a transport.ProgressReporter and returns the
+                                sword2 HTTP layer to make requests of endpoints with (by default a
+                                transport.DepositHttpLayer, which sends payloads in fixed size chunks).
+                                GETs go through each endpoint's HTTP cache first (see
+                                set_http_cache_policy)
+        """
+        # writes of the deposit info and dc are deferred while we are in a batch
+        self._batch_depth = 0
+        self._batch_dirty = set()
+        
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.tracer = tracer if tracer is not None else Tracer()
+        self._http_layer = http_layer
+        
+        if profile is None:
+            profile = profiling.profile_from_env()
+        self._profiler = profiling.Profiler() if profile else None
+        
         # ensure that the base_dir exists
         self._guarantee_directory(base_dir)
        
@@ -34,18 +96,30 @@ class DIP(object):
         # ensure that the history dir exists
         history_dir = os.path.join(self.base_dir, "history")
         self._guarantee_directory(history_dir)
+        self._history_stores = {}
+        self._history_writer = history.HistoryWriter(history_queue_size) if background_history else None
+        
+        # serialised atom entries for metadata-only deposits, by metadata file
+        self._entry_cache = {}
+
+        # the caches of each endpoint's responses to GETs, as they are used
+        self._http_caches = {}
+        self._http_caches_lock = threading.Lock()
         
         # ensure that the packages dir exists
         packages_dir = os.path.join(self.base_dir, "packages")
         self._guarantee_directory(packages_dir)
+        self._package_cache = cache.PackageCache(packages_dir, self.base_dir, self.get_package_cache_policy())
         
         # ensure that the metadata dir exists
         metadata_dir = os.path.join(self.base_dir, "metadata")
         self._guarantee_directory(metadata_dir)
         
-        # load the dublin core (which will initialise if necessary)
+        # make sure the dublin core exists; it is only read in when we first need it
         self.nsmap = {"dcterms" : "http://purl.org/dc/terms/", "xml" : "http://www.w3.org/XML/1998/namespace"}
-        self._load_dc()
+        self._dc_xml = None
+        self._dc_idx = None
+        self._init_dc()
     
     @property
     def deposit_info_raw(self):
@@ -59,14 +133,46 @@ class DIP(object):
         
     @property
     def dc_xml(self):
+        if self._dc_xml is None:
+            self._load_dc()
         return self._dc_xml
     
     @dc_xml.setter
     def dc_xml(self, value):
         # FIXME: should probably do some value validation
         self._dc_xml = value
+        self._dc_idx = None
         self._save_dc()
     
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Group a number of changes to the DIP, so that deposit.json and the dublin core
+        are each written at most once, when the outermost batch completes:
+        
+            with dip.batch():
+                dip.add_dublin_core("title", "A title")
+                dip.set_file("article.pdf")
+        
+        If the block raises an exception, nothing is written, and the DIP should be
+        opened again before it is used further
+        """
+        self._batch_depth += 1
+        completed = False
+        try:
+            yield self
+            completed = True
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                dirty = self._batch_dirty
+                self._batch_dirty = set()
+                if completed:
+                    if "deposit_info" in dirty:
+                        self._save_deposit_info()
+                    if "dc" in dirty:
+                        self._save_dc()
+    
     def get_files(self):
         """
         Get a list of DepositFile objects currently part of this DIP
@@ -86,13 +192,17 @@ class DIP(object):
                 return DepositFile(self, raw=fr)
         return None
     
-    def set_file(self, path):
+    def set_file(self, path, md5=None):
         """
         Add the file at the specified path by-reference to the DIP.  This operation 
         will calculate the file's md5 at the point that it is added.
         
         If the file path already exists in the DIP, its record will be updated.
         
+        Keyword Arguments:
+        md5     -   the file's md5, if the caller has just worked it out (as a packager
+                    does while reading the file), so that it isn't worked out again
+        
         Returns a DepositFile object representing the added file
         """
         # normalise the file path, to be relative to the self.base_dir, so that we can check it
@@ -111,10 +221,10 @@ class DIP(object):
         
         # if we have an existing record for that file, just force an update
         if existing_record is not None:
-            self._update_file_record(existing_record)
+            self._update_file_record(existing_record, md5)
         else:
             # otherwise, add a new file record for that path
-            self._add_file_record(path)
+            self._add_file_record(path, md5)
     
     def remove_file(self, path):
         # normalise the file path, to be relative to the self.base_dir, so that we can check it
@@ -193,6 +303,7 @@ class DIP(object):
                     break
         else:
             # otherwise, give the endpoint an id
+            import uuid
             endpoint.id = str(uuid.uuid4())
         
         # if the endpoint already exists, remove it
@@ -233,15 +344,146 @@ class DIP(object):
         if existing_index > -1:
             del self.deposit_info_raw['endpoints'][existing_index]
             self._save_deposit_info()
+            self._http_cache(endpoint_id).clear()
         
-    def get_history(self, endpoint_id):
+    def get_history(self, endpoint_id, since=None, until=None, method=None):
         """
         get a DepositHistory object representing the deposit history on the supplied endpoint_id
         
         Arguments:
         endpoint_id -   the UUID of the endpoint whose history we are interested in
+        
+        Keyword Arguments:
+        since   -   only include communications at or after this datetime
+        until   -   only include communications at or before this datetime
+        method  -   only include communications with this HTTP method (e.g. "POST")
         """
-        pass
+        # make sure anything still waiting to be written is included
+        self.flush_history()
+        
+        endpoint = self.get_endpoint(endpoint_id)
+        if endpoint is None:
+            endpoint = Endpoint(id=endpoint_id)
+        store = self._history_store(endpoint_id)
+        entries = store.entries(since=since, until=until, method=method)
+        return DepositHistory(self, endpoint, store, entries)
+    
+    def flush_history(self):
+        """
+        Block until all the history recorded so far has been written to disk.  This
+        returns immediately unless the DIP was created with background_history=True
+        """
+        if self._history_writer is not None:
+            self._history_writer.flush()
+    
+    def close(self):
+        """
+        Write out any history still waiting to be written, and stop the DIP's history
+        writer thread if it has one.  The DIP may still be used afterwards, with its
+        history written directly.  A DIP is also a context manager which closes itself:
+        
+            with DIP("path/to/dip", background_history=True) as dip:
+                dip.deposit(endpoint_id)
+        """
+        writer = self._history_writer
+        if writer is None:
+            return
+        self._history_writer = None
+        try:
+            writer.flush()
+        finally:
+            writer.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+    
+    def set_history_policy(self, endpoint_id=None, keep_last=None, keep_days=None, compress_after_days=None,
+                            compression=None, dedupe=None, body_compression=None, max_body_size=None, oversize=None):
+        """
+        Set the retention, compression and de-duplication policy for the history of
+        the whole DIP, or of a single endpoint.  Settings on an endpoint override
+        those on the DIP.  Arguments left as None are not changed.
+        
+        Keyword Arguments:
+        endpoint_id -   the endpoint to set the policy for; if None, set the DIP's default policy
+        keep_last   -   keep only the most recent N exchanges with the endpoint
+        keep_days   -   keep only the exchanges from the last N days
+        compress_after_days -   compress bodies older than N days when compacting
+        compression -   "gzip" or "zstd"
+        dedupe      -   whether to store identical bodies only once
+        body_compression    -   "gzip" or "zstd", to compress bodies as they are recorded
+        max_body_size   -   the largest body, in bytes, to record in full
+        oversize    -   "truncate" or "summarise" bodies larger than max_body_size
+        """
+        if endpoint_id is not None:
+            endpoint = self.get_endpoint(endpoint_id)
+            if endpoint is None:
+                raise InitialiseException("no such endpoint " + endpoint_id)
+            raw = endpoint.raw
+        else:
+            raw = self.deposit_info_raw
+        
+        policy = raw.get("history", {})
+        settings = {"keep_last" : keep_last, "keep_days" : keep_days, "compress_after_days" : compress_after_days,
+                    "compression" : compression, "dedupe" : dedupe, "body_compression" : body_compression,
+                    "max_body_size" : max_body_size, "oversize" : oversize}
+        for k, v in settings.iteritems():
+            if v is not None:
+                policy[k] = v
+        raw["history"] = policy
+        self._save_deposit_info()
+        
+        # bring any stores we already have open up to date
+        for eid, store in self._history_stores.items():
+            store.policy = self.get_history_policy(eid)
+    
+    def get_history_policy(self, endpoint_id=None):
+        """
+        Get the HistoryPolicy which applies to the supplied endpoint_id, or the
+        DIP's default policy if no endpoint_id is given
+        """
+        raw = dict(self.deposit_info_raw.get("history", {}))
+        if endpoint_id is not None:
+            endpoint = self.get_endpoint(endpoint_id)
+            if endpoint is not None:
+                raw.update(endpoint.raw.get("history", {}))
+        return history.HistoryPolicy(raw)
+    
+    def compact_history(self, endpoint_id=None, background=True):
+        """
+        Apply the history policy to the history of one or all endpoints, removing
+        exchanges outside the retention window, compressing older bodies and
+        de-duplicating identical ones.  Deposits may carry on while this runs.
+        
+        Keyword Arguments:
+        endpoint_id -   the endpoint whose history to compact; if None, compact all of them
+        background  -   run the compaction on a background thread
+        
+        If run in the background, returns the started threading.Thread, whose "results"
+        attribute is populated as each endpoint completes.  Otherwise returns the results
+        directly: a dictionary of endpoint id to the compaction statistics
+        """
+        if endpoint_id is not None:
+            endpoint_ids = [endpoint_id]
+        else:
+            endpoint_ids = [e.id for e in self.get_endpoints()]
+        
+        results = {}
+        def run():
+            for eid in endpoint_ids:
+                results[eid] = self._history_store(eid).compact()
+        
+        if not background:
+            run()
+            return results
+        
+        t = threading.Thread(target=run, name="dip-history-compaction")
+        t.results = results
+        t.start()
+        return t
     
     def get_metadata_files(self):
         """
@@ -259,7 +501,7 @@ class DIP(object):
                 return MetadataFile(self, raw=fr)
         return None
         
-    def add_metadata_file(self, md_format, path=None, string=None, deposit_includes_root=True):
+    def add_metadata_file(self, md_format, path=None, string=None, deposit_includes_root=True, schema=None):
         """
         Add a metadata file or string by-value to the DIP
         
@@ -271,12 +513,92 @@ class DIP(object):
         string  -   full string value of the contents of the metadata file
         deposit_includes_root    -   whether to include the metadata in whole (including the root) into a metadata-only deposit, or 
                                     just the children of the root
+        schema  -   path to an XML Schema (.xsd) or RelaxNG (.rng) file to validate the metadata against
         
         You should only supply one of "path" or "string".  If both are provided, the
         "path" will take precedence
+        
+        The metadata is streamed into the DIP's metadata directory, and checked as it
+        goes, so large files do not need to fit in memory.  If the metadata is not
+        well formed, or not valid against the schema, a metadata.MetadataException is
+        raised and the DIP is left as it was.  Adding a format which is already in the
+        DIP replaces it.
+        
+        Returns a MetadataFile object representing the added metadata
         """
-        # NOTE: we are not implementing this yet - dc will suffice for the moment
-        pass
+        if md_format == "dcterms":
+            raise InitialiseException("dcterms metadata is managed through the dublin core methods")
+        if path is None and string is None:
+            raise InitialiseException("add_metadata_file requires either a path or a string")
+        
+        validator = metadata.load_schema(schema) if schema is not None else None
+        rel_path = "metadata/" + metadata.metadata_filename(md_format)
+        dest = os.path.join(self.base_dir, "metadata", metadata.metadata_filename(md_format))
+        
+        if path is not None:
+            if not os.path.isfile(path):
+                raise InitialiseException(path + " is not a path to a file")
+            with open(path, "rb") as source:
+                metadata.copy_validated(source, dest, validator)
+        else:
+            if isinstance(string, unicode):
+                string = string.encode("utf-8")
+            metadata.copy_validated(StringIO(string), dest, validator)
+        
+        return self._set_metadata_record(md_format, rel_path, deposit_includes_root)
+    
+    def crosswalk_metadata(self, from_format, to_format, stylesheet, deposit_includes_root=True, **params):
+        """
+        Derive metadata in a new format from metadata already in the DIP, using an XSLT
+        stylesheet.  Compiled stylesheets are cached for the life of the process, so
+        crosswalking many DIPs with the same stylesheet only compiles it once.
+        
+        Arguments:
+        from_format -   the format of the existing metadata (e.g. "dcterms")
+        to_format   -   the format of the metadata to be generated (e.g. "mods")
+        stylesheet  -   path to the XSLT stylesheet which converts from one to the other
+        
+        Keyword Arguments:
+        deposit_includes_root   -   as for add_metadata_file
+        
+        Any other keyword arguments are passed to the stylesheet as string parameters
+        
+        Returns a MetadataFile object representing the derived metadata
+        """
+        source = self.get_metadata_file(from_format)
+        if source is None:
+            raise InitialiseException("no metadata in format " + from_format + " to crosswalk from")
+        
+        # we already hold the dublin core in memory (including any changes not yet
+        # written out by a batch), so there's no need to parse it again
+        from lxml import etree
+        source_xml = etree.ElementTree(self.dc_xml) if from_format == "dcterms" else source.path
+        
+        rel_path = "metadata/" + metadata.metadata_filename(to_format)
+        dest = os.path.join(self.base_dir, "metadata", metadata.metadata_filename(to_format))
+        metadata.transform(source_xml, stylesheet, dest, **params)
+        return self._set_metadata_record(to_format, rel_path, deposit_includes_root)
+    
+    def _set_metadata_record(self, md_format, rel_path, include_root):
+        n = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+        record = None
+        for fr in self.deposit_info_raw['metadata']:
+            if fr['format'] == md_format:
+                record = fr
+                break
+        if record is None:
+            record = {"format" : md_format, "added" : n}
+            self.deposit_info_raw['metadata'].append(record)
+        record["path"] = rel_path
+        record["include_root"] = include_root
+        record["modified"] = n
+        
+        # the file may have been rewritten within the fingerprint's resolution
+        self._entry_cache.pop((_absolute_path(rel_path, self.base_dir), True), None)
+        self._entry_cache.pop((_absolute_path(rel_path, self.base_dir), False), None)
+        
+        self._save_deposit_info()
+        return MetadataFile(self, raw=record)
         
     def add_dublin_core(self, dcterm, value, lang=None):
         """
@@ -289,10 +611,44 @@ class DIP(object):
         Keyword Arguments:
         lang    -   The language of the value
         """
-        element = etree.SubElement(self._dc_xml, "{" + self.nsmap["dcterms"] + "}" + dcterm, nsmap=self.nsmap)
-        if lang is not None:
-            element.set("{" + self.nsmap["xml"] + "}lang", lang)
-        element.text = value
+        self._add_dc_element(dcterm, value, lang)
+        
+        # save the changes
+        self._save_dc()
+    
+    def add_dublin_core_many(self, values):
+        """
+        Add many Dublin Core values to the DIP at once, saving the metadata only
+        when they have all been added
+        
+        Arguments:
+        values  -   an iterable of (dcterm, value) or (dcterm, value, lang) tuples
+        """
+        for v in values:
+            lang = v[2] if len(v) > 2 else None
+            self._add_dc_element(v[0], v[1], lang)
+        
+        # save the changes
+        self._save_dc()
+    
+    def replace_dublin_core(self, dcterm, values, lang=None):
+        """
+        Replace all the values of a Dublin Core field with the supplied values, saving
+        the metadata once.  If lang is None, the values of the field in every language
+        are replaced, and the new values are added without a language.
+        
+        Arguments:
+        dcterm  -   The field from the dcterms namespace
+        values  -   a list of string values to put in the field (or a single string)
+        
+        Keyword Arguments:
+        lang    -   The language of the values
+        """
+        if isinstance(values, basestring):
+            values = [values]
+        self._remove_dc_pairs(self._match_dc(dcterm, None, lang))
+        for value in values:
+            self._add_dc_element(dcterm, value, lang)
         
         # save the changes
         self._save_dc()
@@ -307,19 +663,8 @@ class DIP(object):
         value   -   The string value to put in the field
         lang    -   The language of the value
         """
-        # locate removable elements
-        elements = []
-        for element in self.dc_xml:
-            match_dcterm = True if dcterm is None else "{" + self.nsmap["dcterms"] + "}" + dcterm == element.tag
-            match_value = True if value is None else element.text.strip() == value
-            match_lang = True if lang is None else element.get("{" + self.nsmap["xml"] + "}lang") == lang
-            
-            if match_dcterm and match_value and match_lang:
-                elements.append(element)
-        
-        # now remove each element from the dc xml
-        for element in elements:
-            self.dc_xml.remove(element)
+        # locate and remove the matching elements
+        self._remove_dc_pairs(self._match_dc(dcterm, value, lang))
         
         # save the changes
         self._save_dc()
@@ -334,17 +679,81 @@ class DIP(object):
             (dcterm, value, lang)
         
         """
-        dcs = []
-        
+        return [t for element, t in self._match_dc(dcterm, value, lang)]
+    
+    def _dc_index(self):
+        # the dcterms elements indexed by term and by (term, lang), as lists of
+        # (element, (dcterm, value, lang)) pairs in document order.  This is built
+        # when first needed, and kept up to date by the methods which change the dc
+        if self._dc_idx is None:
+            by_term = {}
+            by_term_lang = {}
+            for pair in self._dc_pairs():
+                term, _, lang = pair[1]
+                by_term.setdefault(term, []).append(pair)
+                by_term_lang.setdefault((term, lang), []).append(pair)
+            self._dc_idx = (by_term, by_term_lang)
+        return self._dc_idx
+    
+    def _dc_pairs(self):
+        # (element, (dcterm, value, lang)) for each dcterms element in the dc xml
+        prefix = "{" + self.nsmap["dcterms"] + "}"
+        lang_attr = "{" + self.nsmap["xml"] + "}lang"
         for element in self.dc_xml:
-            match_dcterm = True if dcterm is None else "{" + self.nsmap["dcterms"] + "}" + dcterm == element.tag
-            match_value = True if value is None else element.text.strip() == value
-            match_lang = True if lang is None else element.get("{" + self.nsmap["xml"] + "}lang") == lang
-            
-            if match_dcterm and match_value and match_lang:
-                dcs.append((element.tag[len("{" + self.nsmap["dcterms"] + "}"):], element.text.strip(), element.get("{" + self.nsmap["xml"] + "}lang")))
+            if not isinstance(element.tag, basestring) or not element.tag.startswith(prefix):
+                continue
+            text = element.text.strip() if element.text is not None else ""
+            yield (element, (element.tag[len(prefix):], text, element.get(lang_attr)))
+    
+    def _match_dc(self, dcterm=None, value=None, lang=None):
+        if dcterm is None:
+            # no index to help us, so look at every element
+            lang_attr = "{" + self.nsmap["xml"] + "}lang"
+            prefix = "{" + self.nsmap["dcterms"] + "}"
+            candidates = []
+            for element in self.dc_xml:
+                if not isinstance(element.tag, basestring):
+                    continue
+                text = element.text.strip() if element.text is not None else ""
+                candidates.append((element, (element.tag[len(prefix):], text, element.get(lang_attr))))
+            if lang is not None:
+                candidates = [p for p in candidates if p[1][2] == lang]
+        elif lang is not None:
+            candidates = self._dc_index()[1].get((dcterm, lang), [])
+        else:
+            candidates = self._dc_index()[0].get(dcterm, [])
+        
+        if value is not None:
+            return [p for p in candidates if p[1][1] == value]
+        return list(candidates)
+    
+    def _add_dc_element(self, dcterm, value, lang=None):
+        from lxml import etree
+        element = etree.SubElement(self.dc_xml, "{" + self.nsmap["dcterms"] + "}" + dcterm, nsmap=self.nsmap)
+        if lang is not None:
+            element.set("{" + self.nsmap["xml"] + "}lang", lang)
+        element.text = value
         
-        return dcs
+        if self._dc_idx is not None:
+            pair = (element, (dcterm, value.strip() if value is not None else "", lang))
+            self._dc_idx[0].setdefault(dcterm, []).append(pair)
+            self._dc_idx[1].setdefault((dcterm, lang), []).append(pair)
+    
+    def _remove_dc_pairs(self, pairs):
+        if len(pairs) == 0:
+            return
+        removing = set([id(element) for element, t in pairs])
+        for element, t in pairs:
+            self.dc_xml.remove(element)
+        
+        if self._dc_idx is not None:
+            by_term, by_term_lang = self._dc_idx
+            for term in set([t[0] for element, t in pairs]):
+                if term in by_term:
+                    by_term[term] = [p for p in by_term[term] if id(p[0]) not in removing]
+            for key in set([(t[0], t[2]) for element, t in pairs]):
+                if key in by_term_lang:
+                    by_term_lang[key] = [p for p in by_term_lang[key] if id(p[0]) not in removing]
         
     def get_state(self):
         """
@@ -355,6 +764,10 @@ class DIP(object):
         
         Return a DepositState object representing the results of this operation
         """
+        with self._profiling("get_state"):
+            return self._get_state()
+    
+    def _get_state(self):
         # first update all the file records
         files = self.get_files()
         for f in files:
@@ -392,27 +805,27 @@ class DIP(object):
                 ds.add_state(ds.NO_ACTION, f, None)
 
         for m in self.get_metadata_files():
-            # check each metadata file for whether it is up to date with the endpoint or not
-            for er in f.endpoints():
-                if f.updated() > er.last_deposit():
-                    ds.add_state(ds.OUT_OF_DATE, f, er)
+            # check each metadata file for whether it is up to date with the endpoints it
+            # has been deposited to (metadata which has never been deposited anywhere
+            # goes along with the next deposit, so it isn't reported on)
+            for er in m.endpoints:
+                if m.updated > er.last_deposit:
+                    ds.add_state(ds.OUT_OF_DATE, m, er)
                 else:
-                    ds.add_state(ds.UP_TO_DATE, f, er)
-            # check each endpoint it has been deposited to to check that it has been deposited everywhere
-            feids = [er.endpoint.id for er in f.endpoints()]
-            deids = [e.id for e in self.get_endpoints()]
-            for endpoint in deids:
-                if eid not in feids:
-                    ds.add_state(ds.NOT_DEPOSITED, f, f.get_endpoint_record(eid))
+                    ds.add_state(ds.UP_TO_DATE, m, er)
 
         return ds
         
     def deposit(self, endpoint_id, metadata_only=False, metadata_format="dcterms",
-                user_pass=None, in_progress=False, metadata_relevant=True, **packager_args):
+                user_pass=None, in_progress=False, metadata_relevant=True, progress=None, **packager_args):
         """
         Carry out a deposit (create or update) operation of the DIP to the specified
         endpoint.
         
+        If a progress callback is supplied, it is called with a transport.Progress object
+        as the deposit moves through its phases (packaging, uploading, awaiting_receipt and
+        done), and every half a second or so while the payload is being sent.
+        
         Returns a tuple: (CommsMeta, sword2.DepositReceipt)
         
         CommsMeta is the response metadata from the http request
@@ -424,11 +837,17 @@ class DIP(object):
         if endpoint.sd_iri is None or endpoint.col_iri is None:
             raise DepositException("Endpoint " + endpoint.id + " does not have a Service Document IRI and/or a Collection IRI; deposit cannot proceed")
         
-        if metadata_only:
-            return self._deposit_metadata(endpoint, metadata_format, user_pass=user_pass, in_progress=in_progress)
-        else:
-            return self._deposit_binary(endpoint, user_pass=user_pass, in_progress=in_progress,
-                                        metadata_relevant=metadata_relevant, **packager_args)
+        with self._profiling("deposit", endpoint.id) as run:
+            with self.tracer.span("dip.deposit", endpoint_id=endpoint.id, metadata_only=metadata_only):
+                if metadata_only:
+                    response_record, receipt = self._deposit_metadata(endpoint, metadata_format, user_pass=user_pass,
+                                                                      in_progress=in_progress, progress=progress)
+                else:
+                    response_record, receipt = self._deposit_binary(endpoint, user_pass=user_pass, in_progress=in_progress,
+                                                                    metadata_relevant=metadata_relevant, progress=progress,
+                                                                    **packager_args)
+            run.comms_timestamp = response_record.raw.get("timestamp")
+        return response_record, receipt
         
     def delete(self, endpoint_id, user_pass=None):
         """
@@ -440,8 +859,12 @@ class DIP(object):
         if endpoint.edit_iri is None:
             raise DepositException("Can't delete from endpoint " + endpoint_id + " as it has never been deposited to")
 
+        with self.tracer.span("dip.delete", endpoint_id=endpoint.id):
+            return self._delete(endpoint, user_pass)
+    
+    def _delete(self, endpoint, user_pass=None):
         # construct a new connection object around the Service Document identifier
-        conn = sword2.Connection(endpoint.sd_iri, user_name=endpoint.username, user_pass=user_pass, on_behalf_of=endpoint.obo)
+        conn = self._connection(endpoint, user_pass)
 
         # set up a request record object
         request_record = CommsMeta(self, endpoint, type="request", username=endpoint.username)
@@ -449,29 +872,31 @@ class DIP(object):
             request_record.headers['On-Behalf-Of'] = endpoint.obo
         request_record.method = "DELETE"
         request_record.request_url = endpoint.edit_iri
-        request_record.save()
+        self._record_history(request_record)
 
         # call delete on the container
-        receipt = conn.delete(endpoint.edit_iri, on_behalf_of=endpoint.obo)
+        with self.tracer.span("delete", endpoint_id=endpoint.id):
+            receipt = self._request("DELETE", conn.delete, _utf8(endpoint.edit_iri), on_behalf_of=_utf8(endpoint.obo))
 
         # build the response object
         response_record = CommsMeta(self, endpoint,
                                 timestamp=request_record.timestamp, type="response",
                                 method="DELETE", request_url=endpoint.edit_iri, response_code=receipt.code)
 
-        if receipt.dom is not None:
-            response_record.write_body_file(etree.tostring(receipt.dom))
-        response_record.save()
+        self._record_history(response_record, receipt.dom)
 
         # now cleanup this endpoint from every file and metadata record
-        for f in self.get_files():
-            f.remove_endpoint_record(endpoint.id)
-        for m in self.get_metadata_files():
-            m.remove_endpoint_record(endpoint.id)
-
-        # remove the edit iri from the endpoint record and save
-        del endpoint.edit_iri
-        self._save_deposit_info()
+        with self.tracer.span("cleanup", endpoint_id=endpoint.id) as span:
+            files = self.get_files()
+            for f in files:
+                f.remove_endpoint_record(endpoint.id)
+            for m in self.get_metadata_files():
+                m.remove_endpoint_record(endpoint.id)
+            span.set_attribute("file_count", len(files))
+
+            # remove the edit iri from the endpoint record and save
+            del endpoint.edit_iri
+            self._save_deposit_info()
 
         return response_record, receipt
         
@@ -495,8 +920,206 @@ class DIP(object):
         # now we are in a position to package, make sure the output directory exists
         package_dir = self._package_dir(package_format)
         
-        package_info = packager.package(self, package_dir, **packager_args)
+        label = package_format if package_format is not None else packager.__class__.__name__
+        with self.tracer.span("package", format=label) as span:
+            if package_format is not None and self._package_cache.policy.enabled:
+                # reuse the package if we have already built one from exactly the same content
+                subdir = os.path.basename(package_dir)
+                key = self._package_key(package_format, packager_args)
+                package_info = self._package_cache.get(subdir, key)
+                span.set_attribute("cache_hit", package_info is not None)
+                self.metrics.increment("dip_package_cache_requests_total", result="hit" if package_info is not None else "miss")
+                if package_info is None:
+                    package_info = self._package_cache.build(subdir, key,
+                            lambda out_dir: self._build_package(packager, out_dir, endpoint_id, label, packager_args))
+            else:
+                package_info = self._build_package(packager, package_dir, endpoint_id, label, packager_args)
+            
+            if package_info is not None:
+                span.set_attribute("file_count", len(package_info.file_paths))
+                if os.path.isfile(package_info.path):
+                    span.set_attribute("bytes", os.path.getsize(package_info.path))
         return package_info
+    
+    def package_many(self, formats, **packager_args):
+        """
+        Package the DIP in several formats at once (say, for endpoints with different package
+        settings), reading each of its files only once for all of them, and return a dictionary
+        of PackageInfo objects by package format.  Packages already in the package cache are
+        reused and new ones are added to it, so a deposit to an endpoint with one of the formats
+        (and the same packager args) which follows uses the package built here.  A packager
+        which can't be fed from the shared read (see packagers.Packager.writer) builds its
+        package on its own.
+
+        Arguments:
+        formats         -   a list of package formats, or a dictionary of package format to the
+                            packager args to use for it
+
+        Keyword Arguments:
+        packager_args   -   the packager args to use for every format in a list
+        """
+        if not isinstance(formats, dict):
+            formats = dict([(f, packager_args) for f in formats])
+
+        results = {}
+        with self.tracer.span("package_many", formats=len(formats)) as span:
+            # reuse what we can, and reserve somewhere to build the rest
+            use_cache = self._package_cache.policy.enabled
+            building = []
+            for package_format, args in formats.iteritems():
+                packager = packagers.PackagerFactory.load_packager(package_format)
+                package_dir = self._package_dir(package_format)
+                subdir, key = None, None
+                if use_cache:
+                    subdir = os.path.basename(package_dir)
+                    key = self._package_key(package_format, args)
+                    package_info = self._package_cache.get(subdir, key)
+                    self.metrics.increment("dip_package_cache_requests_total", result="hit" if package_info is not None else "miss")
+                    if package_info is not None:
+                        results[package_format] = package_info
+                        continue
+                    package_dir = self._package_cache.reserve(subdir, key)
+                building.append((package_format, packager, args, package_dir, subdir, key))
+            span.set_attribute("cache_hits", len(results))
+
+            try:
+                built = self._build_packages(building)
+            except:
+                for package_format, packager, args, package_dir, subdir, key in building:
+                    if key is not None:
+                        self._package_cache.discard(package_dir)
+                raise
+
+            for (package_format, packager, args, package_dir, subdir, key), package_info in zip(building, built):
+                if key is not None:
+                    package_info = self._package_cache.commit(subdir, key, package_dir, package_info, evict=False)
+                results[package_format] = package_info
+            if use_cache:
+                self._package_cache.evict(keep=[i.package_dir for i in results.values() if i is not None])
+        return results
+
+    def _build_packages(self, building):
+        # build the packages for package_many, all those which have writers from one read
+        # of each file, returning their PackageInfos in the same order
+        writers = []
+        for package_format, packager, args, package_dir, subdir, key in building:
+            writers.append(packager.writer(self, package_dir, **args))
+
+        built = [None] * len(building)
+        shared = [i for i in range(len(building)) if writers[i] is not None]
+        if len(shared) > 0:
+            start = time.time()
+            with self._profiling("package"):
+                infos = packagers.write_packages(self, [writers[i] for i in shared])
+            elapsed = time.time() - start
+            for i, package_info in zip(shared, infos):
+                package_format, package_dir = building[i][0], building[i][3]
+                self.metrics.observe("dip_package_seconds", elapsed, format=package_format)
+                if package_info is not None:
+                    package_info.package_dir = package_dir
+                    if os.path.isfile(package_info.path):
+                        self.metrics.observe("dip_package_bytes", os.path.getsize(package_info.path), format=package_format)
+                built[i] = package_info
+
+        for i in range(len(building)):
+            if writers[i] is None:
+                package_format, packager, args, package_dir = building[i][:4]
+                built[i] = self._build_package(packager, package_dir, None, package_format, args)
+        return built
+
+    def _build_package(self, packager, package_dir, endpoint_id, label, packager_args):
+        with self._profiling("package", endpoint_id), self.metrics.timer("dip_package_seconds", format=label):
+            package_info = packager.package(self, package_dir, **packager_args)
+        if package_info is not None:
+            package_info.package_dir = package_dir
+            if os.path.isfile(package_info.path):
+                self.metrics.observe("dip_package_bytes", os.path.getsize(package_info.path), format=label)
+        return package_info
+    
+    def _package_key(self, package_format, packager_args):
+        # the key of a package in the cache: a hash of everything which goes into it
+        import hashlib
+        files = []
+        for f in self.get_files():
+            st = os.stat(f.path)
+            files.append([f.raw.get("path"), f.md5, st.st_size, st.st_mtime])
+        metadata_files = []
+        for m in self.get_metadata_files():
+            st = os.stat(m.path)
+            metadata_files.append([m.format, m.raw.get("path"), m.include_root, st.st_size, st.st_mtime])
+        content = json.dumps([package_format, packager_args, sorted(files), sorted(metadata_files)],
+                             sort_keys=True, default=str)
+        return hashlib.sha1(content).hexdigest()
+    
+    def set_package_cache_policy(self, enabled=None, max_packages=None, max_bytes=None, max_age_days=None):
+        """
+        Set the policy for reusing and evicting packages.  Arguments left as None are
+        not changed.
+        
+        Keyword Arguments:
+        enabled         -   whether to reuse packages built from the same content
+        max_packages    -   keep at most N packages
+        max_bytes       -   keep at most this many bytes of packages
+        max_age_days    -   remove packages which haven't been used in N days
+        """
+        policy = self.deposit_info_raw.get("package_cache", {})
+        settings = {"enabled" : enabled, "max_packages" : max_packages, "max_bytes" : max_bytes,
+                    "max_age_days" : max_age_days}
+        for k, v in settings.iteritems():
+            if v is not None:
+                policy[k] = v
+        self.deposit_info_raw["package_cache"] = policy
+        self._save_deposit_info()
+        
+        self._package_cache.policy = self.get_package_cache_policy()
+        self._package_cache.evict()
+    
+    def get_package_cache_policy(self):
+        """
+        Get the PackageCachePolicy of the DIP
+        """
+        return cache.PackageCachePolicy(dict(self.deposit_info_raw.get("package_cache", {})))
+
+    def set_http_cache_policy(self, endpoint_id=None, enabled=None, ttl=None):
+        """
+        Set the policy for the cache of the responses to GETs (of deposit receipts and
+        statements) made of the endpoints, for the whole DIP or for a single endpoint.
+        Settings on an endpoint override those on the DIP.  Arguments left as None are
+        not changed.
+
+        Keyword Arguments:
+        endpoint_id -   the endpoint to set the policy for; if None, set the DIP's default policy
+        enabled     -   whether to keep responses at all
+        ttl         -   the seconds for which a response is used without asking the server
+                        whether it has changed (0 always asks, with a conditional GET)
+        """
+        if endpoint_id is not None:
+            endpoint = self.get_endpoint(endpoint_id)
+            if endpoint is None:
+                raise InitialiseException("no such endpoint " + endpoint_id)
+            raw = endpoint.raw
+        else:
+            raw = self.deposit_info_raw
+
+        policy = raw.get("http_cache", {})
+        settings = {"enabled" : enabled, "ttl" : ttl}
+        for k, v in settings.iteritems():
+            if v is not None:
+                policy[k] = v
+        raw["http_cache"] = policy
+        self._save_deposit_info()
+
+    def get_http_cache_policy(self, endpoint_id=None):
+        """
+        Get the HttpCachePolicy which applies to the supplied endpoint_id, or the
+        DIP's default policy if no endpoint_id is given
+        """
+        raw = dict(self.deposit_info_raw.get("http_cache", {}))
+        if endpoint_id is not None:
+            endpoint = self.get_endpoint(endpoint_id)
+            if endpoint is not None:
+                raw.update(endpoint.raw.get("http_cache", {}))
+        return httpcache.HttpCachePolicy(raw)
 
     def package_cleanup(self, package_info, endpoint_id=None, package_format=None, packager=None, **packager_args):
         """
@@ -515,10 +1138,30 @@ class DIP(object):
             raise PackageException("unable to determine package format")
 
         # sort out the output directory so we can tell the packager where to cleanup
-        package_dir = self._package_dir(package_format)
-
-        packager.cleanup(self, package_dir, package_info, **packager_args)
-
+        package_dir = package_info.package_dir
+        if package_dir is None:
+            package_dir = self._package_dir(package_format)
+
+        with self.tracer.span("cleanup", format=package_format):
+            packager.cleanup(self, package_dir, package_info, **packager_args)
+        
+        # if the packager took the package away, it can't be reused
+        if not os.path.isfile(package_info.path):
+            self._package_cache.remove(package_info)
+
+    @contextlib.contextmanager
+    def _profiling(self, operation, endpoint_id=None):
+        # profile the operation if we have been asked to, writing the results next to
+        # the endpoint's history.  A ProfileRun is yielded either way
+        if self._profiler is None:
+            yield profiling.ProfileRun(operation, None)
+            return
+        out_dir = os.path.join(self.base_dir, "history")
+        if endpoint_id is not None:
+            out_dir = os.path.join(out_dir, endpoint_id)
+        with self._profiler.profile(out_dir, operation) as run:
+            yield run
+    
     def _package_dir(self, package_format):
         b64 = base64.encodestring(package_format).strip() # so that we can be sure it is an allowable directory name
         package_dir = os.path.join(self.base_dir, "packages", b64)
@@ -536,23 +1179,64 @@ class DIP(object):
         if endpoint.edit_iri is None:
             raise DepositException("Can't get statement from endpoint " + endpoint_id + " as it has never been deposited to")
 
+        with self.tracer.span("dip.get_repository_statement", endpoint_id=endpoint.id):
+            return self._get_repository_statement(endpoint, user_pass)
+    
+    def _get_repository_statement(self, endpoint, user_pass=None):
         # construct a new connection object around the Service Document identifier
-        conn = sword2.Connection(endpoint.sd_iri, user_name=endpoint.username, user_pass=user_pass, on_behalf_of=endpoint.obo)
+        conn = self._connection(endpoint, user_pass)
 
         # first thing is that we need the statement iri which we can get from the repo
-        dr = conn.get_deposit_receipt(endpoint.edit_iri)
+        with self.tracer.span("get_deposit_receipt", endpoint_id=endpoint.id):
+            dr = self._request("GET", conn.get_deposit_receipt, _utf8(endpoint.edit_iri))
 
         # now get the statement (try atom or fall back to ore)
         statement = None
-        if dr.atom_statement_iri is not None:
-            statement = conn.get_atom_sword_statement(dr.atom_statement_iri)
-        elif dr.ore_statement_iri is not None:
-            statement = conn.get_ore_sword_statement(dr.ore_statement_iri)
+        with self.tracer.span("get_statement", endpoint_id=endpoint.id):
+            if dr.atom_statement_iri is not None:
+                statement = conn.get_atom_sword_statement(dr.atom_statement_iri)
+            elif dr.ore_statement_iri is not None:
+                statement = conn.get_ore_sword_statement(dr.ore_statement_iri)
 
         return statement
-        
-    def get_packager(self, endpoint_id=None):
-        pass
+
+    def reconcile(self, endpoint_id, user_pass=None, checksum_elements=None):
+        """
+        Compare the files in the DIP, and their md5s, with the resources listed in the
+        statement from the specified endpoint's repository.  An endpoint which has never
+        been deposited to is missing every file.
+
+        The md5s are read from the statement's checksum_elements (default
+        reconcile.CHECKSUM_ELEMENTS, the sword:md5); files listed without one are
+        unverified, which is usual for repositories that don't send checksums.
+
+        Returns a reconcile.StatementDiff, whose delta_files are the files which need
+        depositing again
+        """
+        import reconcile
+        endpoint = self.get_endpoint(endpoint_id)
+        reconcile.refresh_records(self)
+        return self._reconcile(endpoint, user_pass, checksum_elements)
+
+    def _reconcile(self, endpoint, user_pass=None, checksum_elements=None):
+        # this doesn't change the DIP, so the Reconciler can run it for several
+        # endpoints at once, once it has refreshed the file records
+        import reconcile
+        with self.tracer.span("dip.reconcile", endpoint_id=endpoint.id):
+            statement = None
+            if endpoint.edit_iri is not None:
+                statement = self._get_repository_statement(endpoint, user_pass)
+            return reconcile.compare(self, endpoint.id, statement, checksum_elements)
+
+    def get_packager(self, endpoint_id=None, package_format=None):
+        """
+        Get the packager which would be used for the supplied endpoint or package format
+        """
+        if endpoint_id is not None:
+            package_format = self.get_endpoint(endpoint_id).package
+        if package_format is None:
+            raise PackageException("unable to determine package format")
+        return packagers.PackagerFactory.load_packager(package_format)
         
     def _default_deposit_info(self):
         n = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
@@ -572,8 +1256,8 @@ class DIP(object):
         }
     
     def _default_dc_xml(self):
-        metadata = etree.Element("metadata")
-        return metadata
+        # an empty dublin core document, exactly as lxml would serialise it
+        return "<?xml version='1.0' encoding='ASCII'?>\n<metadata/>"
     
     def _load_deposit_info(self):
         # get the path to the deposit.json file
@@ -593,62 +1277,140 @@ class DIP(object):
             self._deposit_info_raw = json.load(f)
     
     def _save_deposit_info(self):
-        with open(os.path.join(self.base_dir, "deposit.json"), "wb") as f:
-            out = json.dumps(self.deposit_info_raw, sort_keys=True, indent=2)
-            f.write(out)
+        if self._batch_depth > 0:
+            self._batch_dirty.add("deposit_info")
+            return
+        with self.metrics.timer("dip_deposit_info_save_seconds"):
+            with open(os.path.join(self.base_dir, "deposit.json"), "wb") as f:
+                out = json.dumps(self.deposit_info_raw, sort_keys=True, indent=2)
+                f.write(out)
             
     def _save_dc(self):
         # the path to the dcterms.xml file
         dcterms_file = os.path.join(self.base_dir, "metadata", "dcterms.xml")
         
+        # don't rely on the file's mtime alone to tell us that any cached entry is stale
+        dc_path = os.path.abspath(dcterms_file)
+        for include_root in [True, False]:
+            self._entry_cache.pop((dc_path, include_root), None)
+        
+        if self._batch_depth > 0:
+            self._batch_dirty.add("dc")
+            return
+        
         # wrap in an ElementTree document, and get it to handle writing it out
+        from lxml import etree
         tree = etree.ElementTree(element=self.dc_xml)
         tree.write(dcterms_file, xml_declaration=True, pretty_print=True, encoding="UTF-8")
             
+    def _history_store(self, endpoint_id):
+        store = self._history_stores.get(endpoint_id)
+        if store is None:
+            store = history.HistoryStore(os.path.join(self.base_dir, "history", endpoint_id),
+                                         policy=self.get_history_policy(endpoint_id))
+            # bring in any history kept in the files of earlier versions
+            migrated = store.import_legacy(remove=True)
+            if migrated > 0:
+                log.info("moved " + str(migrated) + " legacy history records for " + endpoint_id + " into the history store")
+            self._history_stores[endpoint_id] = store
+        return store
+    
+    def _record_history(self, record, body=None):
+        # append the CommsMeta record (and its body, if there is one) to the
+        # endpoint's history log, or queue it up to be if we are writing in
+        # the background
+        #
+        # the timestamp of the record is what the history is keyed on, so it goes
+        # on the trace too, so that the two can be matched up
+        timestamp = record.raw.get("timestamp")
+        self.tracer.set_trace_attributes(comms_timestamp=timestamp)
+        store = self._history_store(record.endpoint.id)
+        with self.tracer.span("history_save", endpoint_id=record.endpoint.id, type=record.type,
+                              comms_timestamp=timestamp) as span:
+            if self._history_writer is not None:
+                # the record is written after the span is over, so there is no byte count
+                span.set_attribute("background", True)
+                with self.metrics.timer("dip_history_write_seconds", mode="background"):
+                    self._history_writer.submit(store, record.raw, body)
+            else:
+                with self.metrics.timer("dip_history_write_seconds", mode="direct"):
+                    entry = store.append(record.raw, body)
+                span.set_attribute("bytes", entry["written"])
+    
+    def _request(self, method, call, *args, **kwargs):
+        # make a request of an endpoint with the supplied sword2 connection method,
+        # counting the response code, including for the errors sword2 raises
+        from sword2 import exceptions
+        try:
+            result = call(*args, **kwargs)
+        except exceptions.HTTPResponseError as e:
+            if e.response is not None:
+                self.metrics.increment("dip_http_responses_total", method=method, code=e.response.get("status"))
+                self.tracer.current().set_attribute("status_code", e.response.get("status"))
+            raise
+        if getattr(result, "code", None) is not None:
+            self.metrics.increment("dip_http_responses_total", method=method, code=result.code)
+            self.tracer.current().set_attribute("status_code", result.code)
+        return result
+    
+    def _upload(self, method, kind, size, call, **kwargs):
+        # as _request, for requests which send a deposit, whose duration and size we want too
+        self.metrics.increment("dip_upload_bytes_total", size, kind=kind)
+        with self.tracer.span("upload", method=method, kind=kind, bytes=size):
+            with self.metrics.timer("dip_upload_seconds", kind=kind, method=method):
+                return self._request(method, call, **kwargs)
+    
     def _guarantee_directory(self, dir_path):
         if os.path.exists(dir_path) and not os.path.isdir(dir_path):
             raise InitialiseException(dir_path + " exists, and does not resolve to a directory")
         elif not os.path.exists(dir_path):
             os.makedirs(dir_path) # FIXME: do we need to care about the mode?
             
-    def _load_dc(self):
+    def _init_dc(self):
         # the path to the dcterms.xml file
         dcterms_file = os.path.join(self.base_dir, "metadata", "dcterms.xml")
         
-        # make sure that the DC namespace is registered with ElementTree
-        etree.register_namespace("dcterms", "http://purl.org/dc/terms/")
-        
-        # first ensure that the dc exists
+        # ensure that the dc exists
         if os.path.exists(dcterms_file) and not os.path.isfile(dcterms_file):
             raise InitialiseException(dcterms_file + " exists, but does not resolve to a file")
         if not os.path.exists(dcterms_file):
-            xml = self._default_dc_xml()
-            tree = etree.ElementTree(element=xml)
-            tree.write(dcterms_file, xml_declaration=True)
+            with open(dcterms_file, "wb") as f:
+                f.write(self._default_dc_xml())
+    
+    def _load_dc(self):
+        from lxml import etree
+        
+        # the path to the dcterms.xml file
+        dcterms_file = os.path.join(self.base_dir, "metadata", "dcterms.xml")
+        
+        # make sure that the DC namespace is registered with ElementTree
+        etree.register_namespace("dcterms", "http://purl.org/dc/terms/")
         
-        # now read the dc in
+        # now read the dc in (it will be indexed when we first need it)
         with open(dcterms_file) as f:
             doc = etree.parse(f)
             self._dc_xml = doc.getroot()
+        self._dc_idx = None
     
     def _get_xml(self, xml_file):
+         from lxml import etree
          with open(xml_file) as f:
             doc = etree.parse(f)
          xml = doc.getroot()
          return xml
     
-    def _update_file_record(self, record):
+    def _update_file_record(self, record, checksum=None):
         path = _absolute_path(record['path'], self.base_dir)
-        with open(path) as f:
-            checksum = hashlib.md5(f.read()).hexdigest()
+        if checksum is None:
+            checksum = self._checksum(path)
         n = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
         record['md5'] = checksum
         record['updated'] = n
         self._save_deposit_info()
     
-    def _add_file_record(self, path):
-        with open(path, "r") as f:
-            checksum = hashlib.md5(f.read()).hexdigest()
+    def _add_file_record(self, path, checksum=None):
+        if checksum is None:
+            checksum = self._checksum(path)
         n = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
         record = {
             "path" : _normalise_path(path, self.base_dir),
@@ -659,17 +1421,35 @@ class DIP(object):
         self.deposit_info_raw['files'].append(record)
         self._save_deposit_info()
     
+    def _checksum(self, path):
+        start = time.time()
+        with open(path) as f:
+            data = f.read()
+        md5 = _new_md5()
+        md5.update(data)
+        checksum = md5.hexdigest()
+        self.metrics.observe("dip_hash_seconds", time.time() - start)
+        self.metrics.increment("dip_hash_bytes_total", len(data))
+        return checksum
+    
     def _metadata_to_endpoint(self, metadata_format, endpoint, timestamp):
         pass
     
-    def _deposit_metadata(self, endpoint, metadata_format="dcterms", user_pass=None, in_progress=False):
-        # get the xml metadata
-        mdf = self.get_metadata_file(metadata_format)
-        if not mdf.path.endswith(".xml"):
-            raise DepositException("can't do a metadata only deposit on a non-xml formatted metadata file")
+    def _metadata_entry(self, mdf):
+        # the serialised atom entry for a metadata-only deposit of the supplied
+        # metadata file; this is cached for as long as the file's fingerprint
+        # stays the same, so repeat deposits don't parse and serialise it again
+        st = os.stat(mdf.path)
+        fingerprint = (st.st_mtime, st.st_size, st.st_ino)
+        key = (mdf.path, mdf.include_root)
+        cached = self._entry_cache.get(key)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+        
         xml = self._get_xml(mdf.path)
         
         # create a new sword2 Entry document for deposit
+        import sword2
         e = sword2.Entry()
         
         # there are two options for metadata deposit:
@@ -681,13 +1461,49 @@ class DIP(object):
             for child in xml.getchildren():
                 e.entry.append(child)
         
+        serialised = str(e)
+        self._entry_cache[key] = (fingerprint, serialised)
+        return serialised
+    
+    def _connection(self, endpoint, user_pass, reporter=None):
+        # a connection to the endpoint, whose uploads report on their progress, and
+        # whose GETs go through the endpoint's HTTP cache
+        import sword2, transport
+        http_layer = self._http_layer if self._http_layer is not None else transport.DepositHttpLayer
+        layer = http_layer(reporter if reporter is not None else transport.ProgressReporter())
+        policy = self.get_http_cache_policy(endpoint.id)
+        if policy.enabled:
+            layer = httpcache.CachingHttpLayer(layer, self._http_cache(endpoint.id), ttl=policy.ttl, metrics=self.metrics)
+        return sword2.Connection(_utf8(endpoint.sd_iri), user_name=_utf8(endpoint.username), user_pass=user_pass,
+                                 on_behalf_of=_utf8(endpoint.obo), http_impl=layer)
+
+    def _http_cache(self, endpoint_id):
+        # one per endpoint, so that everything using the endpoint shares its lock
+        with self._http_caches_lock:
+            http_cache = self._http_caches.get(endpoint_id)
+            if http_cache is None:
+                http_cache = httpcache.ResponseCache(os.path.join(self.base_dir, "http_cache", endpoint_id))
+                self._http_caches[endpoint_id] = http_cache
+            return http_cache
+    
+    def _deposit_metadata(self, endpoint, metadata_format="dcterms", user_pass=None, in_progress=False, progress=None):
+        # get the xml metadata
+        mdf = self.get_metadata_file(metadata_format)
+        if not mdf.path.endswith(".xml"):
+            raise DepositException("can't do a metadata only deposit on a non-xml formatted metadata file")
+        
+        # get the (possibly cached) serialised sword2 Entry document for deposit
+        e = _SerialisedEntry(self._metadata_entry(mdf))
+        
         # set up a request record object
         request_record = CommsMeta(self, endpoint, type="request", username=endpoint.username)
         if endpoint.obo is not None:
             request_record.headers['On-Behalf-Of'] = endpoint.obo
         
         # construct a new connection object around the Service Document identifier
-        conn = sword2.Connection(endpoint.sd_iri, user_name=endpoint.username, user_pass=user_pass, on_behalf_of=endpoint.obo)
+        import transport
+        reporter = transport.ProgressReporter(progress)
+        conn = self._connection(endpoint, user_pass, reporter)
         
         # now determine if we are going to do a create or an update
         if endpoint.edit_iri is not None:
@@ -698,26 +1514,25 @@ class DIP(object):
             request_record.method = "PUT"
             request_record.headers['In-Progress'] = str(in_progress)
             
-            # store the body file
-            request_record.write_body_file(str(e))
-            
-            # save the request
-            request_record.save()
+            # save the request, along with its body
+            self._record_history(request_record, e.xml)
             
             # do the update
-            receipt = conn.update(metadata_entry=e, edit_iri=endpoint.edit_iri, in_progress=in_progress)
+            receipt = self._upload("PUT", "metadata", len(e.xml), conn.update,
+                                   metadata_entry=e, edit_iri=_utf8(endpoint.edit_iri), in_progress=in_progress)
+            reporter.done()
             
             # record the deposit
-            mdf.mark_deposited(endpoint.id, request_record.timestamp)
+            with self.tracer.span("mark_deposited", endpoint_id=endpoint.id, file_count=1):
+                mdf.mark_deposited(endpoint.id, request_record.timestamp)
             
             # create a new CommsMeta with the results
             response_record = CommsMeta(self, endpoint, 
                                     timestamp=request_record.timestamp, type="response", 
-                                    method="PUT", request_url=endpoint.edit_iri, response_code=receipt.code)
+                                    method="PUT", request_url=endpoint.edit_iri, response_code=receipt.code,
+                                    throughput=reporter.throughput())
             
-            if receipt.dom is not None:
-                response_record.write_body_file(etree.tostring(receipt.dom))
-            response_record.save()
+            self._record_history(response_record, receipt.dom)
             
             return response_record, receipt
         else:
@@ -728,32 +1543,47 @@ class DIP(object):
             request_record.method = "POST"
             request_record.headers['In-Progress'] = str(in_progress)
             
-            # store the body file
-            request_record.write_body_file(str(e))
-            
-            # save the request
-            request_record.save()
+            # save the request, along with its body
+            self._record_history(request_record, e.xml)
             
             # do the deposit
-            receipt = conn.create(col_iri=endpoint.col_iri, metadata_entry=e, in_progress=in_progress)
+            receipt = self._upload("POST", "metadata", len(e.xml), conn.create,
+                                   col_iri=_utf8(endpoint.col_iri), metadata_entry=e, in_progress=in_progress)
+            reporter.done()
             
             # update the endpoint and other deposit info
             endpoint.edit_iri = receipt.location
-            mdf.mark_deposited(endpoint.id, request_record.timestamp)
-            self._save_deposit_info()
+            with self.tracer.span("mark_deposited", endpoint_id=endpoint.id, file_count=1):
+                mdf.mark_deposited(endpoint.id, request_record.timestamp)
+                self._save_deposit_info()
             
             # create a new CommsMeta with the results
             response_record = CommsMeta(self, endpoint, 
                                     timestamp=request_record.timestamp, type="response", 
-                                    method="POST", request_url=endpoint.col_iri, response_code=receipt.code)
-            if receipt.dom is not None:
-                response_record.write_body_file(etree.tostring(receipt.dom))
-            response_record.save()
+                                    method="POST", request_url=endpoint.col_iri, response_code=receipt.code,
+                                    throughput=reporter.throughput())
+            self._record_history(response_record, receipt.dom)
             
             return response_record, receipt
             
     
-    def _deposit_binary(self, endpoint, user_pass=None, in_progress=False, metadata_relevant=True, **packager_args):
+    def _mark_deposited(self, endpoint, package_info, timestamp):
+        # record that the files and metadata in the package have been deposited
+        with self.tracer.span("mark_deposited", endpoint_id=endpoint.id,
+                              file_count=len(package_info.file_paths) + len(package_info.metadata_formats)):
+            for p in package_info.file_paths:
+                deposit_file = self.get_file(p)
+                deposit_file.mark_deposited(endpoint.id, timestamp)
+            for f in package_info.metadata_formats:
+                metadata_file = self.get_metadata_file(f)
+                metadata_file.mark_deposited(endpoint.id, timestamp)
+            
+            self._save_deposit_info()
+    
+    def _deposit_binary(self, endpoint, user_pass=None, in_progress=False, metadata_relevant=True, progress=None, **packager_args):
+        import transport
+        reporter = transport.ProgressReporter(progress)
+        reporter.packaging()
         package_info = self.package(endpoint.id, **packager_args)
         
         # set up a request record object
@@ -763,46 +1593,44 @@ class DIP(object):
         request_record.headers["Packaging"] = endpoint.package
         
         # construct a new connection object around the Service Document identifier
-        conn = sword2.Connection(endpoint.sd_iri, user_name=endpoint.username, user_pass=user_pass, on_behalf_of=endpoint.obo)
+        conn = self._connection(endpoint, user_pass, reporter)
+
+        # sword2 needn't read the package for its md5 if the layer sends the file itself
+        skip_read = package_info.md5 is not None and getattr(conn.h, "sends_payload_files", False)
         
         # now determine if we are going to do a create or an update
         if endpoint.edit_iri is not None:
             # it's an update
             #
             # first thing is that we need the edit media iri which we can get from the repo
-            dr = conn.get_deposit_receipt(endpoint.edit_iri)
+            with self.tracer.span("get_deposit_receipt", endpoint_id=endpoint.id):
+                dr = self._request("GET", conn.get_deposit_receipt, _utf8(endpoint.edit_iri))
 
             request_record.request_url = dr.edit_media
             request_record.method = "PUT"
             request_record.headers["Metadata-Relevant"] = str(metadata_relevant)
 
             # save the request
-            request_record.save()
+            self._record_history(request_record)
 
             # do the update
-            with open(package_info.path) as payload:
-                receipt = conn.update(edit_media_iri=dr.edit_media, payload=payload,
-                                      filename=package_info.filename, mimetype=package_info.mimetype,
-                                      packaging=endpoint.package, metadata_relevant=metadata_relevant)
+            with transport.Payload(package_info.path, md5=package_info.md5, skip_read=skip_read) as payload:
+                receipt = self._upload("PUT", "binary", payload.size, conn.update,
+                                       edit_media_iri=dr.edit_media, payload=payload, md5sum=package_info.md5,
+                                       filename=package_info.filename, mimetype=package_info.mimetype,
+                                       packaging=_utf8(endpoint.package), metadata_relevant=metadata_relevant)
+            reporter.done()
 
             # mark which files and metadata got deposited
-            for p in package_info.file_paths:
-                deposit_file = self.get_file(p)
-                deposit_file.mark_deposited(endpoint.id, request_record.timestamp)
-            for f in package_info.metadata_formats:
-                metadata_file = self.get_metadata_file(f)
-                metadata_file.mark_deposited(endpoint.id, request_record.timestamp)
-
-            self._save_deposit_info()
+            self._mark_deposited(endpoint, package_info, request_record.timestamp)
 
             # create a new CommsMeta with the results
             response_record = CommsMeta(self, endpoint,
                                     timestamp=request_record.timestamp, type="response",
-                                    method="PUT", request_url=dr.edit_media, response_code=receipt.code)
+                                    method="PUT", request_url=dr.edit_media, response_code=receipt.code,
+                                    throughput=reporter.throughput())
 
-            if receipt.dom is not None:
-                response_record.write_body_file(etree.tostring(receipt.dom))
-            response_record.save()
+            self._record_history(response_record, receipt.dom)
 
             # let the packager clean up after itself
             self.package_cleanup(package_info, endpoint_id=endpoint.id, **packager_args)
@@ -817,34 +1645,28 @@ class DIP(object):
             request_record.headers['In-Progress'] = str(in_progress)
             
             # save the request
-            request_record.save()
+            self._record_history(request_record)
             
             # do the deposit
-            with open(package_info.path) as payload:
-                receipt = conn.create(col_iri=endpoint.col_iri, payload=payload, 
-                                        filename=package_info.filename, mimetype=package_info.mimetype,
-                                        packaging=endpoint.package, in_progress=in_progress)
+            with transport.Payload(package_info.path, md5=package_info.md5, skip_read=skip_read) as payload:
+                receipt = self._upload("POST", "binary", payload.size, conn.create,
+                                       col_iri=_utf8(endpoint.col_iri), payload=payload, md5sum=package_info.md5,
+                                       filename=package_info.filename, mimetype=package_info.mimetype,
+                                       packaging=_utf8(endpoint.package), in_progress=in_progress)
+            reporter.done()
             
             # update the endpoint and other deposit info
             endpoint.edit_iri = receipt.location
 
             # mark which files and metadata got deposited
-            for p in package_info.file_paths:
-                deposit_file = self.get_file(p)
-                deposit_file.mark_deposited(endpoint.id, request_record.timestamp)
-            for f in package_info.metadata_formats:
-                metadata_file = self.get_metadata_file(f)
-                metadata_file.mark_deposited(endpoint.id, request_record.timestamp)
-
-            self._save_deposit_info()
+            self._mark_deposited(endpoint, package_info, request_record.timestamp)
             
             # create a new CommsMeta with the results
             response_record = CommsMeta(self, endpoint, 
                                     timestamp=request_record.timestamp, type="response", 
-                                    method="POST", request_url=endpoint.col_iri, response_code=receipt.code)
-            if receipt.dom is not None:
-                response_record.write_body_file(etree.tostring(receipt.dom))
-            response_record.save()
+                                    method="POST", request_url=endpoint.col_iri, response_code=receipt.code,
+                                    throughput=reporter.throughput())
+            self._record_history(response_record, receipt.dom)
 
             # let the packager clean up after itself
             self.package_cleanup(package_info, endpoint_id=endpoint.id, **packager_args)
@@ -852,6 +1674,17 @@ class DIP(object):
             return response_record, receipt
         
             
+class _SerialisedEntry(object):
+    """
+    Stands in for a sword2.Entry whose XML has already been serialised; sword2
+    only ever asks the entry for its string form
+    """
+    def __init__(self, xml):
+        self.xml = xml
+    
+    def __str__(self):
+        return self.xml
+
 class InitialiseException(Exception):
     """
     Exception to be thrown if the initialisation of a DIP fails
@@ -879,7 +1712,7 @@ class PackageException(Exception):
     Exception to be thrown if a package operation fails
     """
     def __init__(self, message):
-        super(DepositException, self).__init__(self)
+        super(PackageException, self).__init__(self)
         self.message = message
     
     def __str__(self):
@@ -907,6 +1740,7 @@ class Endpoint(object):
                 self.raw['id'] = id
         
         if self.raw.get('id') is None:
+            import uuid
             self.raw['id'] = str(uuid.uuid4())
     
     @property
@@ -1083,7 +1917,8 @@ class MetadataFile(object):
     
     @property
     def updated(self):
-        dt = datetime.datetime.strptime(self.raw.get('updated'), "%Y-%m-%dT%H:%M:%SZ")
+        # metadata records are stamped as "modified" rather than "updated"
+        dt = datetime.datetime.strptime(self.raw.get('updated', self.raw.get('modified')), "%Y-%m-%dT%H:%M:%SZ")
         return dt
         
     @property
@@ -1179,13 +2014,43 @@ class DepositState(object):
                 s.append(state)
         return s
         
+class DepositHistory(object):
+    """
+    The communications with an endpoint, as recorded in the DIP's history log
+    """
+    def __init__(self, dip, endpoint, store, entries):
+        self.dip = dip
+        self.endpoint = endpoint
+        self._store = store
+        self._entries = entries
+    
+    @property
+    def entries(self):
+        return self._entries
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __iter__(self):
+        # records are only loaded from the log as they are asked for
+        for entry in self._entries:
+            yield self.get_record(entry)
+    
+    def get_record(self, entry):
+        """
+        Load the CommsMeta object for the supplied index entry
+        """
+        cm = CommsMeta(self.dip, self.endpoint, raw=self._store.read_record(entry))
+        cm._store = self._store
+        return cm
+    
 class CommsMeta(object):
     request = "request"
     response = "response"
 
     def __init__(self, dip, endpoint, meta_file=None, raw=None, body_file=None,
                     timestamp=None, type=None, method=None, request_url=None, response_code=None,
-                    username=None, auth_type=None, headers=None):
+                    username=None, auth_type=None, headers=None, throughput=None):
         """
         Construct a new CommsMeta object.
         
@@ -1211,6 +2076,8 @@ class CommsMeta(object):
         username    - username used for authentication (request only)
         auth_type   - HTTP authentication method used (request only)
         headers     - a dictionary of provided or received HTTP headers (for request or response)
+        throughput  - a dictionary of the bytes, seconds and bytes_per_second achieved in sending
+                        the request body (response only)
         """
         #if meta_file is None and raw is None:
         #    raise InitialiseException("Can't initialise a CommsMeta object without either a path to the meta file or the raw json")
@@ -1244,16 +2111,24 @@ class CommsMeta(object):
         if username is not None: self.username = username
         if auth_type is not None: self.auth_type = auth_type
         if headers is not None: self.headers = headers
+        if throughput is not None: self.throughput = throughput
     
         # if we are not given a meta file, designate a path for it
         if meta_file is None:
             ts, self.meta_file = self._meta_file_init()
-            if timestamp is None: self.timestamp = ts
+            if timestamp is None and self._raw.get('timestamp') is None: self.timestamp = ts
         else:
             self.meta_file = meta_file
         
         # record the location of the body file (which might still be None)
         self._body_file = body_file
+        
+        # the history store this record was loaded from, if any
+        self._store = None
+    
+    @property
+    def raw(self):
+        return self._raw
     
     @property
     def timestamp(self):
@@ -1319,6 +2194,14 @@ class CommsMeta(object):
     def auth_type(self, value):
         self._raw['auth_type'] = value
     
+    @property
+    def throughput(self):
+        return self._raw.get("throughput")
+    
+    @throughput.setter
+    def throughput(self, value):
+        self._raw['throughput'] = value
+    
     @property
     def headers(self):
         if not self._raw.has_key('headers'):
@@ -1335,12 +2218,28 @@ class CommsMeta(object):
             self._body_file = self._body_file_init()
         return self._body_file
     
+    def read_body(self):
+        """
+        Read the body of this communication from the history store, or from the
+        body file, returning None if there is no body
+        """
+        if self._store is not None:
+            return self._store.read_body(self._raw)
+        if self._body_file is not None and os.path.isfile(self._body_file):
+            with open(self._body_file, "rb") as bf:
+                return bf.read()
+        return None
+    
     def write_body_file(self, body):
+        """
+        Write the body of this communication to the body file.  The body may be a
+        string, a file-like object or an lxml element, and is streamed to disk
+        """
         hdir = self._history_dir()
         if not os.path.exists(hdir):
             os.mkdir(hdir)
         with open(self.body_file, "wb") as bf:
-            bf.write(body)
+            history.write_body(bf, body)
     
     def save(self):
         parent = os.path.dirname(self.meta_file)
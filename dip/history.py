@@ -0,0 +1,764 @@
+########################################################
+## Segmented, append-only history store
+########################################################
+#
+# Each endpoint's history lives in history/<endpoint_id>/ as a small
+# number of files rather than one meta json and one body xml per
+# request and response:
+#
+# index.jsonl           - one line per record: timestamp, type, method,
+#                         response code and the location of the record
+#                         and of its body
+# segment-NNNNNN.jsonl  - the full CommsMeta records, one json document
+#                         per line
+# body-NNNNNN.dat       - the request/response bodies, appended back to
+#                         back and addressed by (segment, offset, length)
+#
+# Segments are rolled over once they exceed the configured size, so that
+# no single file grows without limit.  Queries are answered from the
+# index alone; segments are only opened to load the records asked for.
+#
+# History recorded by earlier versions, as a *_meta.json and *_body.xml file
+# per request and response, is moved into the store by import_legacy, which a
+# DIP does the first time it opens each endpoint's store.
+#
+# A HistoryPolicy controls how much of this is kept: compaction drops the
+# exchanges which fall outside the retention window, compresses the older
+# bodies and stores identical bodies only once.
+
+import os, json, datetime, glob, threading, zlib, copy, atexit, weakref, logging, Queue
+
+log = logging.getLogger(__name__)
+
+INDEX_FILE = "index.jsonl"
+SEGMENT_PATTERN = "segment-%06d.jsonl"
+BODY_PATTERN = "body-%06d.dat"
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+IDENTITY = "identity"
+GZIP = "gzip"
+ZSTD = "zstd"
+
+TRUNCATE = "truncate"
+SUMMARISE = "summarise"
+
+CHUNK_SIZE = 64 * 1024
+
+class HistoryException(Exception):
+    """
+    Exception to be thrown if the history store cannot be read or written
+    """
+    def __init__(self, message):
+        super(HistoryException, self).__init__(self)
+        self.message = message
+
+    def __str__(self):
+        return repr(self.message)
+
+def _timestamp_string(value):
+    # timestamps are stored in a lexicographically sortable format, so we can
+    # compare strings rather than parsing every entry in the index
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return value.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return value
+
+def _compressor(encoding):
+    # returns an object with compress(data) and flush() for the supplied encoding,
+    # or None if the data is to be stored as it is
+    if encoding == GZIP:
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    if encoding == ZSTD:
+        return _zstd().ZstdCompressor().compressobj()
+    return None
+
+def _decompress(data, encoding):
+    if encoding == GZIP:
+        return zlib.decompress(data, 31)
+    if encoding == ZSTD:
+        return _zstd().ZstdDecompressor().decompress(data)
+    return data
+
+def write_body(out, body):
+    """
+    Stream the supplied body to the file-like object "out", without building
+    a complete copy of it in memory first.
+
+    The body may be a string, a file-like object (anything with a read() method)
+    or an lxml element/element tree, which will be serialised straight to "out"
+    """
+    if isinstance(body, basestring):
+        out.write(body)
+    elif hasattr(body, "read"):
+        while True:
+            chunk = body.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            out.write(chunk)
+    elif hasattr(body, "getroottree") or hasattr(body, "getroot"):
+        # we only get here if we have been given an lxml object, so lxml is
+        # already loaded
+        from lxml import etree
+        tree = body if hasattr(body, "getroot") else etree.ElementTree(body)
+        tree.write(out)
+    else:
+        raise HistoryException("unable to write body of type " + str(type(body)))
+
+class _BodyWriter(object):
+    """
+    File-like wrapper which hashes, counts, caps and compresses a body as it is
+    written through to the underlying file
+    """
+    def __init__(self, f, max_size=None, encoding=IDENTITY):
+        import hashlib
+        self.f = f
+        self.max_size = max_size
+        self.encoding = encoding
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self.written = 0
+        self._compressor = _compressor(encoding)
+
+    @property
+    def truncated(self):
+        return self.max_size is not None and self.size > self.max_size
+
+    def write(self, data):
+        self.sha1.update(data)
+        start = self.size
+        self.size += len(data)
+        if self.max_size is not None:
+            if start >= self.max_size:
+                return
+            data = data[:self.max_size - start]
+        self._out(data)
+
+    def close(self):
+        if self._compressor is not None:
+            out = self._compressor.flush()
+            if out:
+                self.f.write(out)
+                self.written += len(out)
+
+    def _out(self, data):
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        if data:
+            self.f.write(data)
+            self.written += len(data)
+
+def _zstd():
+    # zstandard is an optional dependency, only needed if a policy asks for it
+    try:
+        import zstandard
+    except ImportError:
+        raise HistoryException("zstd compression requires the zstandard package to be installed")
+    return zstandard
+
+class HistoryPolicy(object):
+    """
+    Retention, compression and de-duplication settings for a history store
+
+    The raw dictionary may contain any of the following:
+
+    keep_last   - int - keep only the most recent N exchanges (a request and its response)
+    keep_days   - int - keep only the exchanges from the last N days
+    compress_after_days - int - compress bodies which are older than N days when compacting
+    compression - "gzip" or "zstd" - the compression to apply (default "gzip")
+    dedupe      - True/False - store identical bodies only once (default True)
+    body_compression - "gzip" or "zstd" - compress bodies as they are written (default no compression)
+    max_body_size - int - the largest body, in bytes, to keep in full (default no limit)
+    oversize    - "truncate" or "summarise" - what to do with bodies larger than max_body_size: keep
+                    the first max_body_size bytes, or keep only their size and sha1 (default "truncate")
+    """
+    def __init__(self, raw=None):
+        self.raw = raw if raw is not None else {}
+
+    @property
+    def keep_last(self):
+        return self.raw.get("keep_last")
+
+    @property
+    def keep_days(self):
+        return self.raw.get("keep_days")
+
+    @property
+    def compress_after_days(self):
+        return self.raw.get("compress_after_days")
+
+    @property
+    def compression(self):
+        return self.raw.get("compression", GZIP)
+
+    @property
+    def dedupe(self):
+        return self.raw.get("dedupe", True)
+
+    @property
+    def body_compression(self):
+        return self.raw.get("body_compression", IDENTITY)
+
+    @property
+    def max_body_size(self):
+        return self.raw.get("max_body_size")
+
+    @property
+    def oversize(self):
+        return self.raw.get("oversize", TRUNCATE)
+
+class HistoryStore(object):
+    """
+    Append-only store of CommsMeta records and their bodies for a single endpoint
+    """
+    def __init__(self, history_dir, segment_size=DEFAULT_SEGMENT_SIZE, fsync=False, policy=None):
+        """
+        Construct a new HistoryStore around the supplied directory, which will be
+        created if it does not already exist.
+
+        Arguments:
+        history_dir     - the directory in which to keep the index and segment files
+
+        Keyword Arguments:
+        segment_size    - size in bytes beyond which a new segment file is started
+        fsync           - whether to fsync the segments and the index after every append
+        policy          - a HistoryPolicy governing retention, compression and de-duplication
+        """
+        self.history_dir = history_dir
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.policy = policy if policy is not None else HistoryPolicy()
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+
+        # the parsed index, how far into the index file we have read it, and
+        # the bodies already stored, by sha1
+        self._entries = []
+        self._index_pos = 0
+        self._index_ino = None
+        self._bodies = {}
+
+        # appends must not go into any segment at or below this one (used to
+        # keep new records apart from the output of a running compaction)
+        self._segment_floor = 1
+
+        # appends must not share a body in any segment below this one, since a
+        # running compaction will remove those segments
+        self._dedupe_floor = 1
+
+    @property
+    def index_file(self):
+        return os.path.join(self.history_dir, INDEX_FILE)
+
+    def append(self, raw, body=None):
+        """
+        Append a record (the raw dictionary from a CommsMeta object) to the store,
+        along with its optional body.  The body may be a string, a file-like object
+        or an lxml element, and is streamed into the store subject to the policy's
+        max_body_size and body_compression.
+
+        Returns the index entry for the new record, with the number of bytes the
+        append wrote to the store (its body, if it wasn't already stored, its record
+        and its index line) under "written"
+        """
+        with self._lock:
+            self._guarantee_directory()
+            self._refresh()
+
+            segment = self._current_segment()
+            record = dict(raw)
+            written = 0
+            if body is not None:
+                record["body"], written = self._stream_body(segment, body)
+
+            entry = self._append_record(segment, record)
+            written += entry["length"] + self._append_index(entry)
+            return dict(entry, written=written)
+
+    def entries(self, since=None, until=None, method=None, type=None):
+        """
+        Get the index entries which match the parameters provided.  Leaving a keyword
+        set to None is a wildcard which will match anything.
+
+        Keyword Arguments:
+        since   - only entries with a timestamp at or after this datetime (or timestamp string)
+        until   - only entries with a timestamp at or before this datetime (or timestamp string)
+        method  - only entries with this HTTP method
+        type    - only entries of this type ("request" or "response")
+
+        Returns a list of index entries in the order in which they were appended
+        """
+        since = _timestamp_string(since)
+        until = _timestamp_string(until)
+        with self._lock:
+            self._refresh()
+            entries = list(self._entries)
+
+        matches = []
+        for e in entries:
+            ts = e.get("timestamp")
+            if since is not None and (ts is None or ts < since):
+                continue
+            if until is not None and (ts is None or ts > until):
+                continue
+            if method is not None and e.get("method") != method:
+                continue
+            if type is not None and e.get("type") != type:
+                continue
+            matches.append(e)
+        return matches
+
+    def read_record(self, entry):
+        """
+        Load the full raw record referred to by the supplied index entry
+        """
+        seg_path = os.path.join(self.history_dir, SEGMENT_PATTERN % entry["segment"])
+        with open(seg_path, "rb") as f:
+            f.seek(entry["offset"])
+            line = f.read(entry["length"])
+        return json.loads(line)
+
+    def read_body(self, record):
+        """
+        Load the body string for the supplied raw record (or index entry), or None
+        if it has no body
+        """
+        pointer = record.get("body")
+        if pointer is None or pointer.get("summary", False):
+            return None
+        return _decompress(self._read_body_data(pointer), pointer.get("encoding", IDENTITY))
+
+    def rebuild_index(self):
+        """
+        Rebuild the index from the segment files, for example if it has been lost
+        or damaged
+        """
+        with self._lock:
+            entries = []
+            for segment in self._segments():
+                seg_path = os.path.join(self.history_dir, SEGMENT_PATTERN % segment)
+                with open(seg_path, "rb") as f:
+                    offset = 0
+                    for line in f:
+                        if not line.endswith("\n"):
+                            # a partially written final record; ignore it
+                            break
+                        record = json.loads(line)
+                        entries.append(self._index_entry(record, segment, offset, len(line)))
+                        offset += len(line)
+            self._replace_index(entries)
+
+    def compact(self, now=None):
+        """
+        Apply the store's policy to the records it holds: drop the exchanges which
+        fall outside the retention window, compress the bodies which are old enough
+        and store identical bodies only once.
+
+        The retained records are copied into a fresh segment, so appends may carry
+        on into the segments after it while the compaction runs (storing their own
+        copies of any bodies which are only in the segments being compacted); the
+        store is only locked while the compaction starts and while the new index is
+        swapped in.
+
+        Keyword Arguments:
+        now     - the datetime against which the policy's ages are measured (defaults to now)
+
+        Returns a dictionary with the number of records and bytes before and after
+        """
+        if now is None:
+            now = datetime.datetime.now()
+
+        with self._compact_lock:
+            # take a snapshot of the index, and move appends on past the segment
+            # which the compaction will write to
+            with self._lock:
+                self._refresh()
+                snapshot = list(self._entries)
+                old_segments = self._segments()
+                if len(snapshot) == 0:
+                    return {"records_before" : 0, "records_after" : 0, "bytes_before" : 0, "bytes_after" : 0}
+                target = max(old_segments + [self._segment_floor]) + 1
+                self._segment_floor = target + 1
+                self._dedupe_floor = target
+            bytes_before = self._segments_size(old_segments)
+
+            # the bodies which have already been copied, by sha1 and by old location
+            by_sha1 = {}
+            by_location = {}
+            compress_before = None
+            if self.policy.compress_after_days is not None:
+                compress_before = _timestamp_string(now - datetime.timedelta(days=self.policy.compress_after_days))
+
+            kept = []
+            for entry in self._retained(snapshot, now):
+                record = self.read_record(entry)
+                pointer = record.get("body")
+                if pointer is not None and not pointer.get("summary", False):
+                    location = (pointer["segment"], pointer["offset"])
+                    new_pointer = by_location.get(location)
+                    if new_pointer is None and self.policy.dedupe:
+                        new_pointer = by_sha1.get(pointer.get("sha1"))
+                    if new_pointer is None:
+                        encoding = pointer.get("encoding", IDENTITY)
+                        ts = record.get("timestamp")
+                        if encoding == IDENTITY and compress_before is not None and ts is not None and ts < compress_before:
+                            encoding = self.policy.compression
+                        new_pointer = self._copy_body(pointer, target, encoding)
+                        if new_pointer.get("sha1") is not None:
+                            by_sha1[new_pointer["sha1"]] = new_pointer
+                    by_location[location] = new_pointer
+                    record["body"] = new_pointer
+                kept.append(self._append_record(target, record))
+
+            # swap the new index in, carrying over anything appended in the meantime
+            with self._lock:
+                self._refresh()
+                self._replace_index(kept + self._entries[len(snapshot):])
+                for segment in old_segments:
+                    for pattern in [SEGMENT_PATTERN, BODY_PATTERN]:
+                        path = os.path.join(self.history_dir, pattern % segment)
+                        if os.path.isfile(path):
+                            os.unlink(path)
+
+            return {
+                "records_before" : len(snapshot),
+                "records_after" : len(kept),
+                "bytes_before" : bytes_before,
+                "bytes_after" : self._segments_size([target])
+            }
+
+    def import_legacy(self, remove=False):
+        """
+        Import any history recorded as individual *_meta.json and *_body.xml files
+        by earlier versions into the store.
+
+        Keyword Arguments:
+        remove  - delete the legacy files once they have been imported.  Each meta file
+                    is claimed (renamed) before it is imported, so that two processes
+                    importing at once don't both import it
+
+        Returns the number of records imported
+        """
+        count = 0
+        with self._lock:
+            for meta_file in sorted(glob.glob(os.path.join(self.history_dir, "*_meta.json"))):
+                name = meta_file
+                if remove:
+                    claimed = meta_file + ".importing"
+                    try:
+                        os.rename(meta_file, claimed)
+                    except OSError:
+                        continue    # someone else got to it first
+                    meta_file = claimed
+                with open(meta_file) as f:
+                    raw = json.loads(f.read())
+                body_file = self._legacy_body_file(name, raw)
+                if os.path.isfile(body_file):
+                    with open(body_file, "rb") as f:
+                        self.append(raw, f)
+                else:
+                    self.append(raw)
+                count += 1
+                if remove:
+                    os.unlink(meta_file)
+                    if os.path.isfile(body_file):
+                        os.unlink(body_file)
+        return count
+
+    def _legacy_body_file(self, meta_file, raw):
+        # the body was named for the record's timestamp, which isn't always the one in
+        # the name of its meta file (a response took its request's timestamp)
+        if raw.get("timestamp") is None:
+            return meta_file[:-len("_meta.json")] + "_body.xml"
+        type = raw.get("type") if raw.get("type") is not None else "unknown"
+        return os.path.join(self.history_dir, raw["timestamp"] + "_" + type + "_body.xml")
+
+    def _retained(self, entries, now):
+        # an exchange is a request and its response, which share a timestamp
+        exchanges = []
+        for e in entries:
+            if len(exchanges) == 0 or exchanges[-1] != e.get("timestamp"):
+                exchanges.append(e.get("timestamp"))
+        keep = set(exchanges)
+        if self.policy.keep_last is not None:
+            keep = set(exchanges[-self.policy.keep_last:]) if self.policy.keep_last > 0 else set()
+        if self.policy.keep_days is not None:
+            cutoff = _timestamp_string(now - datetime.timedelta(days=self.policy.keep_days))
+            keep = set([ts for ts in keep if ts is not None and ts >= cutoff])
+        return [e for e in entries if e.get("timestamp") in keep]
+
+    def _index_entry(self, record, segment, offset, length):
+        return {
+            "timestamp" : record.get("timestamp"),
+            "type" : record.get("type"),
+            "method" : record.get("method"),
+            "response_code" : record.get("response_code"),
+            "body" : record.get("body"),
+            "segment" : segment,
+            "offset" : offset,
+            "length" : length
+        }
+
+    def _append_record(self, segment, record):
+        line = json.dumps(record, sort_keys=True) + "\n"
+        seg_path = os.path.join(self.history_dir, SEGMENT_PATTERN % segment)
+        with open(seg_path, "ab") as f:
+            offset = f.tell()
+            f.write(line)
+            self._sync(f)
+        return self._index_entry(record, segment, offset, len(line))
+
+    def _stream_body(self, segment, body):
+        # stream the body onto the end of the segment's body file, and then work out
+        # whether we needed to keep it after all.  Returns the body's pointer and the
+        # number of bytes kept
+        policy = self.policy
+        body_path = os.path.join(self.history_dir, BODY_PATTERN % segment)
+        with open(body_path, "ab") as f:
+            offset = f.tell()
+            writer = _BodyWriter(f, policy.max_body_size, policy.body_compression)
+            write_body(writer, body)
+            writer.close()
+            sha1 = writer.sha1.hexdigest()
+
+            existing = self._bodies.get(sha1) if policy.dedupe else None
+            if existing is not None and existing["segment"] < self._dedupe_floor:
+                # it is in a segment which a compaction is about to remove
+                existing = None
+            if existing is not None:
+                # we already have this body, so throw away the copy we just wrote
+                f.truncate(offset)
+                return existing, 0
+
+            pointer = {"segment" : segment, "offset" : offset, "length" : writer.written,
+                       "sha1" : sha1, "encoding" : policy.body_compression}
+            if writer.truncated:
+                pointer["original_length"] = writer.size
+                if policy.oversize == SUMMARISE:
+                    f.truncate(offset)
+                    pointer.update({"segment" : None, "offset" : None, "length" : 0, "summary" : True})
+                    if hasattr(body, "tag"):
+                        pointer["root"] = body.tag
+                else:
+                    pointer["truncated"] = True
+            self._sync(f)
+        return pointer, pointer["length"]
+
+    def _copy_body(self, pointer, segment, encoding):
+        # copy a body into the supplied segment in chunks, compressing it on the way
+        # if it is not already compressed
+        new_pointer = dict(pointer)
+        body_path = os.path.join(self.history_dir, BODY_PATTERN % segment)
+        with open(body_path, "ab") as out:
+            offset = out.tell()
+            compressor = _compressor(encoding) if pointer.get("encoding", IDENTITY) != encoding else None
+            written = 0
+            for chunk in self._read_body_chunks(pointer):
+                if compressor is not None:
+                    chunk = compressor.compress(chunk)
+                out.write(chunk)
+                written += len(chunk)
+            if compressor is not None:
+                chunk = compressor.flush()
+                out.write(chunk)
+                written += len(chunk)
+            self._sync(out)
+        new_pointer.update({"segment" : segment, "offset" : offset, "length" : written, "encoding" : encoding})
+        return new_pointer
+
+    def _read_body_chunks(self, pointer):
+        body_path = os.path.join(self.history_dir, BODY_PATTERN % pointer["segment"])
+        with open(body_path, "rb") as f:
+            f.seek(pointer["offset"])
+            remaining = pointer["length"]
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    def _read_body_data(self, pointer):
+        return "".join(self._read_body_chunks(pointer))
+
+    def _append_index(self, entry):
+        # returns the length of the index line
+        line = json.dumps(entry, sort_keys=True) + "\n"
+        with open(self.index_file, "ab") as f:
+            f.write(line)
+            self._sync(f)
+            self._index_pos = f.tell()
+        self._index_ino = os.stat(self.index_file).st_ino
+        self._add_entry(entry)
+        return len(line)
+
+    def _replace_index(self, entries):
+        tmp = self.index_file + ".tmp"
+        with open(tmp, "wb") as f:
+            for e in entries:
+                f.write(json.dumps(e, sort_keys=True) + "\n")
+            self._sync(f)
+        os.rename(tmp, self.index_file)
+
+        self._entries = []
+        self._bodies = {}
+        for e in entries:
+            self._add_entry(e)
+        self._index_pos = os.path.getsize(self.index_file)
+        self._index_ino = os.stat(self.index_file).st_ino
+
+    def _add_entry(self, entry):
+        self._entries.append(entry)
+        pointer = entry.get("body")
+        if pointer is not None and pointer.get("sha1") is not None:
+            self._bodies[pointer["sha1"]] = pointer
+
+    def _refresh(self):
+        # pick up any index lines appended since we last looked (e.g. by another
+        # process working on the same DIP)
+        if not os.path.isfile(self.index_file):
+            self._entries = []
+            self._bodies = {}
+            self._index_pos = 0
+            return
+        st = os.stat(self.index_file)
+        if st.st_ino != self._index_ino or st.st_size < self._index_pos:
+            # the index has been rewritten underneath us, so start again
+            self._entries = []
+            self._bodies = {}
+            self._index_pos = 0
+            self._index_ino = st.st_ino
+        if st.st_size == self._index_pos:
+            return
+        with open(self.index_file, "rb") as f:
+            f.seek(self._index_pos)
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                self._add_entry(json.loads(line))
+                self._index_pos += len(line)
+
+    def _segments(self):
+        segments = []
+        for path in glob.glob(os.path.join(self.history_dir, "segment-*.jsonl")):
+            name = os.path.basename(path)
+            segments.append(int(name[len("segment-"):-len(".jsonl")]))
+        return sorted(segments)
+
+    def _segments_size(self, segments):
+        size = 0
+        for segment in segments:
+            for pattern in [SEGMENT_PATTERN, BODY_PATTERN]:
+                path = os.path.join(self.history_dir, pattern % segment)
+                if os.path.isfile(path):
+                    size += os.path.getsize(path)
+        return size
+
+    def _current_segment(self):
+        segment = self._entries[-1]["segment"] if len(self._entries) > 0 else 1
+        segment = max(segment, self._segment_floor)
+        seg_path = os.path.join(self.history_dir, SEGMENT_PATTERN % segment)
+        body_path = os.path.join(self.history_dir, BODY_PATTERN % segment)
+        size = os.path.getsize(seg_path) if os.path.isfile(seg_path) else 0
+        size += os.path.getsize(body_path) if os.path.isfile(body_path) else 0
+        if size >= self.segment_size:
+            segment += 1
+        return segment
+
+    def _sync(self, f):
+        if self.fsync:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _guarantee_directory(self):
+        if not os.path.isdir(self.history_dir):
+            os.makedirs(self.history_dir)
+
+# the writers which haven't been closed, to be closed when the interpreter exits.
+# A writer drops out of this once it has been closed and let go of, so there is
+# only the one exit hook however many writers come and go
+_open_writers = weakref.WeakSet()
+
+def _close_open_writers():
+    for writer in list(_open_writers):
+        writer.close()
+
+atexit.register(_close_open_writers)
+
+class HistoryWriter(object):
+    """
+    Background thread which appends records to history stores from a bounded
+    queue, so that the caller does not wait on the disk
+    """
+    def __init__(self, queue_size=1000):
+        """
+        Construct and start a new HistoryWriter.  The thread runs until the writer
+        is closed; anything still queued when the interpreter exits is written out
+        before it goes.
+
+        Keyword Arguments:
+        queue_size  - the number of records which may be waiting to be written
+                        before submit() blocks
+        """
+        self._queue = Queue.Queue(maxsize=queue_size)
+        self._errors = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="dip-history-writer")
+        self._thread.daemon = True
+        self._thread.start()
+        _open_writers.add(self)
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def submit(self, store, raw, body=None):
+        """
+        Queue a record (and its optional body) to be appended to the supplied store.
+        This blocks only if the queue is full.
+        """
+        if self._closed:
+            raise HistoryException("history writer has been closed")
+        if hasattr(body, "getroottree") or hasattr(body, "getroot"):
+            # serialise an lxml body now, so the caller is free to carry on using it
+            # (lxml objects can't be shared between threads)
+            from lxml import etree
+            body = etree.tostring(body)
+        # take a copy, so the caller is free to carry on modifying its record
+        self._queue.put((store, copy.deepcopy(raw), body))
+
+    def flush(self):
+        """
+        Block until everything submitted so far has been written.  If any of the
+        writes failed, raise a HistoryException describing them
+        """
+        self._queue.join()
+        if len(self._errors) > 0:
+            errors = self._errors
+            self._errors = []
+            raise HistoryException("failed to write " + str(len(errors)) + " history record(s): " + str(errors[0]))
+
+    def close(self):
+        """
+        Write out everything still queued and stop the writer thread
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        _open_writers.discard(self)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                store, raw, body = item
+                store.append(raw, body)
+            except Exception as e:
+                log.error("unable to write history record: " + str(e))
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,206 @@
+########################################################
+## Conditional-GET cache for receipts and statements
+########################################################
+#
+# Reading the state of a deposit from a repository means fetching the deposit
+# receipt (for the statement's IRI) and then the statement, and an update deposit
+# fetches the receipt again (for the edit-media IRI).  These only change when
+# something is deposited, so each endpoint keeps the responses to its GETs in
+# http_cache/<endpoint id>/ in the DIP:
+#
+# - a response younger than the policy's ttl is used without asking the server
+# - an older one is revalidated, with If-None-Match and If-Modified-Since from its
+#   ETag and Last-Modified, and a 304 is answered from the cache
+# - a response with neither is only kept if there is a ttl, as it can't be
+#   revalidated
+#
+# Anything other than a GET made through the cache (a deposit, an update or a
+# delete) may change the container, so clears the endpoint's cache first.
+#
+# Each response is kept as <key>.json (its URL, status, headers and when it was
+# stored) and <key>.body, where the key is a hash of the URL and the Accept
+# header.  Both are written to temporary files and renamed into place, the body
+# first, so a reader never sees half of a response.  Reads, writes and clears
+# of a cache are serialised by its lock, and a clear renames the directory
+# aside before removing it, so that a writer in another process finds either
+# the old directory or none, never one being removed under it.
+
+import os, json, time, shutil, threading, logging
+
+log = logging.getLogger(__name__)
+
+class HttpCachePolicy(object):
+    """
+    Policy for an endpoint's HTTP cache, from the raw dictionary stored in
+    deposit.json.  Settings are:
+
+    enabled - True/False - keep responses at all (default True)
+    ttl     - number - seconds for which a response is used without revalidating it
+                (default 0, always revalidate)
+    """
+    def __init__(self, raw=None):
+        self.raw = raw if raw is not None else {}
+
+    @property
+    def enabled(self):
+        return self.raw.get("enabled", True)
+
+    @property
+    def ttl(self):
+        return self.raw.get("ttl", 0)
+
+class CachedResponse(dict):
+    """
+    A response answered from the cache, which sword2 can treat as it does the
+    responses of its own HTTP layers
+    """
+    def __init__(self, headers, status=200):
+        super(CachedResponse, self).__init__(headers)
+        self["status"] = status
+        self.status = status
+
+class ResponseCache(object):
+    """
+    The responses to an endpoint's GETs, kept on disk.  It may be shared between
+    threads
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+
+    def get(self, uri, accept=None):
+        """
+        Get the cached response to the uri, as a tuple of (metadata, content), or None
+        if there isn't one.  The metadata has the status, headers and stored time
+        """
+        key = _key(uri, accept)
+        try:
+            with self._lock:
+                with open(os.path.join(self.cache_dir, key + ".json"), "rb") as f:
+                    meta = json.loads(f.read())
+                with open(os.path.join(self.cache_dir, key + ".body"), "rb") as f:
+                    content = f.read()
+        except (IOError, ValueError):
+            return None
+        if meta.get("uri") != uri:
+            return None
+        return meta, content
+
+    def put(self, uri, accept, status, headers, content):
+        """
+        Keep the response to the uri, replacing any response already kept.  Keeping
+        it is best effort: if the cache is cleared by another process meanwhile, the
+        response is dropped
+        """
+        key = _key(uri, accept)
+        meta = {"uri" : uri, "accept" : accept, "status" : status, "headers" : headers, "stored" : time.time()}
+        with self._lock:
+            try:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                self._write(key + ".body", content)
+                self._write(key + ".json", json.dumps(meta))
+            except (IOError, OSError) as e:
+                log.warn("unable to cache the response from " + uri + ": " + str(e))
+
+    def clear(self):
+        with self._lock:
+            if not os.path.isdir(self.cache_dir):
+                return
+            aside = self.cache_dir + ".cleared." + str(os.getpid()) + "." + str(threading.current_thread().ident)
+            try:
+                os.rename(self.cache_dir, aside)
+            except OSError:
+                return  # someone else cleared it first
+            shutil.rmtree(aside, ignore_errors=True)
+
+    def _write(self, name, data):
+        import tempfile
+        fd, tmp = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=self.cache_dir)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp, os.path.join(self.cache_dir, name))
+
+class CachingHttpLayer(object):
+    """
+    A sword2 HTTP layer which answers GETs from a ResponseCache where it can, and
+    passes everything else on to another layer
+    """
+    def __init__(self, layer, cache, ttl=0, metrics=None):
+        """
+        Arguments:
+        layer   - the sword2 HTTP layer to make requests with
+        cache   - the ResponseCache to keep the responses in
+
+        Keyword Arguments:
+        ttl     - the seconds for which a response is used without revalidating it
+        metrics - a metrics.Metrics to count hits, revalidations and misses with
+        """
+        self.layer = layer
+        self.cache = cache
+        self.ttl = ttl
+        self.metrics = metrics
+
+    @property
+    def sends_payload_files(self):
+        return getattr(self.layer, "sends_payload_files", False)
+
+    def add_credentials(self, username, password):
+        self.layer.add_credentials(username, password)
+
+    def request(self, uri, method, headers=None, payload=None):
+        if method != "GET":
+            self.cache.clear()
+            return self.layer.request(uri, method, headers=headers, payload=payload)
+
+        headers = dict(headers) if headers is not None else {}
+        accept = _header(headers, "Accept")
+        cached = self.cache.get(uri, accept)
+        if cached is not None:
+            meta, content = cached
+            if time.time() - meta["stored"] < self.ttl:
+                self._count("hit")
+                return CachedResponse(meta["headers"], meta["status"]), content
+            etag = _header(meta["headers"], "ETag")
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            last_modified = _header(meta["headers"], "Last-Modified")
+            if last_modified is not None:
+                headers["If-Modified-Since"] = last_modified
+
+        resp, content = self.layer.request(uri, method, headers=headers, payload=payload)
+        status = int(resp.get("status"))
+        if status == 304 and cached is not None:
+            # still good: keep it for another ttl, with whatever validators came with the 304
+            meta, content = cached
+            response_headers = dict(meta["headers"])
+            for name in ["etag", "last-modified"]:
+                value = _header(resp, name)
+                if value is not None:
+                    response_headers[name] = value
+            self.cache.put(uri, accept, meta["status"], response_headers, content)
+            self._count("revalidated")
+            return CachedResponse(response_headers, meta["status"]), content
+
+        self._count("miss")
+        if status == 200:
+            response_headers = dict([(k.lower(), resp.get(k)) for k in resp.keys() if k.lower() != "status"])
+            if self.ttl > 0 or "etag" in response_headers or "last-modified" in response_headers:
+                self.cache.put(uri, accept, status, response_headers, content)
+        return resp, content
+
+    def _count(self, result):
+        if self.metrics is not None:
+            self.metrics.increment("dip_http_cache_requests_total", result=result)
+
+def _key(uri, accept):
+    import hashlib
+    return hashlib.sha1(uri + "\n" + (accept or "")).hexdigest()
+
+def _header(headers, name):
+    # headers from sword2 and httplib2 come in all cases
+    name = name.lower()
+    for k in headers.keys():
+        if k.lower() == name:
+            return headers.get(k)
+    return None
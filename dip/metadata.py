@@ -0,0 +1,157 @@
+########################################################
+## Metadata file handling and crosswalks
+########################################################
+#
+# Metadata files are copied into the DIP by streaming them through lxml's
+# iterparse, which checks that they are well formed (and optionally valid
+# against a schema) as they are written, without holding the whole document
+# in memory.
+#
+# Crosswalks between formats are done with XSLT.  Compiling a stylesheet is
+# far more expensive than applying it, so compiled stylesheets are cached for
+# the life of the process, keyed by their path and modification time.
+#
+# lxml is imported by the functions which use it, so that importing the dip
+# package does not pay for it.
+
+import os, re, threading
+
+CHUNK_SIZE = 64 * 1024
+
+class MetadataException(Exception):
+    """
+    Exception to be thrown if a metadata file cannot be read, validated or transformed
+    """
+    def __init__(self, message):
+        super(MetadataException, self).__init__(self)
+        self.message = message
+
+    def __str__(self):
+        return repr(self.message)
+
+# compiled stylesheets, by absolute path, as (mtime, etree.XSLT)
+_XSLT_CACHE = {}
+_XSLT_LOCK = threading.Lock()
+
+def load_stylesheet(path):
+    """
+    Get the compiled XSLT for the stylesheet at the supplied path, compiling it
+    only if it has not been seen before or has changed since it was compiled
+    """
+    from lxml import etree
+    path = os.path.abspath(path)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        raise MetadataException("no stylesheet at " + path)
+
+    with _XSLT_LOCK:
+        cached = _XSLT_CACHE.get(path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+    try:
+        xslt = etree.XSLT(etree.parse(path))
+    except (etree.XMLSyntaxError, etree.XSLTParseError) as e:
+        raise MetadataException("unable to compile stylesheet " + path + ": " + str(e))
+
+    with _XSLT_LOCK:
+        _XSLT_CACHE[path] = (mtime, xslt)
+    return xslt
+
+def load_schema(path):
+    """
+    Load an XML Schema (.xsd) or RelaxNG (.rng) schema from the supplied path
+    """
+    from lxml import etree
+    try:
+        doc = etree.parse(path)
+        if path.endswith(".rng"):
+            return etree.RelaxNG(doc)
+        return etree.XMLSchema(doc)
+    except (IOError, etree.XMLSyntaxError, etree.XMLSchemaParseError, etree.RelaxNGParseError) as e:
+        raise MetadataException("unable to load schema " + path + ": " + str(e))
+
+def metadata_filename(md_format):
+    """
+    A file name for metadata in the supplied format which is safe to use in the
+    DIP's metadata directory
+    """
+    safe = re.sub("[^A-Za-z0-9._-]", "_", md_format)
+    if safe != md_format:
+        # formats are often URIs, so distinguish ones which differ only in punctuation
+        import hashlib
+        safe += "-" + hashlib.md5(md_format).hexdigest()[:8]
+    return safe + ".xml"
+
+class _TeeReader(object):
+    # file-like object which copies everything read through it to another file
+    def __init__(self, source, dest):
+        self.source = source
+        self.dest = dest
+
+    def read(self, size=CHUNK_SIZE):
+        data = self.source.read(size)
+        self.dest.write(data)
+        return data
+
+def copy_validated(source, dest_path, schema=None):
+    """
+    Stream the XML from the file-like object "source" into the file at dest_path,
+    checking that it is well formed (and valid against the supplied lxml schema)
+    as it goes.  Memory use does not depend on the size of the document.
+
+    If the document is not acceptable, nothing is left at dest_path and a
+    MetadataException is raised.
+
+    Returns the tag of the document's root element
+    """
+    from lxml import etree
+    tmp = dest_path + ".tmp"
+    root_tag = None
+    try:
+        with open(tmp, "wb") as dest:
+            context = etree.iterparse(_TeeReader(source, dest), events=("start", "end"), schema=schema)
+            depth = 0
+            for event, element in context:
+                if event == "start":
+                    if root_tag is None:
+                        root_tag = element.tag
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth > 0:
+                    # we have finished with this element, so let it go, along
+                    # with any preceding siblings which are still hanging around
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+    except etree.XMLSyntaxError as e:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise MetadataException("metadata is not acceptable XML: " + str(e))
+    except:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    os.rename(tmp, dest_path)
+    return root_tag
+
+def transform(source, stylesheet, dest_path, **params):
+    """
+    Apply the XSLT stylesheet at the supplied path to the source XML (a path or
+    an lxml element tree), writing the result to dest_path.  Any keyword arguments
+    are passed to the stylesheet as string parameters.
+    """
+    from lxml import etree
+    xslt = load_stylesheet(stylesheet)
+    string_params = dict([(k, etree.XSLT.strparam(v)) for k, v in params.iteritems()])
+    if isinstance(source, basestring):
+        source = etree.parse(source)
+    try:
+        result = xslt(source, **string_params)
+    except etree.XSLTApplyError as e:
+        raise MetadataException("unable to apply stylesheet " + stylesheet + ": " + str(e))
+    if result.getroot() is None:
+        raise MetadataException("stylesheet " + stylesheet + " did not produce an XML document")
+    result.write(dest_path, xml_declaration=True, encoding="UTF-8")
@@ -0,0 +1,205 @@
+########################################################
+## Metrics
+########################################################
+#
+# A DIP reports what it is doing to its metrics object, as counters (which only
+# go up) and histograms (of durations and sizes), each of which may carry labels:
+#
+#     dip.metrics.increment("dip_hash_bytes_total", 1024)
+#     dip.metrics.observe("dip_package_seconds", 0.25, format="...SimpleZip")
+#
+# The default Metrics object throws all of this away, so instrumentation costs
+# next to nothing unless it is wanted.  CollectingMetrics keeps everything in
+# memory, and PrometheusTextfileMetrics writes it out for the node_exporter's
+# textfile collector:
+#
+#     d = DIP("path/to/dip", metrics=PrometheusTextfileMetrics("/var/lib/node_exporter/dip.prom"))
+#
+# To record something else, subclass Metrics and override increment and observe.
+
+import os, time, atexit, threading, contextlib
+
+# the metrics the DIP reports, as name -> (type, help)
+METRICS = {
+    "dip_hash_bytes_total" : ("counter", "Bytes of deposit files hashed"),
+    "dip_hash_seconds" : ("histogram", "Time taken to hash a deposit file"),
+    "dip_package_seconds" : ("histogram", "Time taken to build a package"),
+    "dip_package_bytes" : ("histogram", "Size of the packages built"),
+    "dip_package_cache_requests_total" : ("counter", "Packages asked for, by whether they were already in the cache"),
+    "dip_upload_seconds" : ("histogram", "Duration of deposit requests, from sending to receiving the receipt"),
+    "dip_upload_bytes_total" : ("counter", "Bytes sent in deposit requests"),
+    "dip_http_responses_total" : ("counter", "Responses from endpoints, by method and status code"),
+    "dip_deposit_info_save_seconds" : ("histogram", "Time taken to write deposit.json"),
+    "dip_history_write_seconds" : ("histogram", "Time taken to record a request or response in the history"),
+}
+
+# histogram buckets for durations, in seconds, and sizes, in bytes
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+BYTES_BUCKETS = [1024 * 4 ** i for i in range(13)]     # 1kB to 16GB
+
+class Metrics(object):
+    """
+    Metrics which go nowhere: the default for a DIP, and the base class for
+    anything which wants to record them
+    """
+    def increment(self, name, value=1, **labels):
+        """
+        Add value to the counter with the supplied name and labels
+        """
+        pass
+
+    def observe(self, name, value, **labels):
+        """
+        Record a value (e.g. a duration or a size) in the histogram with the supplied
+        name and labels
+        """
+        pass
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """
+        Observe the time taken by the body of a with statement, in seconds
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+class _Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+class CollectingMetrics(Metrics):
+    """
+    Metrics which are kept in memory, so that they can be inspected or exported
+    """
+    def __init__(self, buckets=None):
+        """
+        Keyword Arguments:
+        buckets -   a dictionary of histogram name to a list of bucket upper bounds, for
+                    any which should not use the defaults (names ending in _bytes use
+                    BYTES_BUCKETS, and all others SECONDS_BUCKETS)
+        """
+        self.buckets = buckets if buckets is not None else {}
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = _Histogram(self._buckets_for(name))
+                self.histograms[key] = histogram
+            histogram.observe(value)
+
+    def get_counter(self, name, **labels):
+        """
+        The current value of the counter with the supplied name and labels
+        """
+        with self._lock:
+            return self.counters.get((name, _label_key(labels)), 0)
+
+    def get_histogram(self, name, **labels):
+        """
+        The (count, sum) of the histogram with the supplied name and labels
+        """
+        with self._lock:
+            histogram = self.histograms.get((name, _label_key(labels)))
+            if histogram is None:
+                return 0, 0.0
+            return histogram.count, histogram.sum
+
+    def _buckets_for(self, name):
+        if name in self.buckets:
+            return self.buckets[name]
+        return BYTES_BUCKETS if name.endswith("_bytes") else SECONDS_BUCKETS
+
+    def prometheus_text(self):
+        """
+        All of the metrics, in the Prometheus text exposition format
+        """
+        with self._lock:
+            lines = []
+            names = sorted(set([n for n, l in self.counters.keys()] + [n for n, l in self.histograms.keys()]))
+            for name in names:
+                kind, description = METRICS.get(name, (None, None))
+                if description is not None:
+                    lines.append("# HELP " + name + " " + description)
+                if kind is None:
+                    kind = "histogram" if any([n == name for n, l in self.histograms.keys()]) else "counter"
+                lines.append("# TYPE " + name + " " + kind)
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(name + _format_labels(labels) + " " + _format_value(value))
+                for (n, labels), histogram in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(name + "_bucket" + _format_labels(labels + (("le", _format_value(bound)),)) +
+                                     " " + str(count))
+                    lines.append(name + "_bucket" + _format_labels(labels + (("le", "+Inf"),)) + " " + str(histogram.count))
+                    lines.append(name + "_sum" + _format_labels(labels) + " " + _format_value(histogram.sum))
+                    lines.append(name + "_count" + _format_labels(labels) + " " + str(histogram.count))
+            return "\n".join(lines) + "\n"
+
+class PrometheusTextfileMetrics(CollectingMetrics):
+    """
+    Collected metrics which are written to a file for the Prometheus node_exporter's
+    textfile collector.  The file is replaced atomically, so the collector never sees
+    half of it.  Each process should write to a file of its own.
+    """
+    def __init__(self, path, buckets=None, write_at_exit=True):
+        """
+        Arguments:
+        path            - the file to write (its name should end in .prom)
+
+        Keyword Arguments:
+        buckets         - as for CollectingMetrics
+        write_at_exit   - write the file when the process exits, so that short-lived
+                            processes don't need to remember to
+        """
+        super(PrometheusTextfileMetrics, self).__init__(buckets)
+        self.path = path
+        if write_at_exit:
+            atexit.register(self.write)
+
+    def write(self):
+        """
+        Write the current metrics to the file
+        """
+        tmp = self.path + ".tmp." + str(os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(self.prometheus_text())
+        os.rename(tmp, self.path)
+
+def _label_key(labels):
+    return tuple(sorted([(k, str(v)) for k, v in labels.iteritems()]))
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    escaped = [(k, v.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for k, v in labels]
+    return "{" + ",".join([k + "=\"" + v + "\"" for k, v in escaped]) + "}"
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
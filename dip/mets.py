@@ -0,0 +1,178 @@
+########################################################
+## METS (DSpace SIP) implementation
+########################################################
+#
+# Makes a zip of the DIP's files with a METS manifest, mets.xml, following the
+# DSpace METS SIP profile which DSpace's SWORD endpoints expect.
+#
+# mets.xml goes at the end of the zip, after the files, so that the CHECKSUM and
+# SIZE it gives each file are the md5 and size of the file as it was written into
+# the zip, even if the file has changed since it was recorded.  It is written a
+# piece at a time with lxml's xmlfile, so no element for more than one file is
+# ever in memory.  Only the dcterms metadata, which is embedded in the dmdSec, is
+# parsed as a whole; any other metadata files go in the zip ahead of the content
+# and are referenced from a dmdSec of their own.
+
+import os, datetime, mimetypes
+from packagers import Packager, PackageWriter, PackageInfo, PackagerException, HashingWriter, StreamingZipFile, \
+     write_zip_entry
+
+METS_DSPACE_SIP = "http://purl.org/net/sword/package/METSDSpaceSIP"
+
+METS_NS = "http://www.loc.gov/METS/"
+XLINK_NS = "http://www.w3.org/1999/xlink"
+DCTERMS_NS = "http://purl.org/dc/terms/"
+
+PROFILE = "DSpace METS SIP Profile 1.0"
+
+def _m(tag):
+    return "{" + METS_NS + "}" + tag
+
+class METSDSpaceSIPPackager(Packager):
+    """
+    Packager which makes a DSpace METS SIP out of the files in the dip
+
+    The packager args can be any of the following:
+
+    metadata_files - True/False - should the packager include the metadata (dcterms is embedded in
+                        mets.xml, any other formats are included as files)
+    deposit_files - True/False - should the packager include all of the dip's files
+    label - the LABEL of the METS document (default "DSpace Item")
+    remove_package - True/False - on completion of deposit, should the created package be removed
+
+    """
+    def writer(self, dip, out_dir, **packager_args):
+        do_md = packager_args.get("metadata_files", True)
+        do_files = packager_args.get("deposit_files", True)
+
+        # check that some packaging is going to be done
+        if not do_md and not do_files:
+            raise PackagerException("METSDSpaceSIPPackager must be instructed to deposit either metadata files, deposit files or both")
+
+        return METSDSpaceSIPWriter(dip, out_dir, packager_args.get("label", "DSpace Item"), do_md, do_files)
+
+    def cleanup(self, dip, package_dir, package_info, **packager_args):
+        remove_package = packager_args.get("remove_package", False)
+        if not remove_package:
+            return
+        if os.path.isfile(package_info.path):
+            os.unlink(package_info.path)
+
+class METSDSpaceSIPWriter(PackageWriter):
+    def __init__(self, dip, out_dir, label, metadata_files, deposit_files):
+        super(METSDSpaceSIPWriter, self).__init__(deposit_files)
+        self.dip = dip
+        self.out_zip = os.path.join(out_dir, "METSDSpaceSIP.zip")
+        self.mets_file = os.path.join(out_dir, "mets.xml")
+        self.label = label
+        self.metadata_files = dip.get_metadata_files() if metadata_files else []
+
+        # every file goes in the root of the zip, so their names must be unique
+        names = set(["mets.xml"])
+        for f in [mf for mf in self.metadata_files if mf.format != "dcterms"] + (dip.get_files() if deposit_files else []):
+            name = os.path.basename(f.path)
+            if name in names:
+                raise PackagerException("METSDSpaceSIPPackager can't include two files called " + name)
+            names.add(name)
+
+        # use these to record the objects that get packaged, and the (path, md5, size)
+        # of each file as it is written
+        self.file_paths = []
+        self.metadata_formats = [mf.format for mf in self.metadata_files]
+        self.files = []
+
+        self._file = None
+        self._entry = None
+        self._size = 0
+
+    def start(self):
+        # put the metadata at the start of the zip, ready for the files
+        self._file = open(self.out_zip, "wb")
+        self.out = HashingWriter(self._file)
+        self.z = StreamingZipFile(self.out)
+        for mf in self.metadata_files:
+            if mf.format != "dcterms":
+                write_zip_entry(self.z, mf.path, os.path.basename(mf.path))
+
+    def start_file(self, deposit_file, st):
+        self._entry = self.z.entry(os.path.basename(deposit_file.path), st)
+        self._size = 0
+        self.file_paths.append(deposit_file.path)
+
+    def write(self, data):
+        self._entry.write(data)
+        self._size += len(data)
+
+    def end_file(self, md5):
+        self._entry.close()
+        self.files.append((self.file_paths[-1], md5, self._size))
+
+    def finish(self):
+        # and the manifest of what went in, at the end
+        _write_mets(self.mets_file, self.metadata_files, self.files, self.label)
+        write_zip_entry(self.z, self.mets_file, "mets.xml")
+        os.unlink(self.mets_file)
+        self.z.close()
+        self._file.close()
+        return PackageInfo(self.out_zip, self.file_paths, self.metadata_formats, "METSDSpaceSIP.zip", "application/zip",
+                           md5=self.out.hexdigest())
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+        if os.path.isfile(self.mets_file):
+            os.unlink(self.mets_file)
+
+def _write_mets(mets_file, metadata_files, files, label):
+    # write mets.xml, for the (path, md5, size) of each file in the package
+    from lxml import etree
+    nsmap = {None : METS_NS, "xlink" : XLINK_NS, "dcterms" : DCTERMS_NS}
+    href = "{" + XLINK_NS + "}href"
+    now = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    dmd_ids = []
+    with etree.xmlfile(mets_file, encoding="utf-8") as xf:
+        xf.write_declaration()
+        with xf.element(_m("mets"), nsmap=nsmap, LABEL=label, PROFILE=PROFILE):
+            header = etree.Element(_m("metsHdr"), CREATEDATE=now)
+            agent = etree.SubElement(header, _m("agent"), ROLE="CUSTODIAN", TYPE="ORGANIZATION")
+            etree.SubElement(agent, _m("name")).text = "DIP"
+            xf.write(header)
+
+            # the metadata: dcterms is embedded, anything else is referenced
+            for mf in metadata_files:
+                dmd_id = "dmd_" + str(len(dmd_ids) + 1)
+                dmd_ids.append(dmd_id)
+                dmd = etree.Element(_m("dmdSec"), ID=dmd_id)
+                if mf.format == "dcterms":
+                    wrap = etree.SubElement(dmd, _m("mdWrap"), MDTYPE="DC", LABEL="dcterms")
+                    data = etree.SubElement(wrap, _m("xmlData"))
+                    for element in etree.parse(mf.path).getroot():
+                        if isinstance(element.tag, basestring):
+                            data.append(element)
+                else:
+                    etree.SubElement(dmd, _m("mdRef"), LOCTYPE="URL", MDTYPE="OTHER", OTHERMDTYPE=mf.format,
+                                     attrib={href : os.path.basename(mf.path)})
+                xf.write(dmd)
+
+            # one file element per deposit file
+            with xf.element(_m("fileSec")):
+                with xf.element(_m("fileGrp"), USE="CONTENT"):
+                    for i, (path, md5, size) in enumerate(files):
+                        name = os.path.basename(path)
+                        mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                        f = etree.Element(_m("file"), ID="file_" + str(i + 1), MIMETYPE=mimetype,
+                                          CHECKSUM=md5, CHECKSUMTYPE="MD5", SIZE=str(size))
+                        etree.SubElement(f, _m("FLocat"), LOCTYPE="URL", attrib={href : name})
+                        xf.write(f)
+
+            # and the structure, which ties the item's metadata to its files
+            with xf.element(_m("structMap"), ID="struct_1", LABEL="structure", TYPE="LOGICAL"):
+                attrs = {"ID" : "div_1", "TYPE" : "SWORD Object"}
+                if len(dmd_ids) > 0:
+                    attrs["DMDID"] = " ".join(dmd_ids)
+                with xf.element(_m("div"), attrib=attrs):
+                    for i in range(len(files)):
+                        div = etree.Element(_m("div"), ID="div_" + str(i + 2), TYPE="File")
+                        etree.SubElement(div, _m("fptr"), FILEID="file_" + str(i + 1))
+                        xf.write(div)
@@ -2,34 +2,462 @@
 ## Generic Packager classes
 ########################################################
 
+import os
+
 class PackagerException(Exception):
     pass
 
 class Packager(object):
     def package(self, dip, out_dir, **packager_args):
+        """
+        Package the dip into out_dir, returning a PackageInfo.  A packager which has a
+        writer needn't override this
+        """
+        writer = self.writer(dip, out_dir, **packager_args)
+        if writer is None:
+            return None
+        return write_packages(dip, [writer])[0]
+    def writer(self, dip, out_dir, **packager_args):
+        """
+        A PackageWriter which builds the package in out_dir from the bytes of the dip's
+        files as they are pushed to it, or None if the packager can't be fed that way
+        """
         return None
     def cleanup(self, dip, package_dir, package_info, **packager_args):
         pass
 
 class PackageInfo(object):
-    def __init__(self, path, file_paths, metadata_formats, filename, mimetype):
+    def __init__(self, path, file_paths, metadata_formats, filename, mimetype, md5=None):
         self.path = path
         self.file_paths = file_paths
         self.metadata_formats = metadata_formats
         self.filename = filename
         self.mimetype = mimetype
+        # the md5 of the package, if the packager worked it out as it wrote it
+        self.md5 = md5
+        # the directory the package was built in (set by the DIP)
+        self.package_dir = None
+
+class PackageWriter(object):
+    """
+    Builds a package from the bytes of the dip's files as they are pushed to it, one
+    file at a time, so that any number of packages can be built from a single read of
+    each file (see write_packages).
+
+    start is called first, then (if deposit_files is True) start_file, write (for each
+    chunk of the file) and end_file for each of the dip's files in turn, in the order
+    of dip.get_files(), and finally finish, which returns the PackageInfo.  If anything
+    goes wrong, abort is called instead of finish.  Metadata files are small, and each
+    writer reads those for itself.
+    """
+    def __init__(self, deposit_files=True):
+        self.deposit_files = deposit_files
+
+    def start(self):
+        pass
+
+    def start_file(self, deposit_file, st):
+        """
+        Arguments:
+        deposit_file    - the DepositFile of the file which is about to be pushed
+        st              - the os.stat of the file, taken before it was read
+        """
+        pass
+
+    def write(self, data):
+        pass
+
+    def end_file(self, md5):
+        """
+        Arguments:
+        md5 - the md5 of the file as it was pushed, which may not be the one in its record
+        """
+        pass
+
+    def finish(self):
+        return None
+
+    def abort(self):
+        pass
+
+def write_packages(dip, writers, chunk_size=1024 * 1024):
+    """
+    Build packages with the supplied PackageWriters, reading each of the dip's files
+    once and pushing each chunk to all of the writers.  Each file is hashed as it is
+    read, and its record updated if it has changed (see record_checksum).
+
+    Returns the PackageInfo from each writer, in the same order
+    """
+    import hashlib
+    feeding = [w for w in writers if w.deposit_files]
+    try:
+        for w in writers:
+            w.start()
+        if len(feeding) > 0:
+            with dip.batch():
+                for df in dip.get_files():
+                    if not os.path.isfile(df.path):
+                        raise PackagerException(df.path + " is in the DIP but no longer exists")
+                    st = os.stat(df.path)
+                    for w in feeding:
+                        w.start_file(df, st)
+                    md5 = hashlib.md5()
+                    size = 0
+                    with open(df.path, "rb") as f:
+                        while True:
+                            data = f.read(chunk_size)
+                            if not data:
+                                break
+                            size += len(data)
+                            md5.update(data)
+                            for w in feeding:
+                                w.write(data)
+                    # archive headers may have been written with the size already
+                    if size != st.st_size:
+                        raise PackagerException(df.path + " changed while it was being packaged")
+                    md5 = md5.hexdigest()
+                    for w in feeding:
+                        w.end_file(md5)
+                    record_checksum(dip, df, md5)
+        return [w.finish() for w in writers]
+    except:
+        for w in writers:
+            w.abort()
+        raise
+
+def current_record(deposit_file):
+    """
+    Check the DepositFile record of a file which is about to be packaged against the
+    file, by stat'ing it (the file isn't read).  Returns the record if the file hasn't
+    been modified since it was last hashed, so that a packager can trust its md5, or
+    None if it has, in which case the md5 worked out as the file is packaged brings
+    the record up to date (see record_checksum)
+    """
+    import datetime
+    if not os.path.isfile(deposit_file.path):
+        raise PackagerException(deposit_file.path + " is in the DIP but no longer exists")
+    # records are kept to the second
+    modified = datetime.datetime.fromtimestamp(int(os.path.getmtime(deposit_file.path)))
+    if modified > deposit_file.updated:
+        return None
+    return deposit_file
+
+def record_checksum(dip, deposit_file, md5):
+    """
+    Bring the DepositFile record of a file up to date with the md5 of the file as it
+    was packaged, which a packager worked out as it read the file.  A file which has
+    changed since it was recorded (or been modified since it was last hashed) has its
+    record updated, without being read again.
+
+    Returns True if the record's md5 was correct
+    """
+    import datetime
+    modified = datetime.datetime.fromtimestamp(int(os.path.getmtime(deposit_file.path)))
+    if md5 != deposit_file.md5 or modified > deposit_file.updated:
+        correct = md5 == deposit_file.md5
+        dip.set_file(deposit_file.path, md5=md5)
+        return correct
+    return True
+
+class HashingReader(object):
+    """
+    Works out the md5 of a file-like object as it is read
+    """
+    def __init__(self, f):
+        import hashlib
+        self.f = f
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.md5.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+class HashingWriter(object):
+    """
+    Works out the md5 of everything written through it to a file-like object, and
+    counts the bytes, so that it can tell() without the file having to be seekable
+    """
+    def __init__(self, f):
+        import hashlib
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.position = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.md5.update(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        self.f.flush()
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+# sizes and offsets beyond this need zip64 extensions (as zipfile has it)
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+class StreamingZipFile(object):
+    """
+    Writes a zip strictly in order, to a file-like object which need only have a
+    write method, so that the zip can be hashed (or streamed) as it is written.
+    zipfile.ZipFile seeks back to fill in each entry's CRC and sizes once it has been
+    written, so the local headers, data descriptors and central directory are
+    written here instead.
+
+    Entries whose data is known up front (writestr) are stored, with their CRC and
+    sizes in their header.  Entries whose data is pushed (entry, write_zip_entry) are
+    deflated, with their CRC and sizes in a data descriptor after their data (general
+    purpose flag bit 3): some readers, java.util.zip.ZipInputStream among them, can't
+    read a stored entry with a data descriptor, since they can't tell where its data
+    ends.  zip64 extensions are used where the sizes or offsets need them.
+    """
+    def __init__(self, out, compresslevel=6):
+        """
+        Arguments:
+        out             - the file-like object to write the zip to
+
+        Keyword Arguments:
+        compresslevel   - the zlib compression level of the deflated entries
+        """
+        self.out = out
+        self.compresslevel = compresslevel
+        self.offset = 0
+        self.entries = []
+        self.names = set()
+        self.closed = False
+
+    def writestr(self, arcname, data, mode=0100644, mtime=None):
+        """
+        Add an entry holding the string data
+        """
+        import zlib, time
+        entry = _ZipEntry(self._name(arcname), time.time() if mtime is None else mtime, mode, ZIP_STORED, self.offset)
+        entry.crc = zlib.crc32(data) & 0xffffffff
+        entry.file_size = entry.compress_size = len(data)
+        entry.zip64 = len(data) > ZIP64_LIMIT
+        self._write(entry.local_header())
+        self._write(data)
+        self.entries.append(entry)
+
+    def entry(self, arcname, st):
+        """
+        Start an entry for the file whose os.stat is st, returning a ZipEntryWriter to
+        push its data to
+        """
+        return ZipEntryWriter(self, arcname, st)
+
+    def close(self):
+        """
+        Write the central directory (the underlying file-like object is not closed)
+        """
+        import struct
+        if self.closed:
+            return
+        self.closed = True
+        start = self.offset
+        for entry in self.entries:
+            self._write(entry.central_header())
+        size = self.offset - start
+        count = len(self.entries)
+        if count > 0xFFFF or start > ZIP64_LIMIT or size > ZIP64_LIMIT:
+            end = self.offset
+            self._write(struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0, count, count, size, start))
+            self._write(struct.pack("<IIQI", 0x07064b50, 0, end, 1))
+            count, size, start = min(count, 0xFFFF), min(size, 0xFFFFFFFF), min(start, 0xFFFFFFFF)
+        self._write(struct.pack("<IHHHHIIH", 0x06054b50, 0, 0, count, count, size, start, 0))
+
+    def _name(self, arcname):
+        if arcname in self.names:
+            raise PackagerException("the zip already has an entry called " + arcname)
+        self.names.add(arcname)
+        return arcname
+
+    def _write(self, data):
+        self.out.write(data)
+        self.offset += len(data)
+
+class _ZipEntry(object):
+    # the header fields of an entry in a StreamingZipFile
+    def __init__(self, arcname, mtime, mode, compress_type, header_offset):
+        import time
+        if isinstance(arcname, unicode):
+            try:
+                self.filename, self.flag_bits = arcname.encode("ascii"), 0
+            except UnicodeEncodeError:
+                # bit 11: the name is UTF-8
+                self.filename, self.flag_bits = arcname.encode("utf-8"), 0x800
+        else:
+            self.filename, self.flag_bits = arcname, 0
+        t = time.localtime(mtime)
+        if t[0] < 1980:
+            t = (1980, 1, 1, 0, 0, 0)
+        self.dos_date = (t[0] - 1980) << 9 | t[1] << 5 | t[2]
+        self.dos_time = t[3] << 11 | t[4] << 5 | t[5] // 2
+        self.external_attr = (mode & 0xFFFF) << 16L
+        self.compress_type = compress_type
+        self.header_offset = header_offset
+        self.crc = self.file_size = self.compress_size = 0
+        self.zip64 = False
+
+    @property
+    def version(self):
+        return 45 if self.zip64 else 20
+
+    def local_header(self):
+        import struct
+        if self.zip64:
+            # the sizes are in the zip64 extra field
+            extra = struct.pack("<HHQQ", 1, 16, self.file_size, self.compress_size)
+            sizes = (0xFFFFFFFF, 0xFFFFFFFF)
+        else:
+            extra = ""
+            sizes = (self.compress_size, self.file_size)
+        return struct.pack("<IHHHHHIIIHH", 0x04034b50, self.version, self.flag_bits, self.compress_type,
+                           self.dos_time, self.dos_date, self.crc, sizes[0], sizes[1],
+                           len(self.filename), len(extra)) + self.filename + extra
+
+    def data_descriptor(self):
+        import struct
+        if self.zip64:
+            return struct.pack("<IIQQ", 0x08074b50, self.crc, self.compress_size, self.file_size)
+        return struct.pack("<IIII", 0x08074b50, self.crc, self.compress_size, self.file_size)
+
+    def central_header(self):
+        import struct
+        # anything too big for its field goes in the zip64 extra field, in this order
+        extra = []
+        file_size, compress_size, header_offset = self.file_size, self.compress_size, self.header_offset
+        if file_size > ZIP64_LIMIT:
+            extra.append(file_size)
+            file_size = 0xFFFFFFFF
+        if compress_size > ZIP64_LIMIT:
+            extra.append(compress_size)
+            compress_size = 0xFFFFFFFF
+        if header_offset > ZIP64_LIMIT:
+            extra.append(header_offset)
+            header_offset = 0xFFFFFFFF
+        extra = struct.pack("<HH" + "Q" * len(extra), 1, 8 * len(extra), *extra) if len(extra) > 0 else ""
+        version = 45 if self.zip64 or len(extra) > 0 else 20
+        return struct.pack("<IHHHHHHIIIHHHHHII", 0x02014b50, 3 << 8 | version, version, self.flag_bits,
+                           self.compress_type, self.dos_time, self.dos_date, self.crc, compress_size, file_size,
+                           len(self.filename), len(extra), 0, 0, 0, self.external_attr,
+                           header_offset) + self.filename + extra
+
+class ZipEntryWriter(object):
+    """
+    Writes a deflated entry to a StreamingZipFile from data pushed to it, with its
+    CRC and sizes in a data descriptor after the data
+    """
+    def __init__(self, z, arcname, st):
+        """
+        Arguments:
+        z       - the StreamingZipFile to write to
+        arcname - the name of the entry
+        st      - the os.stat of the file the data comes from
+        """
+        import zlib
+        self.zlib = zlib
+        self.z = z
+        entry = _ZipEntry(z._name(arcname), st.st_mtime, st.st_mode, ZIP_DEFLATED, z.offset)
+        entry.flag_bits |= 0x08
+        # an entry which will need zip64 sizes in its data descriptor has to say so in its header
+        entry.zip64 = st.st_size > ZIP64_LIMIT
+        z._write(entry.local_header())
+        self.entry = entry
+        self.compressor = zlib.compressobj(z.compresslevel, zlib.DEFLATED, -15)
+
+    def write(self, data):
+        entry = self.entry
+        entry.file_size += len(data)
+        entry.crc = self.zlib.crc32(data, entry.crc) & 0xffffffff
+        data = self.compressor.compress(data)
+        entry.compress_size += len(data)
+        self.z._write(data)
+
+    def close(self):
+        entry = self.entry
+        data = self.compressor.flush()
+        entry.compress_size += len(data)
+        self.z._write(data)
+        # the header was written without zip64 extensions, so the data descriptor can't have them either
+        if not entry.zip64 and (entry.file_size > ZIP64_LIMIT or entry.compress_size > ZIP64_LIMIT):
+            raise PackagerException(entry.filename + " grew too large to be written to a zip in order")
+        self.z._write(entry.data_descriptor())
+        self.z.entries.append(entry)
+
+def write_zip_entry(z, path, arcname, chunk_size=1024 * 1024):
+    """
+    Add the file at path to the StreamingZipFile z, with a ZipEntryWriter
+
+    Returns the md5 of the file
+    """
+    import hashlib
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        entry = z.entry(arcname, os.fstat(f.fileno()))
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            md5.update(data)
+            entry.write(data)
+        entry.close()
+    return md5.hexdigest()
+
+class TarEntryWriter(object):
+    """
+    Writes an entry to a tarfile.TarFile from data pushed to it (TarFile.addfile
+    wants a file to read the data from)
+    """
+    def __init__(self, t, arcname, st):
+        """
+        Arguments:
+        t       - the tarfile.TarFile to write to
+        arcname - the name of the entry
+        st      - the os.stat of the file the data comes from
+        """
+        import tarfile
+        self.tarfile = tarfile
+        self.t = t
+        self.info = tarfile.TarInfo(arcname)
+        self.info.size = st.st_size
+        self.info.mtime = int(st.st_mtime)
+        self.info.mode = st.st_mode & 07777
+        self.info.uid = st.st_uid
+        self.info.gid = st.st_gid
+        # the header; the data goes straight after it
+        t.addfile(self.info)
+
+    def write(self, data):
+        self.t.fileobj.write(data)
+
+    def close(self):
+        # pad the data to a whole number of blocks, as TarFile.addfile would
+        blocks, remainder = divmod(self.info.size, self.tarfile.BLOCKSIZE)
+        if remainder > 0:
+            self.t.fileobj.write(self.tarfile.NUL * (self.tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self.t.offset += blocks * self.tarfile.BLOCKSIZE
 
 ########################################################
 ## SimpleZip implementation
 ########################################################
-# Note we do the imports here rather than at the top 
-# just for the purposes of keeping all the dependencies
-# together
 
-import zipfile, os
 class SimpleZipPackager(Packager):
     """
-    Packager which makes a simple flat zip file out of the files in the dip
+    Packager which makes a simple flat zip file out of the files in the dip.  Each
+    file is hashed as it is written, and its record updated if it has changed, and
+    the zip is hashed as it is written too, so that it needn't be read to deposit it.
 
     The packager args can be any of the following:
 
@@ -38,7 +466,7 @@ class SimpleZipPackager(Packager):
     remove_zip - True/False - on completion of deposit, should the created package be removed
 
     """
-    def package(self, dip, out_dir, **packager_args):
+    def writer(self, dip, out_dir, **packager_args):
         # sort out the arguments/paths to use
         out_zip = os.path.join(out_dir, "SimpleZip.zip")
         do_md = packager_args.get("metadata_files", True)
@@ -48,24 +476,7 @@ class SimpleZipPackager(Packager):
         if not do_md and not do_files:
             raise PackagerException("SimpleZipPackager must be instructed to deposit either metadata files, deposit files or both")
 
-        # use these to record the objects that get packaged
-        file_paths = []
-        metadata_formats = []
-
-        # create the zip
-        with zipfile.ZipFile(out_zip, "w") as z:
-            if do_md:
-                metadata_files = dip.get_metadata_files()
-                for mf in metadata_files:
-                    metadata_formats.append(mf.format)
-                    z.write(mf.path, self._filename(mf.path))
-            if do_files:
-                deposit_files = dip.get_files()
-                for df in deposit_files:
-                    file_paths.append(df.path)
-                    z.write(df.path, self._filename(df.path))
-        
-        return PackageInfo(out_zip, file_paths, metadata_formats, "SimpleZip.zip", "application/zip")
+        return SimpleZipWriter(dip, out_zip, do_md, do_files)
 
     def cleanup(self, dip, package_dir, package_info, **packager_args):
         # sort out the arguments/paths to use
@@ -75,10 +486,49 @@ class SimpleZipPackager(Packager):
             return
         os.unlink(out_zip)
 
-    def _filename(self, path):
-        parts = os.path.split(path)
-        return parts[1]
-        
+class SimpleZipWriter(PackageWriter):
+    def __init__(self, dip, out_zip, metadata_files, deposit_files):
+        super(SimpleZipWriter, self).__init__(deposit_files)
+        self.dip = dip
+        self.out_zip = out_zip
+        self.metadata_files = metadata_files
+
+        # use these to record the objects that get packaged
+        self.file_paths = []
+        self.metadata_formats = []
+
+        self._file = None
+        self._entry = None
+
+    def start(self):
+        self._file = open(self.out_zip, "wb")
+        self.out = HashingWriter(self._file)
+        self.z = StreamingZipFile(self.out)
+        if self.metadata_files:
+            for mf in self.dip.get_metadata_files():
+                self.metadata_formats.append(mf.format)
+                write_zip_entry(self.z, mf.path, os.path.basename(mf.path))
+
+    def start_file(self, deposit_file, st):
+        self.file_paths.append(deposit_file.path)
+        self._entry = self.z.entry(os.path.basename(deposit_file.path), st)
+
+    def write(self, data):
+        self._entry.write(data)
+
+    def end_file(self, md5):
+        self._entry.close()
+
+    def finish(self):
+        self.z.close()
+        self._file.close()
+        return PackageInfo(self.out_zip, self.file_paths, self.metadata_formats, "SimpleZip.zip", "application/zip",
+                           md5=self.out.hexdigest())
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+
 ##########################################################
 # Packager Factory and configuration
 ##########################################################
@@ -86,15 +536,77 @@ class SimpleZipPackager(Packager):
 # we just put the PackagerFactory here too to keep it all
 # together
 
+import threading, importlib
+
+ENTRY_POINT_GROUP = "dip.packagers"
+
 class PackagerFactory(object):
+    """
+    Provides the packager for a package format.  Packagers are looked up in the
+    PACKAGERS configuration below and then in the "dip.packagers" setuptools entry
+    point group, whose entry point names are the package format identifiers:
+
+        entry_points={
+            "dip.packagers" : [
+                "http://example.com/package/Fast = fastpack.dip:FastPackager"
+            ]
+        }
+
+    A packager's module is only imported the first time its format is asked for,
+    and a single instance of each packager is shared from then on, so packagers
+    must not keep any state between calls.
+    """
+    _instances = {}
+    _lock = threading.Lock()
+
     @classmethod
     def load_packager(cls, package_identifier):
-        klazz = PACKAGERS.get(package_identifier)
-        return klazz()
+        packager = cls._instances.get(package_identifier)
+        if packager is not None:
+            return packager
+        with cls._lock:
+            packager = cls._instances.get(package_identifier)
+            if packager is None:
+                packager = cls._resolve(package_identifier)()
+                cls._instances[package_identifier] = packager
+        return packager
+
+    @classmethod
+    def register(cls, package_identifier, packager):
+        """
+        Register a packager for a package format at runtime.  The packager may be a
+        Packager class, or a "module:Class" string to be imported when first needed
+        """
+        with cls._lock:
+            PACKAGERS[package_identifier] = packager
+            cls._instances.pop(package_identifier, None)
+
+    @classmethod
+    def _resolve(cls, package_identifier):
+        target = PACKAGERS.get(package_identifier)
+        if target is None:
+            # not one of ours, so see if a plugin provides it.  pkg_resources is slow
+            # to import, so only bring it in if we have to
+            import pkg_resources
+            for ep in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP, name=package_identifier):
+                return ep.load()
+            raise PackagerException("no packager is available for package format " + str(package_identifier))
+        if isinstance(target, basestring):
+            module_name, _, attr = target.partition(":")
+            try:
+                target = getattr(importlib.import_module(module_name), attr)
+            except (ImportError, AttributeError) as e:
+                raise PackagerException("unable to load packager " + target + " for " + package_identifier + ": " + str(e))
+        return target
 
-# FIXME: a proper solution would load these dynamically, perhaps from some
-# installation directory.  For the time being, our PackagerFactory just
-# gets them from here
+# Built in packagers, by package format identifier.  Values may be Packager classes, or
+# "module:Class" strings for packagers whose dependencies should only be imported when
+# they are used.  Third party packagers should use the "dip.packagers" entry point
+# group rather than being added here.
 PACKAGERS = {
-    "http://purl.org/net/sword/package/SimpleZip" : SimpleZipPackager
+    "http://purl.org/net/sword/package/SimpleZip" : SimpleZipPackager,
+    "http://purl.org/net/sword/package/BagIt" : "dip.bagit:BagItPackager",
+    "http://purl.org/net/sword/package/METSDSpaceSIP" : "dip.mets:METSDSpaceSIPPackager",
+    "http://purl.org/net/sword/package/Tar" : "dip.tarball:TarPackager",
+    "http://purl.org/net/sword/package/TarGz" : "dip.tarball:TarGzPackager"
 }
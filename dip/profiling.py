@@ -0,0 +1,131 @@
+########################################################
+## Profiling
+########################################################
+#
+# A DIP can profile its own deposit, package and get_state operations in place,
+# for when one is slow in production and can't be reproduced anywhere else.  It
+# is switched on with DIP(profile=True), or for every DIP in the process by
+# setting the DIP_PROFILE environment variable (to anything but "" or "0").
+#
+# Each profiled operation writes, next to the history of the endpoint it was for
+# (or in history/ itself, for operations which aren't for an endpoint):
+#
+# <timestamp>_<operation>_profile.prof  - the cProfile stats, for pstats or snakeviz
+# <timestamp>_<operation>_profile.txt   - the functions which took the most time
+# <timestamp>_<operation>_memory.json   - peak RSS before and after, and the types of
+#                                         object which grew the most in number
+#
+# where the timestamp is that of the CommsMeta records the operation wrote, if it
+# wrote any, so that the profile can be matched up with the history.
+#
+# (Python 2 has no tracemalloc, so the memory profile counts live objects by type
+# instead of tracing allocations; it is a coarser picture, but shows what is piling up.)
+
+import os, gc, json, datetime, threading, contextlib
+
+PROFILE_ENV = "DIP_PROFILE"
+
+def profile_from_env():
+    """
+    Whether the environment asks for DIPs to be profiled
+    """
+    return os.environ.get(PROFILE_ENV, "") not in ["", "0"]
+
+class ProfileRun(object):
+    """
+    A single profiled operation.  Set comms_timestamp to name its files after the
+    CommsMeta records it wrote
+    """
+    def __init__(self, operation, timestamp):
+        self.operation = operation
+        self.timestamp = timestamp
+        self.comms_timestamp = None
+        self.files = []
+
+class Profiler(object):
+    """
+    Profiles operations, one at a time on each thread (an operation which is
+    profiled within another, as the package within a deposit, is part of the
+    outer one's profile)
+    """
+    def __init__(self, top=30):
+        """
+        Keyword Arguments:
+        top -   the number of functions and object types to list in the summaries
+        """
+        self.top = top
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def profile(self, out_dir, operation):
+        """
+        Profile the body of a with statement, writing the results to out_dir.  The
+        ProfileRun is yielded, and lists the files written once the body is done
+        """
+        run = ProfileRun(operation, datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+        if getattr(self._local, "active", False):
+            yield run
+            return
+
+        import cProfile
+        self._local.active = True
+        rss_before = _peak_rss_kb()
+        objects_before = _object_counts()
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield run
+        finally:
+            profiler.disable()
+            self._local.active = False
+            self._write(out_dir, run, profiler, rss_before, objects_before)
+
+    def _write(self, out_dir, run, profiler, rss_before, objects_before):
+        import pstats
+        from StringIO import StringIO
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+        timestamp = run.comms_timestamp if run.comms_timestamp is not None else run.timestamp
+        prefix = os.path.join(out_dir, timestamp + "_" + run.operation)
+
+        prof_file = prefix + "_profile.prof"
+        profiler.dump_stats(prof_file)
+
+        summary = StringIO()
+        stats = pstats.Stats(profiler, stream=summary)
+        stats.sort_stats("cumulative").print_stats(self.top)
+        txt_file = prefix + "_profile.txt"
+        with open(txt_file, "wb") as f:
+            f.write(summary.getvalue())
+
+        objects_after = _object_counts()
+        growth = [(name, count - objects_before.get(name, 0), count) for name, count in objects_after.iteritems()]
+        growth.sort(key=lambda g: g[1], reverse=True)
+        memory = {
+            "operation" : run.operation,
+            "started" : run.timestamp,
+            "comms_timestamp" : run.comms_timestamp,
+            "peak_rss_kb_before" : rss_before,
+            "peak_rss_kb_after" : _peak_rss_kb(),
+            "object_growth" : [{"type" : name, "growth" : delta, "count" : count}
+                                for name, delta, count in growth[:self.top] if delta > 0]
+        }
+        memory_file = prefix + "_memory.json"
+        with open(memory_file, "wb") as f:
+            f.write(json.dumps(memory, sort_keys=True, indent=2))
+
+        run.files = [prof_file, txt_file, memory_file]
+
+def _peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def _object_counts():
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
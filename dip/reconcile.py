@@ -0,0 +1,265 @@
+########################################################
+## Reconciliation of DIPs against their repositories
+########################################################
+#
+# Compares what a repository says it holds for a DIP (the resources listed in
+# the endpoint's SWORD statement) with the files and md5s in the DIP's
+# deposit.json, and reports the difference:
+#
+# missing       - files in the DIP which the repository doesn't list
+# extra         - resources the repository lists which aren't in the DIP
+# mismatched    - files the repository lists with a different md5 from the DIP's
+# unverified    - files the repository lists without an md5 to check against
+#
+# Resources are matched to files by name, which is what the file is called in
+# the package; the packages themselves (original deposits in a packaging other
+# than Binary) and the DIP's metadata files aren't files of the DIP, so are left
+# out.  The missing and mismatched files are the ones a delta deposit needs to
+# send (StatementDiff.delta_files).
+#
+# SWORD statements don't have to give checksums, so the md5 of a resource is
+# read from whichever of the checksum elements its Atom entry holds, if any.
+# The default, CHECKSUM_ELEMENTS, is the sword:md5 the stand-in server gives,
+# which most real repositories don't send; pass the elements a repository does
+# use to the Reconciler (or DIP.reconcile).  Without one of them, every file the
+# repository lists is "unverified", which is the normal result rather than a
+# fault: it only means its content couldn't be checked, not that it differs.
+#
+# The Reconciler fetches the statements for many DIPs and endpoints at once, on
+# a pool of threads, since the time goes in waiting for the repositories.
+
+import os, time, logging
+
+log = logging.getLogger(__name__)
+
+BINARY = "http://purl.org/net/sword/package/Binary"
+
+# the elements of a statement's Atom entry which may hold the md5 of the resource,
+# unless others are given
+CHECKSUM_ELEMENTS = [
+    "{http://purl.org/net/sword/terms/}md5"
+]
+
+class StatementDiff(object):
+    """
+    The difference between a DIP and what an endpoint's repository holds for it
+    """
+    def __init__(self, dip_dir, endpoint_id, missing=None, extra=None, mismatched=None, unverified=None, error=None):
+        """
+        Arguments:
+        dip_dir     - the base directory of the DIP
+        endpoint_id - the id of the endpoint
+
+        Keyword Arguments:
+        missing     - the paths of the files which the repository doesn't list
+        extra       - the names of the resources the repository lists which aren't in the DIP
+        mismatched  - (path, local md5, repository md5) tuples for the files whose md5s differ
+        unverified  - the paths of the files which the repository lists without an md5
+        error       - what went wrong, if the statement couldn't be fetched
+        """
+        self.dip_dir = dip_dir
+        self.endpoint_id = endpoint_id
+        self.missing = missing if missing is not None else []
+        self.extra = extra if extra is not None else []
+        self.mismatched = mismatched if mismatched is not None else []
+        self.unverified = unverified if unverified is not None else []
+        self.error = error
+
+    @property
+    def in_sync(self):
+        return self.error is None and len(self.missing) == 0 and len(self.extra) == 0 and len(self.mismatched) == 0
+
+    @property
+    def delta_files(self):
+        """
+        The paths of the files which need depositing to bring the repository up to date
+        """
+        return self.missing + [path for path, local, remote in self.mismatched]
+
+    def __str__(self):
+        if self.error is not None:
+            return self.dip_dir + " -> " + self.endpoint_id + ": " + self.error
+        return (self.dip_dir + " -> " + self.endpoint_id + ": " + str(len(self.missing)) + " missing, " +
+                str(len(self.extra)) + " extra, " + str(len(self.mismatched)) + " mismatched, " +
+                str(len(self.unverified)) + " unverified")
+
+class ReconcileReport(object):
+    """
+    The outcome of reconciling many DIPs: a StatementDiff for each DIP and endpoint
+    """
+    def __init__(self):
+        self.diffs = []
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def out_of_sync(self):
+        return [d for d in self.diffs if not d.in_sync]
+
+    @property
+    def errors(self):
+        return [d for d in self.diffs if d.error is not None]
+
+    @property
+    def elapsed(self):
+        end = self.finished if self.finished is not None else time.time()
+        return end - self.started
+
+class Reconciler(object):
+    """
+    Reconciles many DIPs against the repositories of their endpoints, fetching the
+    statements concurrently
+    """
+    def __init__(self, threads=8, user_pass=None, checksum_elements=None):
+        """
+        Keyword Arguments:
+        threads             - the number of statements to fetch at once; 1 fetches them one at
+                                a time in this thread
+        user_pass           - the password to fetch the statements with
+        checksum_elements   - the ElementTree tags ("{namespace}name") of the Atom entry
+                                elements which hold the md5 of a resource, in order of
+                                preference (default CHECKSUM_ELEMENTS)
+        """
+        self.threads = threads
+        self.user_pass = user_pass
+        self.checksum_elements = checksum_elements
+
+    def reconcile(self, dips, endpoint_ids=None, progress=None):
+        """
+        Reconcile the supplied DIPs against their endpoints
+
+        Arguments:
+        dips            - DIP objects, or the paths of existing DIP directories
+
+        Keyword Arguments:
+        endpoint_ids    - only reconcile against the endpoints with these ids (default all)
+        progress        - a function to call with each StatementDiff as it is made
+
+        Returns a ReconcileReport, with the diffs in the order of the DIPs and their endpoints
+        """
+        from dip import DIP, InitialiseException
+        report = ReconcileReport()
+        tasks = []
+        for d in dips:
+            if not isinstance(d, DIP):
+                # opening a DIP creates it, and there is nothing to reconcile in a new one
+                if not os.path.isfile(os.path.join(d, "deposit.json")):
+                    raise InitialiseException(d + " is not a DIP")
+                d = DIP(d)
+            # bring the file records up to date here, so that the fetches for the
+            # DIP's endpoints don't all try to at once
+            refresh_records(d)
+            for e in d.get_endpoints():
+                if endpoint_ids is None or e.id in endpoint_ids:
+                    tasks.append((d, e.id))
+
+        pool = None
+        if self.threads > 1 and len(tasks) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.threads, len(tasks)))
+        try:
+            results = pool.imap(self._reconcile, tasks) if pool is not None else (self._reconcile(t) for t in tasks)
+            for diff in results:
+                report.diffs.append(diff)
+                if progress is not None:
+                    progress(diff)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        report.finished = time.time()
+        log.info("reconciled " + str(len(report.diffs)) + " endpoints (" + str(len(report.out_of_sync)) +
+                 " out of sync) in " + str(round(report.elapsed, 2)) + "s")
+        return report
+
+    def _reconcile(self, task):
+        # runs on the pool, so reports any problem rather than raising it
+        d, endpoint_id = task
+        try:
+            return d._reconcile(d.get_endpoint(endpoint_id), user_pass=self.user_pass,
+                                checksum_elements=self.checksum_elements)
+        except Exception as e:
+            log.warn("unable to reconcile " + d.base_dir + " with " + endpoint_id + ": " + str(e))
+            return StatementDiff(d.base_dir, endpoint_id, error=e.__class__.__name__ + ": " + str(e))
+
+def refresh_records(dip):
+    """
+    Re-hash any of the DIP's files which have been modified since they were last
+    hashed, so that their records can be compared with the repository's
+    """
+    import packagers
+    with dip.batch():
+        for df in dip.get_files():
+            if os.path.isfile(df.path) and packagers.current_record(df) is None:
+                dip.set_file(df.path)
+
+def compare(dip, endpoint_id, statement, checksum_elements=None):
+    """
+    Compare the DIP's files with the resources in a statement from the endpoint's
+    repository
+
+    Arguments:
+    dip         - the DIP
+    endpoint_id - the id of the endpoint the statement came from
+    statement   - the sword2 statement, or None if nothing has been deposited to the
+                    endpoint yet
+
+    Keyword Arguments:
+    checksum_elements   - the tags of the elements which hold the md5 of a resource
+                            (default CHECKSUM_ELEMENTS); files the repository lists
+                            without any of them are unverified
+
+    Returns a StatementDiff
+    """
+    if checksum_elements is None:
+        checksum_elements = CHECKSUM_ELEMENTS
+    # what the repository holds, by name
+    resources = {}
+    if statement is not None:
+        for r in statement.resources:
+            if r.is_original_deposit and len([p for p in _packaging(r) if p != BINARY]) > 0:
+                continue    # a package, rather than a file
+            name = _name(r.uri)
+            if name is not None:
+                resources[name] = _md5(r, checksum_elements)
+    for mf in dip.get_metadata_files():
+        resources.pop(os.path.basename(mf.path), None)
+
+    diff = StatementDiff(dip.base_dir, endpoint_id)
+    names = set()
+    for df in dip.get_files():
+        name = os.path.basename(df.path)
+        names.add(name)
+        if name not in resources:
+            diff.missing.append(df.path)
+            continue
+        remote = resources[name]
+        if remote is None:
+            diff.unverified.append(df.path)
+        elif remote.lower() != df.md5:
+            diff.mismatched.append((df.path, df.md5, remote.lower()))
+    diff.extra = sorted([name for name in resources if name not in names])
+    return diff
+
+def _packaging(resource):
+    packaging = getattr(resource, "packaging", None) or []
+    return [p.strip() for p in packaging if p is not None]
+
+def _name(uri):
+    import urllib, urlparse
+    if uri is None:
+        return None
+    path = urlparse.urlparse(uri).path.rstrip("/")
+    if path == "":
+        return None
+    return urllib.unquote(path.rsplit("/", 1)[-1])
+
+def _md5(resource, checksum_elements):
+    dom = getattr(resource, "dom", None)
+    if dom is None:
+        return None
+    for tag in checksum_elements:
+        e = dom.find(tag)
+        if e is not None and e.text is not None and e.text.strip() != "":
+            return e.text.strip()
+    return None
@@ -0,0 +1,695 @@
+########################################################
+## In-process SWORDv2 server stand-in
+########################################################
+#
+# StandInServer is a small SWORDv2 server which runs in background threads of
+# the current process, so that deposits can be exercised (and stressed) without
+# a real repository:
+#
+#     with StandInServer(latency=0.05, bandwidth=1024 * 1024) as server:
+#         dip.set_endpoint(sd_iri=server.sd_iri, col_iri=server.col_iri(),
+#                          package="http://purl.org/net/sword/package/SimpleZip")
+#         dip.deposit(endpoint_id)
+#
+# It supports:
+#
+# GET    <url>/sd                   - the service document
+# POST   <url>/col/<collection>     - create a container from a package or an Atom entry
+# GET    <url>/edit/<id>            - the deposit receipt
+# PUT    <url>/edit/<id>            - replace the container's metadata
+# DELETE <url>/edit/<id>            - delete the container
+# GET    <url>/em/<id>              - the content (only if the server keeps content)
+# PUT    <url>/em/<id>              - replace the content
+# DELETE <url>/em/<id>              - remove the content
+# GET    <url>/statement/<id>       - the Atom statement
+#
+# The deposit receipt and the statement have an ETag and a Last-Modified, and
+# conditional GETs of them are answered with a 304 when nothing has changed.
+#
+# Request bodies are spooled to disk rather than held in memory, and hashed as
+# they arrive, so it is safe to send it very large packages.  SimpleZip packages
+# are unpacked (in the sense that each member is listed as a resource in the
+# statement, with its md5) but their content is discarded unless keep_content
+# is set.
+#
+# All of the state is held in memory, and goes away when the server does.
+
+import re, time, random, base64, socket, hashlib, zipfile, datetime, threading, tempfile, calendar, email.utils
+import BaseHTTPServer, SocketServer
+from xml.sax.saxutils import escape, quoteattr
+
+CHUNK_SIZE = 64 * 1024
+
+SIMPLE_ZIP = "http://purl.org/net/sword/package/SimpleZip"
+BINARY = "http://purl.org/net/sword/package/Binary"
+
+ATOM_NS = "http://www.w3.org/2005/Atom"
+SWORD_NS = "http://purl.org/net/sword/terms/"
+
+# the SWORD error documents we can send back
+ERROR_BAD_REQUEST = "http://purl.org/net/sword/error/ErrorBadRequest"
+ERROR_CONTENT = "http://purl.org/net/sword/error/ErrorContent"
+ERROR_CHECKSUM_MISMATCH = "http://purl.org/net/sword/error/ErrorChecksumMismatch"
+ERROR_MAX_UPLOAD_SIZE = "http://purl.org/net/sword/error/MaxUploadSizeExceeded"
+ERROR_INJECTED = "http://purl.org/net/sword/error/StandInInjectedError"
+
+STATE_IN_PROGRESS = "http://purl.org/net/sword/terms/state/inProgress"
+STATE_ARCHIVED = "http://purl.org/net/sword/terms/state/archived"
+
+def _now():
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+class _Throttle(object):
+    # holds a stream of bytes to no more than rate bytes per second
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.time()
+        self.sent = 0
+
+    def consume(self, n):
+        if self.rate is None:
+            return
+        self.sent += n
+        due = self.started + float(self.sent) / self.rate
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+class Container(object):
+    """
+    An object deposited in the stand-in server: its metadata (the Atom entry it
+    was created or last updated with, if any) and the resources it holds
+    """
+    def __init__(self, id, collection, username=None):
+        self.id = id
+        self.collection = collection
+        self.username = username
+        self.created = _now()
+        self.updated = self.created
+        self.in_progress = False
+        self.metadata = None
+        self.resources = []
+        self.content = None
+
+class Resource(object):
+    """
+    A file in a container.  The original deposit is listed along with any files
+    unpacked from it
+    """
+    def __init__(self, name, md5, size, mimetype, packaging=None, original=False):
+        self.name = name
+        self.md5 = md5
+        self.size = size
+        self.mimetype = mimetype
+        self.packaging = packaging
+        self.original = original
+        self.deposited_on = _now()
+
+class StandInServer(object):
+    """
+    An in-process SWORDv2 server, which can be made slow, unreliable or fussy about
+    the size of what it is sent.  Use it as a context manager, or call start() and
+    stop() yourself.
+    """
+    def __init__(self, host="127.0.0.1", port=0, collections=None, latency=0, bandwidth=None,
+                 error_rate=0.0, error_status=500, max_body_size=None, keep_content=False,
+                 username=None, password=None, seed=None):
+        """
+        Keyword Arguments:
+        host            - the interface to listen on
+        port            - the port to listen on; 0 picks a free one
+        collections     - the names of the collections to offer (default ["default"])
+        latency         - seconds to wait before responding to each request, or a
+                            (min, max) tuple to wait a random time between the two
+        bandwidth       - the maximum bytes per second at which each request body is
+                            read and each response body is written (None for no limit)
+        error_rate      - the proportion of requests (0 to 1) to fail with error_status
+        error_status    - the HTTP status code for injected errors
+        max_body_size   - the largest request body to accept; larger ones get a 413
+        keep_content    - keep the content of deposited packages, so that it can be
+                            retrieved from the edit-media IRI
+        username        - if set, require HTTP basic authentication with this username
+        password        - ... and this password
+        seed            - seed for the random numbers behind latency and error injection
+        """
+        self.host = host
+        self.port = port
+        self.collections = collections if collections is not None else ["default"]
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.max_body_size = max_body_size
+        self.keep_content = keep_content
+        self.username = username
+        self.password = password
+
+        self.containers = {}
+        self.stats = {"requests" : 0, "errors_injected" : 0, "bytes_received" : 0,
+                      "active" : 0, "max_concurrency" : 0, "statuses" : {}}
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._httpd = None
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def start(self):
+        """
+        Start listening, in a background thread.  Returns the server
+        """
+        self._httpd = _HTTPServer((self.host, self.port), _Handler)
+        self._httpd.standin = self
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="dip-standin-server")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop listening, and wait for the server thread to finish
+        """
+        if self._httpd is None:
+            return
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._httpd.close_connections()
+        self._thread.join()
+        self._httpd = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://%s:%s" % (self.host, self.port)
+
+    @property
+    def sd_iri(self):
+        return self.url + "/sd"
+
+    def col_iri(self, collection=None):
+        """
+        The IRI of the named collection (the first one, if no name is given)
+        """
+        return self.url + "/col/" + (collection if collection is not None else self.collections[0])
+
+    def edit_iri(self, container_id):
+        return self.url + "/edit/" + container_id
+
+    def em_iri(self, container_id):
+        return self.url + "/em/" + container_id
+
+    def statement_iri(self, container_id):
+        return self.url + "/statement/" + container_id
+
+    def get_container(self, container_id):
+        with self._lock:
+            return self.containers.get(container_id)
+
+    def _new_container(self, collection, username):
+        with self._lock:
+            self._next_id += 1
+            container = Container(str(self._next_id), collection, username)
+            self.containers[container.id] = container
+            return container
+
+    def _remove_container(self, container_id):
+        with self._lock:
+            return self.containers.pop(container_id, None)
+
+    def _delay(self):
+        with self._lock:
+            latency = self.latency
+            if isinstance(latency, tuple):
+                latency = self._random.uniform(latency[0], latency[1])
+        if latency:
+            time.sleep(latency)
+
+    def _inject_error(self):
+        with self._lock:
+            return self.error_rate > 0 and self._random.random() < self.error_rate
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def _enter(self):
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["active"] += 1
+            self.stats["max_concurrency"] = max(self.stats["max_concurrency"], self.stats["active"])
+
+    def _exit(self, status):
+        with self._lock:
+            self.stats["active"] -= 1
+            self.stats["statuses"][status] = self.stats["statuses"].get(status, 0) + 1
+
+    ########################################################
+    ## Documents
+    ########################################################
+
+    def service_document(self):
+        collections = ""
+        for name in self.collections:
+            collections += """
+        <collection href=%(href)s>
+            <atom:title>%(name)s</atom:title>
+            <accept>*/*</accept>
+            <accept alternate="multipart-related">*/*</accept>
+            <sword:acceptPackaging>%(simple_zip)s</sword:acceptPackaging>
+            <sword:acceptPackaging>%(binary)s</sword:acceptPackaging>
+            <sword:mediation>true</sword:mediation>
+        </collection>""" % {"href" : quoteattr(self.col_iri(name)), "name" : escape(name),
+                            "simple_zip" : SIMPLE_ZIP, "binary" : BINARY}
+        max_size = ""
+        if self.max_body_size is not None:
+            # the service document gives this in kB
+            max_size = "<sword:maxUploadSize>%d</sword:maxUploadSize>" % (self.max_body_size / 1024)
+        return """<?xml version="1.0" encoding="UTF-8"?>
+<service xmlns="http://www.w3.org/2007/app" xmlns:atom="%(atom)s" xmlns:sword="%(sword)s">
+    <sword:version>2.0</sword:version>
+    %(max_size)s
+    <workspace>
+        <atom:title>DIP stand-in server</atom:title>%(collections)s
+    </workspace>
+</service>
+""" % {"atom" : ATOM_NS, "sword" : SWORD_NS, "max_size" : max_size, "collections" : collections}
+
+    def deposit_receipt(self, container):
+        original = [r for r in container.resources if r.original]
+        packaging = "".join(["<sword:packaging>%s</sword:packaging>" % escape(r.packaging)
+                             for r in original if r.packaging is not None])
+        return """<?xml version="1.0" encoding="UTF-8"?>
+<entry xmlns="%(atom)s" xmlns:sword="%(sword)s">
+    <title>Container %(id)s</title>
+    <id>%(edit)s</id>
+    <updated>%(updated)s</updated>
+    <author><name>%(author)s</name></author>
+    <content type="application/zip" src=%(em_attr)s/>
+    <link rel="edit" href=%(edit_attr)s/>
+    <link rel="edit-media" href=%(em_attr)s/>
+    <link rel="http://purl.org/net/sword/terms/add" href=%(edit_attr)s/>
+    <link rel="http://purl.org/net/sword/terms/statement" type="application/atom+xml;type=feed" href=%(statement)s/>
+    %(packaging)s
+    <sword:treatment>Stored by the DIP stand-in server</sword:treatment>
+    %(metadata)s
+</entry>
+""" % {"atom" : ATOM_NS, "sword" : SWORD_NS, "id" : container.id, "updated" : container.updated,
+       "author" : escape(container.username or "anonymous"),
+       "edit" : escape(self.edit_iri(container.id)), "edit_attr" : quoteattr(self.edit_iri(container.id)),
+       "em_attr" : quoteattr(self.em_iri(container.id)),
+       "statement" : quoteattr(self.statement_iri(container.id)),
+       "packaging" : packaging, "metadata" : _foreign_elements(container.metadata)}
+
+    def statement(self, container):
+        entries = ""
+        for r in container.resources:
+            original = ""
+            if r.original:
+                original = ('<category scheme="http://purl.org/net/sword/terms/" ' +
+                            'term="http://purl.org/net/sword/terms/originalDeposit" label="Original Deposit"/>')
+            entries += """
+    <entry>
+        <id>%(src)s</id>
+        <title>%(name)s</title>
+        <updated>%(deposited_on)s</updated>
+        <content type=%(mimetype)s src=%(src_attr)s/>
+        %(original)s
+        <sword:depositedOn>%(deposited_on)s</sword:depositedOn>
+        <sword:depositedBy>%(by)s</sword:depositedBy>
+        <sword:md5>%(md5)s</sword:md5>
+        %(packaging)s
+    </entry>""" % {"src" : escape(self.em_iri(container.id) + "/" + r.name),
+                   "src_attr" : quoteattr(self.em_iri(container.id) + "/" + r.name),
+                   "name" : escape(r.name), "deposited_on" : r.deposited_on,
+                   "mimetype" : quoteattr(r.mimetype), "original" : original,
+                   "by" : escape(container.username or "anonymous"), "md5" : r.md5,
+                   "packaging" : "<sword:packaging>%s</sword:packaging>" % escape(r.packaging) if r.packaging else ""}
+
+        state = STATE_IN_PROGRESS if container.in_progress else STATE_ARCHIVED
+        return """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="%(atom)s" xmlns:sword="%(sword)s">
+    <id>%(self)s</id>
+    <title>Statement for container %(id)s</title>
+    <updated>%(updated)s</updated>
+    <author><name>DIP stand-in server</name></author>
+    <link rel="self" href=%(self_attr)s/>
+    <category scheme="http://purl.org/net/sword/terms/state" term="%(state)s" label="State">%(description)s</category>%(entries)s
+</feed>
+""" % {"atom" : ATOM_NS, "sword" : SWORD_NS, "id" : container.id, "updated" : container.updated,
+       "self" : escape(self.statement_iri(container.id)), "self_attr" : quoteattr(self.statement_iri(container.id)),
+       "state" : state, "description" : "In progress" if container.in_progress else "Archived",
+       "entries" : entries}
+
+    def error_document(self, href, summary):
+        return """<?xml version="1.0" encoding="UTF-8"?>
+<sword:error xmlns="%(atom)s" xmlns:sword="%(sword)s" href=%(href)s>
+    <title>ERROR</title>
+    <updated>%(updated)s</updated>
+    <generator uri="http://swordapp.org/" version="2.0">DIP stand-in server</generator>
+    <summary>%(summary)s</summary>
+    <sword:treatment>processing failed</sword:treatment>
+</sword:error>
+""" % {"atom" : ATOM_NS, "sword" : SWORD_NS, "href" : quoteattr(href), "updated" : _now(), "summary" : escape(summary)}
+
+def _foreign_elements(entry):
+    # the elements from outside the Atom namespace in a serialised entry (i.e. its
+    # metadata), to echo back in the deposit receipt
+    if entry is None:
+        return ""
+    from lxml import etree
+    try:
+        root = etree.fromstring(entry)
+    except etree.XMLSyntaxError:
+        return ""
+    return "\n    ".join([etree.tostring(e) for e in root
+                          if isinstance(e.tag, basestring) and not e.tag.startswith("{" + ATOM_NS + "}")])
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        # the open (kept alive) connections, so that we can close them when we stop
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.connections_lock:
+            self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        with self.connections_lock:
+            self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def close_connections(self):
+        with self.connections_lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+class _RequestError(Exception):
+    # raised while handling a request to send back a SWORD error document
+    def __init__(self, status, href, summary):
+        super(_RequestError, self).__init__(summary)
+        self.status = status
+        self.href = href
+        self.summary = summary
+
+class _Body(object):
+    # a request body spooled to a temporary file, with its md5 and size
+    def __init__(self):
+        self.file = tempfile.TemporaryFile()
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.md5.update(data)
+        self.size += len(data)
+
+    def read(self):
+        self.file.seek(0)
+        return self.file.read()
+
+    def close(self):
+        self.file.close()
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "DIPStandIn/1.0"
+
+    ROUTES = [
+        ("GET", re.compile("^/sd/?$"), "_get_service_document"),
+        ("POST", re.compile("^/col/([^/]+)/?$"), "_create"),
+        ("GET", re.compile("^/edit/([^/]+)/?$"), "_get_receipt"),
+        ("PUT", re.compile("^/edit/([^/]+)/?$"), "_replace_metadata"),
+        ("DELETE", re.compile("^/edit/([^/]+)/?$"), "_delete_container"),
+        ("GET", re.compile("^/em/([^/]+)/?$"), "_get_content"),
+        ("PUT", re.compile("^/em/([^/]+)/?$"), "_replace_content"),
+        ("DELETE", re.compile("^/em/([^/]+)/?$"), "_delete_content"),
+        ("GET", re.compile("^/statement/([^/]+)/?$"), "_get_statement"),
+    ]
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def standin(self):
+        return self.server.standin
+
+    def _dispatch(self, method):
+        standin = self.standin
+        standin._enter()
+        status = None
+        body = None
+        try:
+            try:
+                # always read the whole body, so the client gets to hear what we have to say
+                body = self._read_body()
+                standin._delay()
+                if standin._inject_error():
+                    standin._count("errors_injected")
+                    raise _RequestError(standin.error_status, ERROR_INJECTED, "error injected by the stand-in server")
+                self._authenticate()
+                if standin.max_body_size is not None and body.size > standin.max_body_size:
+                    raise _RequestError(413, ERROR_MAX_UPLOAD_SIZE, "request body of %d bytes is larger than %d" %
+                                        (body.size, standin.max_body_size))
+                self._check_md5(body)
+
+                path = self.path.split("?")[0]
+                for route_method, pattern, handler in self.ROUTES:
+                    match = pattern.match(path)
+                    if match is None:
+                        continue
+                    if route_method == method:
+                        status = getattr(self, handler)(body, *match.groups())
+                        break
+                else:
+                    if any([p.match(path) for m, p, h in self.ROUTES]):
+                        raise _RequestError(405, ERROR_BAD_REQUEST, method + " is not supported on " + path)
+                    raise _RequestError(404, ERROR_BAD_REQUEST, "nothing at " + path)
+            except _RequestError as e:
+                status = e.status
+                headers = {"WWW-Authenticate" : 'Basic realm="SWORD"'} if status == 401 else {}
+                self._respond(status, standin.error_document(e.href, e.summary), "text/xml", headers)
+            except Exception as e:
+                status = 500
+                self._respond(status, standin.error_document(ERROR_BAD_REQUEST, "stand-in server error: " + str(e)), "text/xml")
+        finally:
+            if body is not None:
+                body.close()
+            standin._exit(status)
+
+    def _read_body(self):
+        body = _Body()
+        throttle = _Throttle(self.standin.bandwidth)
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            while True:
+                size = int(self.rfile.readline().split(";")[0].strip(), 16)
+                if size == 0:
+                    # the trailer, if any, then the blank line
+                    while self.rfile.readline().strip() != "":
+                        pass
+                    break
+                self._copy(size, body, throttle)
+                self.rfile.readline()
+        else:
+            self._copy(int(self.headers.get("Content-Length", 0)), body, throttle)
+        self.standin._count("bytes_received", body.size)
+        return body
+
+    def _copy(self, size, body, throttle):
+        remaining = size
+        while remaining > 0:
+            data = self.rfile.read(min(remaining, CHUNK_SIZE))
+            if not data:
+                raise _RequestError(400, ERROR_BAD_REQUEST, "request body ended early")
+            body.write(data)
+            throttle.consume(len(data))
+            remaining -= len(data)
+
+    def _authenticate(self):
+        standin = self.standin
+        if standin.username is None:
+            return
+        auth = self.headers.get("Authorization", "")
+        if auth.startswith("Basic "):
+            try:
+                username, password = base64.b64decode(auth[6:]).split(":", 1)
+            except (TypeError, ValueError):
+                username, password = None, None
+            if username == standin.username and password == standin.password:
+                return
+        raise _RequestError(401, ERROR_BAD_REQUEST, "authentication required")
+
+    def _check_md5(self, body):
+        expected = self.headers.get("Content-MD5")
+        if expected is not None and body.size > 0 and expected.strip() != body.md5.hexdigest():
+            raise _RequestError(412, ERROR_CHECKSUM_MISMATCH, "Content-MD5 does not match the request body")
+
+    def _respond(self, status, content=None, mimetype=None, headers=None):
+        self.send_response(status)
+        for k, v in (headers or {}).iteritems():
+            self.send_header(k, v)
+        if content is not None and mimetype is not None:
+            self.send_header("Content-Type", mimetype)
+        self.send_header("Content-Length", str(len(content) if content is not None else 0))
+        self.end_headers()
+        if content is not None and self.command != "HEAD":
+            throttle = _Throttle(self.standin.bandwidth)
+            for i in xrange(0, len(content), CHUNK_SIZE):
+                chunk = content[i:i + CHUNK_SIZE]
+                self.wfile.write(chunk)
+                throttle.consume(len(chunk))
+        return status
+
+    def _container(self, container_id):
+        container = self.standin.get_container(container_id)
+        if container is None:
+            raise _RequestError(404, ERROR_BAD_REQUEST, "no container " + container_id)
+        return container
+
+    def _receipt_response(self, status, container, headers=None):
+        return self._respond(status, self.standin.deposit_receipt(container), "application/atom+xml;type=entry", headers)
+
+    def _conditional_response(self, container, content, mimetype):
+        # a GET with an ETag (the md5 of the content) and a Last-Modified (when the
+        # container was last updated), which answers a conditional GET with a 304
+        # if nothing has changed
+        etag = '"' + hashlib.md5(content).hexdigest() + '"'
+        modified = calendar.timegm(time.strptime(container.updated, "%Y-%m-%dT%H:%M:%SZ"))
+        headers = {"ETag" : etag, "Last-Modified" : email.utils.formatdate(modified, usegmt=True)}
+        if_none_match = self.headers.get("If-None-Match")
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_none_match is not None:
+            if etag in [t.strip() for t in if_none_match.split(",")] or if_none_match.strip() == "*":
+                return self._respond(304, headers=headers)
+        elif if_modified_since is not None:
+            since = email.utils.parsedate_tz(if_modified_since)
+            if since is not None and modified <= email.utils.mktime_tz(since):
+                return self._respond(304, headers=headers)
+        return self._respond(200, content, mimetype, headers)
+
+    def _is_entry(self):
+        return self.headers.get("Content-Type", "").replace(" ", "").startswith("application/atom+xml")
+
+    def _in_progress(self):
+        return self.headers.get("In-Progress", "false").strip().lower() == "true"
+
+    def _username(self):
+        return self.headers.get("On-Behalf-Of") or self.standin.username
+
+    def _filename(self):
+        disposition = self.headers.get("Content-Disposition", "")
+        match = re.search('filename="?([^";]+)"?', disposition)
+        return match.group(1) if match is not None else "content"
+
+    def _content(self, body):
+        # the resources for a package (the package itself, and anything we can unpack
+        # from it), and the content to keep, if we are keeping it
+        packaging = self.headers.get("Packaging", BINARY).strip()
+        mimetype = self.headers.get("Content-Type", "application/octet-stream")
+        resources = [Resource(self._filename(), body.md5.hexdigest(), body.size, mimetype, packaging, original=True)]
+        if packaging == SIMPLE_ZIP:
+            body.file.seek(0)
+            try:
+                with zipfile.ZipFile(body.file) as z:
+                    for info in z.infolist():
+                        md5 = hashlib.md5()
+                        with z.open(info) as member:
+                            for data in iter(lambda: member.read(CHUNK_SIZE), ""):
+                                md5.update(data)
+                        resources.append(Resource(info.filename, md5.hexdigest(), info.file_size, "application/octet-stream"))
+            except zipfile.BadZipfile:
+                raise _RequestError(400, ERROR_CONTENT, "SimpleZip package is not a zip file")
+        return resources, body.read() if self.standin.keep_content else None
+
+    def _get_service_document(self, body):
+        return self._respond(200, self.standin.service_document(), "application/atomserv+xml")
+
+    def _create(self, body, collection):
+        if collection not in self.standin.collections:
+            raise _RequestError(404, ERROR_BAD_REQUEST, "no collection " + collection)
+        if self.headers.get("Content-Type", "").startswith("multipart/"):
+            raise _RequestError(415, ERROR_CONTENT, "multipart deposits are not supported by the stand-in server")
+
+        # work out what we've been sent before making the container, so a bad package leaves nothing behind
+        metadata, resources, content = None, [], None
+        if self._is_entry():
+            metadata = body.read()
+        else:
+            resources, content = self._content(body)
+
+        container = self.standin._new_container(collection, self._username())
+        container.metadata = metadata
+        container.resources = resources
+        container.content = content
+        container.in_progress = self._in_progress()
+        return self._receipt_response(201, container, {"Location" : self.standin.edit_iri(container.id)})
+
+    def _get_receipt(self, body, container_id):
+        container = self._container(container_id)
+        return self._conditional_response(container, self.standin.deposit_receipt(container), "application/atom+xml;type=entry")
+
+    def _replace_metadata(self, body, container_id):
+        container = self._container(container_id)
+        if not self._is_entry():
+            raise _RequestError(415, ERROR_CONTENT, "metadata must be sent as an Atom entry")
+        container.metadata = body.read()
+        container.in_progress = self._in_progress()
+        container.updated = _now()
+        return self._receipt_response(200, container)
+
+    def _delete_container(self, body, container_id):
+        if self.standin._remove_container(container_id) is None:
+            raise _RequestError(404, ERROR_BAD_REQUEST, "no container " + container_id)
+        return self._respond(204)
+
+    def _get_content(self, body, container_id):
+        container = self._container(container_id)
+        if container.content is None:
+            raise _RequestError(404, ERROR_CONTENT, "the stand-in server has not kept the content of container " + container_id)
+        original = [r for r in container.resources if r.original][0]
+        return self._respond(200, container.content, original.mimetype)
+
+    def _replace_content(self, body, container_id):
+        container = self._container(container_id)
+        container.resources, container.content = self._content(body)
+        container.updated = _now()
+        return self._respond(204)
+
+    def _delete_content(self, body, container_id):
+        container = self._container(container_id)
+        container.resources = []
+        container.content = None
+        container.updated = _now()
+        return self._respond(204)
+
+    def _get_statement(self, body, container_id):
+        container = self._container(container_id)
+        return self._conditional_response(container, self.standin.statement(container), "application/atom+xml;type=feed")
@@ -0,0 +1,288 @@
+########################################################
+## Tar implementation
+########################################################
+#
+# Makes a flat tar (or tar.gz) of the DIP's files, like SimpleZip but for
+# endpoints which take tarballs.  The tar is written as a stream, a file at a
+# time in small blocks, to any file-like object, so the packager never holds
+# more than a block of any file in memory and the same code can write to a
+# package file or to anything else which takes the bytes in order.
+#
+# The gzip stage compresses the stream in independent blocks, in parallel across
+# the machine's cores, as pigz does.  Each block is written out as a complete
+# gzip member, and the members are concatenated in order; a concatenation of
+# gzip members is itself a gzip file (RFC 1952), which gunzip, tar and Python's
+# own gzip and tarfile modules all read as one.  Forking the processes costs more
+# than compressing a small package, so the pool is started once and shared by
+# every tar.gz made in the process (see shared_pool).
+#
+# The tar is built by a PackageWriter, so it can be built alongside other
+# packages from a single read of each file.  Each file is hashed as it is read
+# into the tar, and its record updated if it has changed, and the package is
+# hashed as it is written, so that the deposit needn't read it again to work out
+# its Content-MD5.
+
+import os, zlib, collections, threading
+from packagers import Packager, PackageWriter, PackageInfo, PackagerException, HashingWriter, TarEntryWriter, write_packages
+
+TAR = "http://purl.org/net/sword/package/Tar"
+TAR_GZ = "http://purl.org/net/sword/package/TarGz"
+
+# the size of the blocks which are compressed independently
+BLOCK_SIZE = 1024 * 1024
+
+# the pools which ParallelGzipWriters share, by number of processes, as (pid, pool)
+_pools = {}
+_pools_lock = threading.Lock()
+
+def shared_pool(processes):
+    """
+    The pool of the supplied number of processes which ParallelGzipWriters share if
+    they aren't given one, started the first time it is needed (and again in a forked
+    child, which can't use its parent's).  multiprocessing stops it when the
+    interpreter exits
+    """
+    with _pools_lock:
+        pid, pool = _pools.get(processes, (None, None))
+        if pool is None or pid != os.getpid():
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            _pools[processes] = (os.getpid(), pool)
+        return pool
+
+class TarPackager(Packager):
+    """
+    Packager which makes a flat tar file out of the files in the dip
+
+    The packager args can be any of the following:
+
+    metadata_files - True/False - should the packager include all of the metadata files
+    deposit_files - True/False - should the packager include all of the dip's files
+    remove_package - True/False - on completion of deposit, should the created package be removed
+
+    """
+    filename = "Tar.tar"
+    mimetype = "application/x-tar"
+    compressed = False
+
+    def writer(self, dip, out_dir, **packager_args):
+        return TarWriter(self, dip, os.path.join(out_dir, self.filename), None, **packager_args)
+
+    def write(self, dip, out, **packager_args):
+        """
+        Write the package to the supplied file-like object, which need only have a
+        write method.  Takes the same packager args as package.
+
+        Returns a tuple of the paths of the files and the formats of the metadata
+        which were packaged
+        """
+        writer = TarWriter(self, dip, None, out, **packager_args)
+        write_packages(dip, [writer])
+        return writer.file_paths, writer.metadata_formats
+
+    def cleanup(self, dip, package_dir, package_info, **packager_args):
+        remove_package = packager_args.get("remove_package", False)
+        if not remove_package:
+            return
+        if os.path.isfile(package_info.path):
+            os.unlink(package_info.path)
+
+class TarGzPackager(TarPackager):
+    """
+    Packager which makes a flat tar.gz file out of the files in the dip, compressing
+    blocks of it in parallel
+
+    The packager args are those of the TarPackager, and:
+
+    compresslevel - 1-9 - the gzip compression level (default 6)
+    block_size - the number of bytes of the tar to compress at a time (default 1MB)
+    processes - the number of processes to compress with (default the number of CPUs; 1
+                    compresses in this process)
+
+    """
+    filename = "Tar.tar.gz"
+    mimetype = "application/gzip"
+    compressed = True
+
+class TarWriter(PackageWriter):
+    """
+    Writes the tar (or tar.gz) of a TarPackager, to the package file at path, or to
+    the file-like object out
+    """
+    def __init__(self, packager, dip, path, out, **packager_args):
+        do_md = packager_args.get("metadata_files", True)
+        do_files = packager_args.get("deposit_files", True)
+
+        # check that some packaging is going to be done
+        name = packager.__class__.__name__
+        if not do_md and not do_files:
+            raise PackagerException(name + " must be instructed to deposit either metadata files, deposit files or both")
+        super(TarWriter, self).__init__(do_files)
+
+        self.packager = packager
+        self.path = path
+        self.out = out
+        self.packager_args = packager_args
+        self.metadata_files = dip.get_metadata_files() if do_md else []
+
+        # the tar is flat, so the names in it must be unique
+        names = set()
+        for f in self.metadata_files + (dip.get_files() if do_files else []):
+            basename = os.path.basename(f.path)
+            if basename in names:
+                raise PackagerException(name + " can't include two files called " + basename)
+            names.add(basename)
+
+        # use these to record the objects that get packaged
+        self.file_paths = []
+        self.metadata_formats = []
+
+        self._file = None
+        self._hashing = None
+        self._gz = None
+        self._tar = None
+        self._entry = None
+
+    def start(self):
+        import tarfile
+        out = self.out
+        if out is None:
+            self._file = open(self.path, "wb")
+            out = self._hashing = HashingWriter(self._file)
+        if self.packager.compressed:
+            out = self._gz = ParallelGzipWriter(out, compresslevel=self.packager_args.get("compresslevel", 6),
+                                                block_size=self.packager_args.get("block_size", BLOCK_SIZE),
+                                                processes=self.packager_args.get("processes"))
+        # "w|" writes the tar as a stream, without seeking
+        self._tar = tarfile.open(mode="w|", fileobj=out)
+        for mf in self.metadata_files:
+            self._tar.add(mf.path, os.path.basename(mf.path))
+            self.metadata_formats.append(mf.format)
+
+    def start_file(self, deposit_file, st):
+        self._entry = TarEntryWriter(self._tar, os.path.basename(deposit_file.path), st)
+        self.file_paths.append(deposit_file.path)
+
+    def write(self, data):
+        self._entry.write(data)
+
+    def end_file(self, md5):
+        self._entry.close()
+
+    def finish(self):
+        self._tar.close()
+        if self._gz is not None:
+            self._gz.close()
+        if self._file is None:
+            return None
+        self._file.close()
+        return PackageInfo(self.path, self.file_paths, self.metadata_formats, self.packager.filename,
+                           self.packager.mimetype, md5=self._hashing.hexdigest())
+
+    def abort(self):
+        if self._tar is not None:
+            try:
+                self._tar.close()
+            except Exception:
+                pass    # the package is being thrown away anyway
+        if self._gz is not None:
+            self._gz.terminate()
+        if self._file is not None:
+            self._file.close()
+
+class ParallelGzipWriter(object):
+    """
+    A file-like object which gzips what is written to it onto another, compressing
+    each block_size bytes as a separate gzip member in a pool of processes
+    """
+    def __init__(self, fileobj, compresslevel=6, block_size=BLOCK_SIZE, processes=None, pool=None):
+        """
+        Arguments:
+        fileobj         - the file-like object to write the compressed stream to
+
+        Keyword Arguments:
+        compresslevel   - the gzip compression level
+        block_size      - the number of bytes to compress as each member
+        processes       - the number of processes to compress with (default the number of
+                            CPUs; 1 compresses in this process)
+        pool            - the multiprocessing.Pool to compress with (default the shared_pool
+                            of that many processes).  It is left running when the writer closes
+        """
+        if processes is None:
+            import multiprocessing
+            processes = multiprocessing.cpu_count()
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.processes = processes
+        self.closed = False
+        self._buffer = []
+        self._buffered = 0
+        self._members = 0
+        self._pool = pool
+        self._pending = collections.deque()
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to a closed ParallelGzipWriter")
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered < self.block_size:
+            return
+        # join what we have once, compress as many whole blocks of it as there are,
+        # and keep the rest for next time
+        data = "".join(self._buffer)
+        offset = 0
+        while len(data) - offset >= self.block_size:
+            self._compress(data[offset:offset + self.block_size])
+            offset += self.block_size
+        rest = data[offset:]
+        self._buffer = [rest] if rest else []
+        self._buffered = len(rest)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Compress whatever is left, and write out everything compressed so far (the
+        underlying file-like object is not closed)
+        """
+        if self.closed:
+            return
+        if self._buffered > 0 or self._members == 0:
+            # an empty stream is still one (empty) member
+            self._compress("".join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+        while len(self._pending) > 0:
+            self.fileobj.write(self._pending.popleft().get())
+        self.closed = True
+
+    def terminate(self):
+        """
+        Stop compressing, abandoning whatever has not been written out yet (the blocks
+        already with the pool are compressed, and thrown away)
+        """
+        self._pending.clear()
+        self._buffer = []
+        self._buffered = 0
+        self.closed = True
+
+    def _compress(self, block):
+        self._members += 1
+        if self.processes <= 1:
+            self.fileobj.write(_gzip_member(block, self.compresslevel))
+            return
+        if self._pool is None:
+            self._pool = shared_pool(self.processes)
+        self._pending.append(self._pool.apply_async(_gzip_member, (block, self.compresslevel)))
+        # write out the oldest blocks as they come back, keeping only a couple of blocks
+        # per process in memory
+        while len(self._pending) > 2 * self.processes or (len(self._pending) > 0 and self._pending[0].ready()):
+            self.fileobj.write(self._pending.popleft().get())
+
+def _gzip_member(data, compresslevel):
+    # 16 + MAX_WBITS has zlib write a gzip header and trailer around the deflate stream
+    c = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
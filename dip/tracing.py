@@ -0,0 +1,224 @@
+########################################################
+## Tracing
+########################################################
+#
+# Where metrics give aggregates, a trace gives the timeline of a single operation:
+# a DIP opens a root span for each deposit, delete or get_repository_statement,
+# with nested spans for the work done along the way (packaging, requests to the
+# endpoint, marking files as deposited, saving the history and cleaning up):
+#
+#     dip.deposit
+#         package
+#         history_save
+#         upload
+#         mark_deposited
+#         history_save
+#         cleanup
+#
+# When a root span ends, the whole trace goes to the tracer's exporter.  With no
+# exporter (the default) no spans are made at all.  To write traces to a file of
+# OTLP JSON lines, which the OpenTelemetry collector's file receiver (and most
+# trace viewers) can read:
+#
+#     d = DIP("path/to/dip", tracer=Tracer(OTLPJsonFileExporter("traces.jsonl")))
+#
+# Each trace carries the comms_timestamp of the CommsMeta records it wrote, which is
+# what the history is keyed on, so a slow deposit can be matched up with its history.
+
+import os, time, json, threading, contextlib
+
+class Span(object):
+    """
+    A single timed operation within a trace
+    """
+    def __init__(self, name, trace_id, parent_id=None, attributes=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.attributes = attributes if attributes is not None else {}
+        self.start = time.time()
+        self.end = None
+        self.error = None
+
+    def set_attribute(self, key, value):
+        """
+        Set an attribute of the span (e.g. a byte count or a response code)
+        """
+        self.attributes[key] = value
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+class _NullSpan(object):
+    # stands in for a span when nothing is being traced
+    def set_attribute(self, key, value):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+class Tracer(object):
+    """
+    Makes spans, nesting each inside whichever span is open on the current thread
+    """
+    def __init__(self, exporter=None):
+        """
+        Keyword Arguments:
+        exporter    -   a SpanExporter to send each trace to when it completes.  If this
+                        is None, nothing is traced
+        """
+        self.exporter = exporter
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        """
+        Time the body of a with statement as a span with the supplied name and
+        attributes.  The span is yielded, so that attributes which are only known
+        at the end can be added to it
+        """
+        if self.exporter is None:
+            yield _NULL_SPAN
+            return
+
+        stack = self._stack()
+        if len(stack) == 0:
+            span = Span(name, _new_id(16), attributes=attributes)
+            self._local.trace = []
+        else:
+            span = Span(name, stack[-1].trace_id, stack[-1].span_id, attributes)
+        stack.append(span)
+        try:
+            yield span
+        except Exception as e:
+            span.error = e.__class__.__name__ + ": " + str(e)
+            raise
+        finally:
+            span.end = time.time()
+            stack.pop()
+            self._local.trace.append(span)
+            if len(stack) == 0:
+                trace = self._local.trace
+                self._local.trace = []
+                self.exporter.export(trace)
+
+    def current(self):
+        """
+        The innermost span open on this thread (which quietly ignores attributes if
+        there isn't one)
+        """
+        stack = self._stack()
+        return stack[-1] if len(stack) > 0 else _NULL_SPAN
+
+    def set_trace_attributes(self, **attributes):
+        """
+        Set attributes on the root span of the trace open on this thread, if there is one
+        """
+        stack = self._stack()
+        if len(stack) > 0:
+            stack[0].attributes.update(attributes)
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = []
+            self._local.stack = stack
+        return stack
+
+class SpanExporter(object):
+    """
+    Receives each completed trace from a Tracer; subclasses send it somewhere
+    """
+    def export(self, spans):
+        """
+        Export the spans of a completed trace, in the order in which they ended
+        (so the root span is last)
+        """
+        pass
+
+class CollectingExporter(SpanExporter):
+    """
+    Keeps the spans of every trace in memory
+    """
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        with self._lock:
+            self.spans.extend(spans)
+
+class OTLPJsonFileExporter(SpanExporter):
+    """
+    Appends each trace to a file as a line of OTLP JSON (an ExportTraceServiceRequest)
+    """
+    def __init__(self, path, service_name="dip"):
+        """
+        Arguments:
+        path            - the file to append the traces to
+
+        Keyword Arguments:
+        service_name    - the service.name resource attribute to give the spans
+        """
+        self.path = path
+        self.service_name = service_name
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        line = json.dumps(self.otlp(spans), sort_keys=True)
+        with self._lock:
+            with open(self.path, "ab") as f:
+                f.write(line + "\n")
+
+    def otlp(self, spans):
+        """
+        The OTLP JSON document for the supplied spans
+        """
+        return {
+            "resourceSpans" : [{
+                "resource" : {"attributes" : _otlp_attributes({"service.name" : self.service_name})},
+                "scopeSpans" : [{
+                    "scope" : {"name" : "dip"},
+                    "spans" : [self._otlp_span(s) for s in spans]
+                }]
+            }]
+        }
+
+    def _otlp_span(self, span):
+        obj = {
+            "traceId" : span.trace_id,
+            "spanId" : span.span_id,
+            "name" : span.name,
+            "kind" : 1,     # SPAN_KIND_INTERNAL
+            "startTimeUnixNano" : str(int(span.start * 1e9)),
+            "endTimeUnixNano" : str(int(span.end * 1e9)),
+            "attributes" : _otlp_attributes(span.attributes),
+            "status" : {"code" : 1}     # STATUS_CODE_OK
+        }
+        if span.parent_id is not None:
+            obj["parentSpanId"] = span.parent_id
+        if span.error is not None:
+            obj["status"] = {"code" : 2, "message" : span.error}     # STATUS_CODE_ERROR
+        return obj
+
+def _otlp_attributes(attributes):
+    out = []
+    for key, value in sorted(attributes.items()):
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            v = {"boolValue" : value}
+        elif isinstance(value, (int, long)):
+            v = {"intValue" : str(value)}
+        elif isinstance(value, float):
+            v = {"doubleValue" : value}
+        else:
+            v = {"stringValue" : value if isinstance(value, basestring) else str(value)}
+        out.append({"key" : key, "value" : v})
+    return out
+
+def _new_id(size):
+    return os.urandom(size).encode("hex")
@@ -0,0 +1,291 @@
+########################################################
+## Deposit transport
+########################################################
+#
+# The HTTP layer which a DIP gives to sword2 for its deposits.  sword2's own
+# layer reads the whole payload into memory and hands it to httplib2 in one go,
+# so memory use grows with the package, and nothing can be known about a
+# deposit until its receipt arrives.  This one sends the payload straight to the
+# socket, chunk_size bytes at a time (read from the file, or sliced from a
+# read-only mmap of it, so that the bytes never need copying into Python
+# strings), so memory use is the same whatever the size of the package, and it
+# counts the chunks as they go, so that:
+#
+# - a progress callback can be told the phase of the deposit, the bytes sent,
+#   the rate and the ETA as the upload goes on
+# - the throughput achieved can be recorded in the response CommsMeta
+#
+# sword2 also reads the whole payload before sending it, to work out its
+# Content-MD5.  A Payload whose md5 is already known spares it that read (see
+# Payload).
+#
+# Because a payload can only be sent once, credentials are sent pre-emptively
+# (as HTTP Basic, which is what SWORD servers use) rather than in answer to a
+# 401 challenge, which would need the payload to be sent again.
+#
+# This module imports sword2, so the DIP only imports it when making a deposit.
+
+import os, time, base64, httplib
+from StringIO import StringIO
+import httplib2
+from sword2 import http_layer
+
+# the number of bytes of the payload which are sent at a time
+CHUNK_SIZE = 64 * 1024
+
+class Progress(object):
+    """
+    A report on the progress of a deposit, as given to a progress callback
+    """
+    PACKAGING = "packaging"
+    UPLOADING = "uploading"
+    AWAITING_RECEIPT = "awaiting_receipt"
+    DONE = "done"
+
+    def __init__(self, phase, bytes_sent=0, total_bytes=None, elapsed=0.0):
+        """
+        Arguments:
+        phase       - one of PACKAGING, UPLOADING, AWAITING_RECEIPT or DONE
+
+        Keyword Arguments:
+        bytes_sent  - the number of bytes of the payload sent so far
+        total_bytes - the size of the payload, if it is known yet
+        elapsed     - the seconds since the upload started
+        """
+        self.phase = phase
+        self.bytes_sent = bytes_sent
+        self.total_bytes = total_bytes
+        self.elapsed = elapsed
+
+    @property
+    def rate(self):
+        """
+        The average upload rate so far, in bytes per second (None if nothing has been sent)
+        """
+        if self.bytes_sent == 0 or self.elapsed <= 0:
+            return None
+        return self.bytes_sent / self.elapsed
+
+    @property
+    def eta(self):
+        """
+        The estimated number of seconds until the payload is sent, at the current rate
+        """
+        rate = self.rate
+        if rate is None or self.total_bytes is None:
+            return None
+        return max(self.total_bytes - self.bytes_sent, 0) / rate
+
+    def __repr__(self):
+        return "Progress(%s, %d/%s bytes)" % (self.phase, self.bytes_sent, self.total_bytes)
+
+class ProgressReporter(object):
+    """
+    Keeps track of the progress of a deposit, telling the callback (if there is one)
+    about it no more often than every interval seconds while the payload is being sent
+    """
+    def __init__(self, callback=None, interval=0.5):
+        self.callback = callback
+        self.interval = interval
+        self.phase = None
+        self.bytes_sent = 0
+        self.total_bytes = None
+        self.started = None
+        self.finished = None
+        self._last_report = None
+
+    def packaging(self):
+        self._report(Progress.PACKAGING)
+
+    def start_upload(self, total_bytes):
+        self.bytes_sent = 0
+        self.total_bytes = total_bytes
+        self.started = time.time()
+        self.finished = None
+        self._report(Progress.UPLOADING)
+
+    def sent(self, size):
+        self.bytes_sent += size
+        if self.callback is not None and time.time() - self._last_report >= self.interval:
+            self._report(Progress.UPLOADING)
+
+    def awaiting_receipt(self):
+        self._report(Progress.AWAITING_RECEIPT)
+
+    def done(self):
+        self.finished = time.time()
+        self._report(Progress.DONE)
+
+    def throughput(self):
+        """
+        The bytes sent and seconds taken (from starting to send the payload until the
+        receipt arrived) by the last upload, as a dictionary for the CommsMeta
+        """
+        if self.started is None:
+            return None
+        seconds = (self.finished if self.finished is not None else time.time()) - self.started
+        return {
+            "bytes" : self.bytes_sent,
+            "seconds" : seconds,
+            "bytes_per_second" : self.bytes_sent / seconds if seconds > 0 else None
+        }
+
+    def _report(self, phase):
+        self.phase = phase
+        self._last_report = time.time()
+        if self.callback is not None:
+            elapsed = self._last_report - self.started if self.started is not None else 0.0
+            self.callback(Progress(phase, self.bytes_sent, self.total_bytes, elapsed))
+
+class Payload(object):
+    """
+    A file to be deposited, for passing to sword2 as the payload.
+
+    sword2 reads a payload through before sending it, to work out its md5 and size
+    for the Content-MD5 and Content-Length headers.  If the md5 of the file is
+    already known, and the payload is to be sent by a layer which sends the file
+    itself (one whose sends_payload_files is True, like the DepositHttpLayer), give
+    the md5 and skip_read: the payload then reads as empty to sword2, and the layer
+    puts the real md5 and size in the headers, so that the file is only read once,
+    as it is sent.  Any other layer sends what the payload reads, so it must read
+    as the file.
+    """
+    def __init__(self, path, md5=None, skip_read=False):
+        """
+        Arguments:
+        path        - the path to the file
+
+        Keyword Arguments:
+        md5         - the hex md5 of the file, if it is known
+        skip_read   - read as empty, because the md5 is known and the layer sends the file
+        """
+        if skip_read and md5 is None:
+            raise ValueError("a payload can only skip being read if its md5 is known")
+        self.path = path
+        self.md5 = md5
+        self.skip_read = skip_read
+        self.size = os.path.getsize(path)
+        self.file = open(path, "rb")
+
+    def read(self, size=-1):
+        if self.skip_read:
+            return ""
+        return self.file.read(size)
+
+    def seek(self, offset, whence=0):
+        self.file.seek(offset, whence)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class _ChunkedBody(object):
+    # a request body which the connection sends a chunk at a time, telling the reporter
+    # about each chunk sent
+    def __init__(self, payload, size, reporter, chunk_size=CHUNK_SIZE, use_mmap=False):
+        self.payload = payload
+        self.size = size
+        self.reporter = reporter
+        self.chunk_size = chunk_size
+        self.use_mmap = use_mmap
+
+    def chunks(self):
+        f = self.payload.file if isinstance(self.payload, Payload) else self.payload
+        if self.use_mmap and self.size > 0 and hasattr(f, "fileno"):
+            import mmap
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for offset in xrange(0, len(m), self.chunk_size):
+                    yield buffer(m, offset, self.chunk_size)
+            finally:
+                m.close()
+        else:
+            # from the start, in case this is a retry
+            f.seek(0)
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def send(self, sock):
+        self.reporter.start_upload(self.size)
+        for chunk in self.chunks():
+            sock.sendall(chunk)
+            self.reporter.sent(len(chunk))
+        self.reporter.awaiting_receipt()
+
+class _ChunkedSendMixin:
+    # lets httplib send a _ChunkedBody, which it would otherwise read 8KB at a time (an
+    # old style class, like httplib's, or object's __init__ would come before theirs)
+    def send(self, data):
+        if not isinstance(data, _ChunkedBody):
+            return httplib.HTTPConnection.send(self, data)
+        if self.sock is None:
+            self.connect()
+        data.send(self.sock)
+
+class _HTTPConnection(_ChunkedSendMixin, httplib2.HTTPConnectionWithTimeout):
+    pass
+
+class _HTTPSConnection(_ChunkedSendMixin, httplib2.HTTPSConnectionWithTimeout):
+    pass
+
+_CONNECTIONS = {"http" : _HTTPConnection, "https" : _HTTPSConnection}
+
+class DepositHttpLayer(http_layer.HttpLib2Layer):
+    """
+    A sword2 HTTP layer which sends payloads a chunk at a time, reporting on their
+    progress to a ProgressReporter
+    """
+    # it sends a Payload's file, not what the payload reads (see Payload)
+    sends_payload_files = True
+
+    def __init__(self, reporter=None, timeout=30.0, ca_certs=None, chunk_size=CHUNK_SIZE, use_mmap=False):
+        """
+        Keyword Arguments:
+        reporter    - the ProgressReporter to tell about uploads
+        timeout     - the socket timeout, in seconds
+        ca_certs    - the CA certificates file to verify https connections with
+        chunk_size  - the number of bytes of a payload to send at a time
+        use_mmap    - send payload files from a read-only mmap of them, rather than
+                        reading them
+        """
+        # there's nothing to be gained by caching deposit responses
+        super(DepositHttpLayer, self).__init__(None, timeout=timeout, ca_certs=ca_certs)
+        self.reporter = reporter if reporter is not None else ProgressReporter()
+        self.chunk_size = chunk_size
+        self.use_mmap = use_mmap
+        self._authorization = None
+
+    def add_credentials(self, username, password):
+        credentials = username + ":" + (password if password is not None else "")
+        self._authorization = "Basic " + base64.b64encode(credentials)
+
+    def request(self, uri, method, headers=None, payload=None):
+        headers = dict(headers) if headers is not None else {}
+        if self._authorization is not None:
+            headers["Authorization"] = self._authorization
+
+        body = None
+        if payload is not None:
+            if isinstance(payload, basestring):
+                headers["Content-Length"] = str(len(payload))
+                payload = StringIO(payload)
+            if isinstance(payload, Payload):
+                headers["Content-Length"] = str(payload.size)
+                if payload.md5 is not None:
+                    headers["Content-MD5"] = str(payload.md5)
+            length = headers.get("Content-Length")
+            body = _ChunkedBody(payload, int(length) if length is not None else None, self.reporter,
+                                self.chunk_size, self.use_mmap)
+
+        scheme = uri.split(":", 1)[0].lower()
+        resp, content = self.h.request(uri, method, headers=headers, body=body,
+                                       connection_type=_CONNECTIONS.get(scheme))
+        return (http_layer.HttpLib2Response(resp), content)
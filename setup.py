@@ -30,5 +30,10 @@ DIP - Deposit Information Package, SWORDv2 client environment""",
     packages=find_packages(exclude=['tests']),
     include_package_data=True,
     zip_safe=False,
-    install_requires=["sword2", "lxml"]
+    install_requires=["sword2", "lxml"],
+    entry_points={
+        "dip.packagers" : [
+            "http://purl.org/net/sword/package/SimpleZip = dip.packagers:SimpleZipPackager"
+        ]
+    }
 )
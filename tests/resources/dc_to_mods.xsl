@@ -0,0 +1,21 @@
+<?xml version="1.0" encoding="UTF-8"?>
+<xsl:stylesheet version="1.0"
+    xmlns:xsl="http://www.w3.org/1999/XSL/Transform"
+    xmlns:dcterms="http://purl.org/dc/terms/"
+    xmlns:mods="http://www.loc.gov/mods/v3"
+    exclude-result-prefixes="dcterms">
+
+    <xsl:param name="genre" select="'text'"/>
+
+    <xsl:template match="/">
+        <mods:mods>
+            <xsl:for-each select="//dcterms:title">
+                <mods:titleInfo><mods:title><xsl:value-of select="."/></mods:title></mods:titleInfo>
+            </xsl:for-each>
+            <xsl:for-each select="//dcterms:creator">
+                <mods:name><mods:namePart><xsl:value-of select="."/></mods:namePart></mods:name>
+            </xsl:for-each>
+            <mods:genre><xsl:value-of select="$genre"/></mods:genre>
+        </mods:mods>
+    </xsl:template>
+</xsl:stylesheet>
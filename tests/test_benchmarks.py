@@ -0,0 +1,47 @@
+from . import TestController
+
+import os, json, shutil, imp
+
+WORK_DIR = "dip_benchmark_dir"
+BENCHMARKS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks")
+
+suite = imp.load_source("dip_benchmark_suite", os.path.join(BENCHMARKS, "suite.py"))
+
+class TestBenchmarks(TestController):
+
+    def _cleanup(self):
+        if os.path.isdir(WORK_DIR):
+            shutil.rmtree(WORK_DIR)
+
+    def setUp(self):
+        self._cleanup()
+
+    def tearDown(self):
+        self._cleanup()
+
+    def test_01_small_suite(self):
+        # a tiny run of every operation, to make sure the suite itself still works
+        # (including a deposit to the stand-in server from a DIP read back from disk)
+        os.makedirs(WORK_DIR)
+        seen = []
+        doc = suite.run_suite(os.path.abspath(WORK_DIR), suite.OPERATIONS, [10], ["large"], ["one"],
+                              timeout=120, progress=seen.append, large_count=1, large_mb=1)
+
+        assert len(doc["results"]) == len(suite.OPERATIONS)
+        assert len(seen) == len(suite.OPERATIONS)
+        for result in doc["results"]:
+            assert result["status"] == "ok", result
+            assert result["seconds"] >= 0
+            assert result["peak_rss_kb"] > 0
+            assert "dip_dir" not in result
+
+        byname = dict([(r["name"], r) for r in doc["results"]])
+        assert byname["set_file/10/large/one"]["items"] == suite.SET_FILE_SAMPLE
+        assert byname["get_state/10/large/one"]["items"] == 10
+        assert byname["package/10/large/one"]["bytes"] > 1024 * 1024
+        assert byname["deposit/10/large/one"]["items"] == 1
+
+        # the results can be compared against themselves
+        rows = suite.compare(doc, json.loads(json.dumps(doc)))
+        assert len(rows) == len(suite.OPERATIONS)
+        assert rows[0][3] == 1.0
@@ -0,0 +1,177 @@
+from . import TestController
+
+import dip
+import os, shutil, json
+
+BULK_DIR = "dip_bulk_dir"
+RESOURCES = os.path.join("tests", "resources")
+TESTFILE_MD5 = "6fd9af1196c0f77e463bf2dcfdbef852"
+TESTFILE2_MD5 = "8a86db9c36f1f7a0d8905afe3649b886"
+
+class TestBulk(TestController):
+
+    def _cleanup(self):
+        if os.path.isdir(BULK_DIR):
+            shutil.rmtree(BULK_DIR)
+
+    def setUp(self):
+        self._cleanup()
+        os.makedirs(BULK_DIR)
+
+    def tearDown(self):
+        self._cleanup()
+
+    def _write(self, name, content):
+        path = os.path.join(BULK_DIR, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_01_dip_batch(self):
+        d = dip.DIP(os.path.join(BULK_DIR, "one"))
+        deposit_file = os.path.join(d.base_dir, "deposit.json")
+        before = os.path.getmtime(deposit_file)
+        os.utime(deposit_file, (before - 10, before - 10))
+
+        with d.batch():
+            d.add_dublin_core("title", "A title")
+            d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+            # nothing has been written yet
+            assert len(dip.DIP(d.base_dir).get_files()) == 0
+            assert len(dip.DIP(d.base_dir).get_dublin_core()) == 0
+
+        d2 = dip.DIP(d.base_dir)
+        assert len(d2.get_files()) == 1
+        assert d2.get_dublin_core() == [("title", "A title", None)]
+
+        # and if the batch fails, nothing is written
+        try:
+            with d2.batch():
+                d2.add_dublin_core("creator", "Richard")
+                raise ValueError("stop")
+        except ValueError:
+            pass
+        assert len(dip.DIP(d.base_dir).get_dublin_core()) == 1
+
+    def test_02_import_csv(self):
+        testfile = os.path.abspath(os.path.join(RESOURCES, "testfile.txt"))
+        testfile2 = os.path.abspath(os.path.join(RESOURCES, "testfile2.txt"))
+        csv_file = self._write("import.csv",
+            "dip,dcterms:title@en,dcterms:creator,file,file\n" +
+            "one,A title,Richard|Mark," + testfile + "," + testfile2 + "\n" +
+            "two,Another title,,," + testfile + "\n" +
+            "three,Broken,,does-not-exist.txt,\n" +
+            ",No dip,,,\n")
+
+        importer = dip.BulkImporter(base_dir=BULK_DIR, processes=1)
+        report = importer.import_file(csv_file)
+
+        assert report.rows == 4
+        assert report.succeeded == 2
+        assert report.failed == 2
+        assert [e[0] for e in report.errors] == [4, 5]
+        assert report.rows_per_second > 0
+
+        one = dip.DIP(os.path.join(BULK_DIR, "one"))
+        assert one.get_dublin_core("title") == [("title", "A title", "en")]
+        assert one.get_dublin_core("creator") == [("creator", "Richard", None), ("creator", "Mark", None)]
+        assert sorted([f.md5 for f in one.get_files()]) == sorted([TESTFILE_MD5, TESTFILE2_MD5])
+
+        two = dip.DIP(os.path.join(BULK_DIR, "two"))
+        assert len(two.get_files()) == 1
+        assert len(two.get_dublin_core()) == 1
+
+    def test_03_import_jsonl_pool(self):
+        testfile = os.path.abspath(os.path.join(RESOURCES, "testfile.txt"))
+        lines = []
+        for i in range(20):
+            lines.append(json.dumps({"dip" : "dip" + str(i), "files" : [testfile],
+                                     "dcterms" : [["title", "Title " + str(i), "en"], ["creator", "Richard"]]}))
+        lines.append("{not json")
+        jsonl = self._write("import.jsonl", "\n".join(lines) + "\n")
+
+        reports = []
+        importer = dip.BulkImporter(base_dir=BULK_DIR, processes=2, chunk_size=8)
+        report = importer.import_file(jsonl, progress=reports.append)
+
+        assert report.rows == 21
+        assert report.succeeded == 20
+        assert report.errors[0][0] == 21
+        assert len(reports) == 3
+
+        d = dip.DIP(os.path.join(BULK_DIR, "dip7"))
+        assert d.get_dublin_core("title") == [("title", "Title 7", "en")]
+        assert len(d.get_files()) == 1
+
+        # importing again with replace does not duplicate the values
+        importer = dip.BulkImporter(base_dir=BULK_DIR, processes=1, replace=True)
+        importer.import_file(jsonl)
+        d = dip.DIP(os.path.join(BULK_DIR, "dip7"))
+        assert d.get_dublin_core("title") == [("title", "Title 7", "en")]
+        assert d.get_dublin_core("creator") == [("creator", "Richard", None)]
+
+    def test_04_import_jsonl_invalid_rows(self):
+        # rows which are valid json, but not of the right form, are reported like any other row error
+        lines = [
+            json.dumps({"dip" : "one", "dcterms" : [["title", "A title"]]}),
+            "[1,2]",
+            "null",
+            json.dumps({"dip" : "two", "dcterms" : [5]}),
+            json.dumps({"dip" : "two", "dcterms" : [["title"]]}),
+            json.dumps({"dip" : "two", "dcterms" : "title"}),
+            json.dumps({"dip" : ["two"]}),
+            json.dumps({"dip" : "two", "files" : "a.pdf"}),
+            "{not json",
+            json.dumps({"dip" : "three", "dcterms" : [["title", "Another title", "en"]]})
+        ]
+        jsonl = self._write("import.jsonl", "\n".join(lines) + "\n")
+        report = dip.BulkImporter(base_dir=BULK_DIR, processes=1).import_file(jsonl)
+
+        assert report.rows == 10
+        assert report.succeeded == 2
+        assert [e[0] for e in report.errors] == range(2, 10)
+        assert "expected an object, not list" in report.errors[0][2]
+        assert "dcterms value" in report.errors[2][2]
+        assert report.errors[-1][2].startswith("invalid json")
+        assert dip.DIP(os.path.join(BULK_DIR, "three")).get_dublin_core("title") == [("title", "Another title", "en")]
+        assert not os.path.exists(os.path.join(BULK_DIR, "two"))
+
+    def test_05_rows_for_one_dip_pool(self):
+        # many rows for the same DIPs, spread through the file, are all applied
+        testfile = os.path.abspath(os.path.join(RESOURCES, "testfile.txt"))
+        lines = []
+        for i in range(40):
+            lines.append(json.dumps({"dip" : "dip" + str(i % 3), "dcterms" : [["identifier", "id" + str(i)]],
+                                     "files" : [testfile] if i < 3 else []}))
+        jsonl = self._write("import.jsonl", "\n".join(lines) + "\n")
+
+        importer = dip.BulkImporter(base_dir=BULK_DIR, processes=4, chunk_size=25)
+        report = importer.import_file(jsonl)
+
+        assert report.rows == 40
+        assert report.failed == 0, report.errors
+        for n in range(3):
+            d = dip.DIP(os.path.join(BULK_DIR, "dip" + str(n)))
+            # in the order of the rows
+            assert [v[1] for v in d.get_dublin_core("identifier")] == ["id" + str(i) for i in range(n, 40, 3)]
+            assert len(d.get_files()) == 1
+
+    def test_06_import_csv_encoding(self):
+        csv_file = self._write("import.csv",
+            "\xef\xbb\xbfdip,dcterms:creator,dcterms:title\n" +
+            "one,M\xc3\xbcller|\xe5\xbc\xa0\xe4\xbc\x9f,Caf\xc3\xa9\n" +
+            "two,M\xfcller,\n")
+        report = dip.BulkImporter(base_dir=BULK_DIR, processes=1).import_file(csv_file)
+        assert report.succeeded == 1
+        assert [e[0] for e in report.errors] == [3]
+
+        one = dip.DIP(os.path.join(BULK_DIR, "one"))
+        assert one.get_dublin_core("creator") == [("creator", u"M\xfcller", None), ("creator", u"\u5f20\u4f1f", None)]
+        assert one.get_dublin_core("title") == [("title", u"Caf\xe9", None)]
+
+        # in another encoding
+        latin1 = self._write("latin1.csv", "dip,dcterms:creator\nthree,M\xfcller\n")
+        report = dip.BulkImporter(base_dir=BULK_DIR, processes=1, encoding="latin-1").import_file(latin1)
+        assert report.failed == 0, report.errors
+        three = dip.DIP(os.path.join(BULK_DIR, "three"))
+        assert three.get_dublin_core("creator") == [("creator", u"M\xfcller", None)]
@@ -0,0 +1,156 @@
+from . import TestController
+
+import dip
+from dip.standin import StandInServer, SIMPLE_ZIP
+import os, shutil, time, glob
+
+DIP_DIR = "dip_test_dir"
+RESOURCES = os.path.join("tests", "resources")
+
+class TestCache(TestController):
+
+    def _cleanup(self):
+        if os.path.isdir(DIP_DIR):
+            shutil.rmtree(DIP_DIR)
+
+    def setUp(self):
+        self._cleanup()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        self._cleanup()
+
+    def _dip(self, **kwargs):
+        d = dip.DIP(DIP_DIR, **kwargs)
+        self.content = os.path.join(DIP_DIR, "content.txt")
+        with open(self.content, "wb") as f:
+            f.write("some content")
+        d.set_file(self.content)
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        return d
+
+    def _change(self, d, content, mtime=None):
+        with open(self.content, "wb") as f:
+            f.write(content)
+        if mtime is not None:
+            os.utime(self.content, (mtime, mtime))
+        d.set_file(self.content)
+
+    def _packages(self):
+        return glob.glob(os.path.join(DIP_DIR, "packages", "*", "*", dip.cache.INFO_FILE))
+
+    def test_01_reuse(self):
+        metrics = dip.CollectingMetrics()
+        d = self._dip(metrics=metrics)
+        first = d.package(package_format=SIMPLE_ZIP)
+        second = d.package(package_format=SIMPLE_ZIP)
+        assert first.path == second.path
+        assert os.path.isfile(second.path)
+        assert sorted(second.file_paths) == sorted(first.file_paths)
+        assert second.metadata_formats == first.metadata_formats
+        assert second.package_dir == os.path.dirname(second.path)
+        assert metrics.get_counter("dip_package_cache_requests_total", result="miss") == 1
+        assert metrics.get_counter("dip_package_cache_requests_total", result="hit") == 1
+        assert metrics.get_histogram("dip_package_seconds", format=SIMPLE_ZIP)[0] == 1
+
+        # a new DIP object over the same directory finds it too
+        d = dip.DIP(DIP_DIR)
+        assert d.package(package_format=SIMPLE_ZIP).path == first.path
+
+        # different packager arguments make a different package
+        md_only = d.package(package_format=SIMPLE_ZIP, deposit_files=False)
+        assert md_only.path != first.path
+        assert md_only.file_paths == []
+
+    def test_02_changes(self):
+        d = self._dip()
+        first = d.package(package_format=SIMPLE_ZIP)
+        self._change(d, "some different content")
+        second = d.package(package_format=SIMPLE_ZIP)
+        assert second.path != first.path
+        # the old one is still there, in case it is still being sent somewhere
+        assert os.path.isfile(first.path)
+
+        # a metadata change makes a new package too
+        time.sleep(0.01)
+        d.add_dublin_core("title", "A title")
+        third = d.package(package_format=SIMPLE_ZIP)
+        assert third.path not in [first.path, second.path]
+        assert len(self._packages()) == 3
+
+    def test_03_shared_between_endpoints(self):
+        self.server = StandInServer(keep_content=True).start()
+        metrics = dip.CollectingMetrics()
+        d = self._dip(metrics=metrics)
+        for i in range(2):
+            e = dip.Endpoint(sd_iri=self.server.sd_iri, col_iri=self.server.col_iri(), package=SIMPLE_ZIP)
+            d.set_endpoint(endpoint=e)
+        for e in d.get_endpoints():
+            cm, receipt = d.deposit(e.id)
+            assert receipt.code == 201
+        assert metrics.get_counter("dip_package_cache_requests_total", result="miss") == 1
+        assert metrics.get_counter("dip_package_cache_requests_total", result="hit") == 1
+        assert self.server.get_container("1").content == self.server.get_container("2").content
+
+        # a package which the packager cleans up is dropped from the cache
+        e = d.get_endpoints()[0]
+        d.deposit(e.id, remove_zip=True)
+        assert len(self._packages()) == 1
+        d.deposit(e.id, remove_zip=True)
+        assert metrics.get_counter("dip_package_cache_requests_total", result="miss") == 3
+
+    def test_04_eviction(self):
+        d = self._dip()
+        infos = []
+        for i in range(6):
+            self._change(d, "content " + str(i), 1000000000 + i)
+            infos.append(d.package(package_format=SIMPLE_ZIP))
+        # four are kept by default, the most recent
+        assert len(self._packages()) == 4
+        assert not os.path.exists(infos[0].path)
+        assert not os.path.exists(infos[1].path)
+
+        # using a package makes it the most recent
+        self._change(d, "content 2", 1000000002)
+        assert d.package(package_format=SIMPLE_ZIP).path == infos[2].path
+        d.set_package_cache_policy(max_packages=2)
+        remaining = [i for i in infos if os.path.exists(i.path)]
+        assert [i.path for i in remaining] == [infos[2].path, infos[5].path]
+
+        # by size, the one just asked for always survives
+        d.set_package_cache_policy(max_packages=10, max_bytes=1)
+        assert len(self._packages()) == 0
+        self._change(d, "content 7")
+        info = d.package(package_format=SIMPLE_ZIP)
+        assert os.path.isfile(info.path)
+        assert len(self._packages()) == 1
+
+        # by age
+        d.set_package_cache_policy(max_bytes=10 ** 9, max_age_days=1)
+        packages = d._package_cache
+        assert packages.evict(now=time.time() + 3600) == []
+        assert packages.evict(now=time.time() + 2 * 86400) == [os.path.basename(info.package_dir)]
+
+    def test_05_disabled_and_interrupted(self):
+        d = self._dip()
+        d.set_package_cache_policy(enabled=False)
+        info = d.package(package_format=SIMPLE_ZIP)
+        assert info.path == os.path.join(d._package_dir(SIMPLE_ZIP), "SimpleZip.zip")
+        assert len(self._packages()) == 0
+        d.set_package_cache_policy(enabled=True)
+
+        # a build which died part way through is ignored, and cleared up once it is old
+        subdir = os.path.basename(d._package_dir(SIMPLE_ZIP))
+        key = d._package_key(SIMPLE_ZIP, {})
+        partial = os.path.join(DIP_DIR, "packages", subdir, key)
+        os.makedirs(partial)
+        stale = partial + ".tmp.1.1"
+        os.makedirs(stale)
+        info = d.package(package_format=SIMPLE_ZIP)
+        assert info.package_dir == partial
+        assert os.path.isfile(os.path.join(partial, dip.cache.INFO_FILE))
+        assert os.path.isdir(stale)
+        d._package_cache.evict(now=time.time() + 2 * 86400)
+        assert not os.path.isdir(stale)
@@ -688,6 +688,40 @@ class TestDIP(TestController):
         a = d.get_dublin_core()
         assert len(a) == 0
         
+    def test_25a_bulk_dc(self):
+        d = dip.DIP(DIP_DIR)
+        
+        d.add_dublin_core_many([("identifier", "123456"), ("title", "A title", "en"), ("title", "Titlen", "no")] +
+                                [("creator", "Creator " + str(i)) for i in range(500)])
+        
+        # everything has been written in one go
+        d2 = dip.DIP(DIP_DIR)
+        assert len(d2.get_dublin_core()) == 503
+        assert len(d2.get_dublin_core("creator")) == 500
+        assert d2.get_dublin_core("creator")[0] == ("creator", "Creator 0", None)
+        assert d2.get_dublin_core("creator")[-1] == ("creator", "Creator 499", None)
+        assert d2.get_dublin_core("title", lang="no") == [("title", "Titlen", "no")]
+        assert d2.get_dublin_core("creator", "Creator 250") == [("creator", "Creator 250", None)]
+        
+        # replace all the creators
+        d2.replace_dublin_core("creator", ["Richard", "Mark"])
+        assert d2.get_dublin_core("creator") == [("creator", "Richard", None), ("creator", "Mark", None)]
+        
+        # replace the title in one language only
+        d2.replace_dublin_core("title", "Tittel", lang="no")
+        assert d2.get_dublin_core("title", lang="no") == [("title", "Tittel", "no")]
+        assert d2.get_dublin_core("title", lang="en") == [("title", "A title", "en")]
+        
+        # removal keeps the index in step with the xml
+        d2.remove_dublin_core("creator", "Mark")
+        assert d2.get_dublin_core("creator") == [("creator", "Richard", None)]
+        d2.remove_dublin_core(lang="en")
+        assert d2.get_dublin_core("title") == [("title", "Tittel", "no")]
+        
+        d3 = dip.DIP(DIP_DIR)
+        assert d3.get_dublin_core() == d2.get_dublin_core()
+        assert len(d3.get_dublin_core()) == 3
+    
     def test_26_comms_meta_init(self):
         d = dip.DIP(DIP_DIR)
         
@@ -805,6 +839,30 @@ class TestDIP(TestController):
     def test_29_comms_meta_body(self):
         pass
     
+    def test_30_metadata_entry_cache(self):
+        d = dip.DIP(DIP_DIR)
+        d.add_dublin_core("title", "A title", "en")
+        mdf = d.get_metadata_file("dcterms")
+        
+        # the serialised entry is built once and then reused
+        e1 = d._metadata_entry(mdf)
+        assert "A title" in e1
+        e2 = d._metadata_entry(mdf)
+        assert e1 is e2
+        
+        # but is rebuilt when the metadata changes
+        d.add_dublin_core("creator", "Richard")
+        e3 = d._metadata_entry(mdf)
+        assert e3 is not e1
+        assert "Richard" in e3
+        
+        # as well as when the file is changed from outside
+        with open(mdf.path, "wb") as f:
+            f.write("<metadata xmlns:dcterms='http://purl.org/dc/terms/'><dcterms:title>Other</dcterms:title></metadata>")
+        e4 = d._metadata_entry(mdf)
+        assert "Other" in e4
+        assert "Richard" not in e4
+    
     def text_100_full_dip(self):
         # create the DIP
         d = dip.DIP(DIP_DIR)
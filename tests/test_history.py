@@ -0,0 +1,366 @@
+from . import TestController
+
+import dip
+from dip import history
+from lxml import etree
+from StringIO import StringIO
+import datetime, os, shutil, threading
+
+DIP_DIR = "dip_test_dir"
+HISTORY_DIR = os.path.join(DIP_DIR, "history", "1234")
+
+class TestHistory(TestController):
+
+    def _cleanup(self):
+        # cleanup the DIP directory
+        if os.path.isdir(DIP_DIR):
+            shutil.rmtree(DIP_DIR)
+        elif os.path.isfile(DIP_DIR):
+            os.remove(DIP_DIR)
+
+    def setUp(self):
+        self._cleanup()
+
+    def tearDown(self):
+        self._cleanup()
+
+    def _size(self, directory):
+        return sum([os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory)])
+
+    def _raw(self, ts, type="request", method="POST"):
+        return {"timestamp" : ts, "type" : type, "method" : method, "request_url" : "http://col"}
+
+    def test_01_append_and_read(self):
+        store = history.HistoryStore(HISTORY_DIR)
+        e1 = store.append(self._raw("2013-01-01T00:00:00.000000Z"), "<entry/>")
+        e2 = store.append(self._raw("2013-01-01T00:00:00.000000Z", type="response"))
+
+        # all the history lives in a handful of files
+        assert sorted(os.listdir(HISTORY_DIR)) == ["body-000001.dat", "index.jsonl", "segment-000001.jsonl"]
+
+        entries = store.entries()
+        assert len(entries) == 2
+        # they are the entries append returned, which also counted what it wrote
+        assert dict(entries[0], written=e1["written"]) == e1
+        assert dict(entries[1], written=e2["written"]) == e2
+
+        r1 = store.read_record(e1)
+        assert r1["method"] == "POST"
+        assert r1["type"] == "request"
+        assert store.read_body(r1) == "<entry/>"
+
+        r2 = store.read_record(e2)
+        assert r2["type"] == "response"
+        assert store.read_body(r2) is None
+
+    def test_02_filter_entries(self):
+        store = history.HistoryStore(HISTORY_DIR)
+        store.append(self._raw("2013-01-01T00:00:00.000000Z", method="POST"))
+        store.append(self._raw("2013-01-02T00:00:00.000000Z", method="PUT"))
+        store.append(self._raw("2013-01-03T00:00:00.000000Z", method="DELETE"))
+
+        assert len(store.entries(method="PUT")) == 1
+        assert len(store.entries(since=datetime.datetime(2013, 1, 2))) == 2
+        assert len(store.entries(until="2013-01-02T00:00:00.000000Z")) == 2
+        assert len(store.entries(since=datetime.datetime(2013, 1, 2), method="POST")) == 0
+
+        # a new store on the same directory sees the same index
+        store2 = history.HistoryStore(HISTORY_DIR)
+        assert len(store2.entries()) == 3
+
+    def test_03_segment_rollover(self):
+        store = history.HistoryStore(HISTORY_DIR, segment_size=100)
+        for i in range(5):
+            store.append(self._raw("2013-01-01T00:00:0" + str(i) + ".000000Z"), "x" * 80)
+
+        entries = store.entries()
+        assert len(entries) == 5
+        assert len(set([e["segment"] for e in entries])) == 5
+        for e in entries:
+            assert store.read_body(store.read_record(e)) == "x" * 80
+
+    def test_04_rebuild_index(self):
+        store = history.HistoryStore(HISTORY_DIR, segment_size=100)
+        for i in range(3):
+            store.append(self._raw("2013-01-01T00:00:0" + str(i) + ".000000Z"), "x" * 80)
+        before = store.entries()
+
+        os.remove(store.index_file)
+        store2 = history.HistoryStore(HISTORY_DIR)
+        assert len(store2.entries()) == 0
+        store2.rebuild_index()
+        assert store2.entries() == before
+
+    def test_05_import_legacy(self):
+        d = dip.DIP(DIP_DIR)
+        e1 = dip.Endpoint(sd_iri="sd", col_iri="col", id="1234")
+        d.set_endpoint(endpoint=e1)
+
+        cm = dip.CommsMeta(d, e1, type="request", method="POST")
+        cm.write_body_file("<entry/>")
+        cm.save()
+
+        store = history.HistoryStore(HISTORY_DIR)
+        assert store.import_legacy(remove=True) == 1
+        assert not os.path.exists(cm.meta_file)
+        assert not os.path.exists(cm.body_file)
+
+        records = list(d.get_history("1234"))
+        assert len(records) == 1
+        assert records[0].timestamp == cm.timestamp
+        assert records[0].read_body() == "<entry/>"
+
+        # a DIP moves legacy history into the store the first time it opens it
+        cm2 = dip.CommsMeta(d, e1, type="response", method="POST", timestamp=cm.timestamp)
+        cm2.write_body_file("<receipt/>")
+        cm2.save()
+        d = dip.DIP(DIP_DIR)
+        records = list(d.get_history("1234"))
+        assert len(records) == 2
+        assert records[1].read_body() == "<receipt/>"
+        assert not os.path.exists(cm2.meta_file)
+        assert [f for f in os.listdir(HISTORY_DIR) if "_meta" in f or "_body" in f] == []
+        assert len(dip.DIP(DIP_DIR).get_history("1234")) == 2
+
+    def test_06_dip_get_history(self):
+        d = dip.DIP(DIP_DIR)
+        e1 = dip.Endpoint(sd_iri="sd", col_iri="col", id="1234")
+        d.set_endpoint(endpoint=e1)
+
+        req = dip.CommsMeta(d, e1, type="request", method="POST", request_url="col")
+        d._record_history(req, "<entry/>")
+        resp = dip.CommsMeta(d, e1, timestamp=req.timestamp, type="response", method="POST", request_url="col", response_code=201)
+        d._record_history(resp, "<receipt/>")
+        req2 = dip.CommsMeta(d, e1, type="request", method="DELETE", request_url="edit")
+        d._record_history(req2)
+
+        h = d.get_history("1234")
+        assert len(h) == 3
+
+        records = list(h)
+        assert records[0].type == "request"
+        assert records[0].timestamp == req.timestamp
+        assert records[0].read_body() == "<entry/>"
+        assert records[1].response_code == 201
+        assert records[1].read_body() == "<receipt/>"
+        assert records[2].read_body() is None
+
+        assert len(d.get_history("1234", method="DELETE")) == 1
+        assert len(d.get_history("1234", since=req2.timestamp)) == 1
+        assert len(d.get_history("1234", until=req.timestamp)) == 2
+
+    def test_07_dedupe(self):
+        store = history.HistoryStore(HISTORY_DIR)
+        e1 = store.append(self._raw("2013-01-01T00:00:00.000000Z"), "<entry/>")
+        size = self._size(HISTORY_DIR)
+        e2 = store.append(self._raw("2013-01-02T00:00:00.000000Z"), "<entry/>")
+        assert e1["body"] == e2["body"]
+        assert os.path.getsize(os.path.join(HISTORY_DIR, "body-000001.dat")) == len("<entry/>")
+        # each append counts what it wrote, which for the second is only its record and index line
+        assert e1["written"] == size
+        assert e2["written"] == self._size(HISTORY_DIR) - size
+        assert e2["written"] < e1["written"]
+
+        store = history.HistoryStore(os.path.join(DIP_DIR, "history", "5678"), policy=history.HistoryPolicy({"dedupe" : False}))
+        e1 = store.append(self._raw("2013-01-01T00:00:00.000000Z"), "<entry/>")
+        e2 = store.append(self._raw("2013-01-02T00:00:00.000000Z"), "<entry/>")
+        assert e1["body"] != e2["body"]
+
+    def test_08_compact_retention(self):
+        policy = history.HistoryPolicy({"keep_last" : 2})
+        store = history.HistoryStore(HISTORY_DIR, policy=policy)
+        for i in range(4):
+            ts = "2013-01-0" + str(i + 1) + "T00:00:00.000000Z"
+            store.append(self._raw(ts, type="request"), "<entry>" + str(i) + "</entry>")
+            store.append(self._raw(ts, type="response"), "<receipt/>")
+
+        stats = store.compact(now=datetime.datetime(2013, 1, 5))
+        assert stats["records_before"] == 8
+        assert stats["records_after"] == 4
+
+        entries = store.entries()
+        assert len(entries) == 4
+        assert entries[0]["timestamp"] == "2013-01-03T00:00:00.000000Z"
+        assert store.read_body(store.read_record(entries[0])) == "<entry>2</entry>"
+        assert store.read_body(store.read_record(entries[3])) == "<receipt/>"
+
+        # the old segments have gone, and appends carry on after the compacted one
+        assert not os.path.exists(os.path.join(HISTORY_DIR, "segment-000001.jsonl"))
+        e = store.append(self._raw("2013-01-05T00:00:00.000000Z"), "<entry>4</entry>")
+        assert e["segment"] > entries[0]["segment"]
+        assert len(history.HistoryStore(HISTORY_DIR).entries()) == 5
+
+        store.policy = history.HistoryPolicy({"keep_days" : 1})
+        store.compact(now=datetime.datetime(2013, 1, 5, 12))
+        assert len(store.entries()) == 1
+
+    def test_09_compact_compression(self):
+        policy = history.HistoryPolicy({"compress_after_days" : 1})
+        store = history.HistoryStore(HISTORY_DIR, policy=policy)
+        body = "<entry>" + ("x" * 1000) + "</entry>"
+        store.append(self._raw("2013-01-01T00:00:00.000000Z"), body)
+        store.append(self._raw("2013-01-10T00:00:00.000000Z"), body + " ")
+
+        stats = store.compact(now=datetime.datetime(2013, 1, 10, 12))
+        assert stats["bytes_after"] < stats["bytes_before"]
+
+        entries = store.entries()
+        assert entries[0]["body"]["encoding"] == "gzip"
+        assert entries[1]["body"]["encoding"] == "identity"
+        assert store.read_body(store.read_record(entries[0])) == body
+        assert store.read_body(entries[1]) == body + " "
+
+    def test_10_dip_history_policy(self):
+        d = dip.DIP(DIP_DIR)
+        e1 = dip.Endpoint(sd_iri="sd", col_iri="col", id="1234")
+        d.set_endpoint(endpoint=e1)
+
+        d.set_history_policy(keep_days=30)
+        d.set_history_policy(endpoint_id="1234", keep_last=1)
+        assert d.deposit_info_raw["history"]["keep_days"] == 30
+
+        policy = d.get_history_policy("1234")
+        assert policy.keep_days == 30
+        assert policy.keep_last == 1
+        assert d.get_history_policy().keep_last is None
+
+        for i in range(3):
+            req = dip.CommsMeta(d, e1, type="request", method="POST", request_url="col")
+            d._record_history(req, "<entry/>")
+            resp = dip.CommsMeta(d, e1, timestamp=req.timestamp, type="response", method="POST", request_url="col", response_code=201)
+            d._record_history(resp)
+
+        t = d.compact_history()
+        t.join()
+        assert t.results["1234"]["records_after"] == 2
+        assert len(d.get_history("1234")) == 2
+
+    def test_11_background_writer(self):
+        d = dip.DIP(DIP_DIR, background_history=True, history_queue_size=2)
+        e1 = dip.Endpoint(sd_iri="sd", col_iri="col", id="1234")
+        d.set_endpoint(endpoint=e1)
+
+        for i in range(10):
+            req = dip.CommsMeta(d, e1, type="request", method="POST", request_url="col")
+            d._record_history(req, "<entry>" + str(i) + "</entry>")
+            # changes after the record has been submitted do not leak into history
+            req.method = "PUT"
+
+        # and nor do changes to an lxml body
+        entry = etree.fromstring("<entry>original</entry>")
+        d._record_history(dip.CommsMeta(d, e1, type="response", method="POST", request_url="col"), entry)
+        entry.text = "changed"
+
+        d.flush_history()
+        records = list(history.HistoryStore(HISTORY_DIR).entries())
+        assert len(records) == 11
+        assert len(d.get_history("1234", method="POST")) == 11
+        assert history.HistoryStore(HISTORY_DIR).read_body(records[-1]) == "<entry>original</entry>"
+
+        # closing the DIP stops its writer, and history is then written directly
+        writer = d._history_writer
+        d.close()
+        assert writer.closed
+        assert not writer._thread.is_alive()
+        assert writer not in history._open_writers
+        d._record_history(dip.CommsMeta(d, e1, type="request", method="POST", request_url="col"), "<entry/>")
+        assert len(history.HistoryStore(HISTORY_DIR).entries()) == 12
+
+        # as does leaving a with block, so DIPs opened one after another don't leave threads behind
+        threads = threading.active_count()
+        for i in range(5):
+            with dip.DIP(DIP_DIR, background_history=True) as d:
+                d._record_history(dip.CommsMeta(d, e1, type="request", method="POST", request_url="col"), "<entry/>")
+        assert threading.active_count() == threads
+        assert len(history.HistoryStore(HISTORY_DIR).entries()) == 17
+
+    def test_12_background_writer_errors(self):
+        writer = history.HistoryWriter()
+        os.makedirs(DIP_DIR)
+        with open(os.path.join(DIP_DIR, "notadir"), "wb") as f:
+            f.write("x")
+        store = history.HistoryStore(os.path.join(DIP_DIR, "notadir"))
+        writer.submit(store, self._raw("2013-01-01T00:00:00.000000Z"))
+        with self.assertRaises(history.HistoryException):
+            writer.flush()
+
+        # once reported, the errors are cleared
+        writer.flush()
+        writer.close()
+        with self.assertRaises(history.HistoryException):
+            writer.submit(store, self._raw("2013-01-01T00:00:00.000000Z"))
+
+    def test_13_stream_bodies(self):
+        store = history.HistoryStore(HISTORY_DIR)
+
+        # an lxml element is serialised straight into the store
+        xml = etree.fromstring("<receipt><id>1234</id></receipt>")
+        e1 = store.append(self._raw("2013-01-01T00:00:00.000000Z"), xml)
+        assert store.read_body(e1) == "<receipt><id>1234</id></receipt>"
+
+        # and a file-like object is read from in chunks
+        e2 = store.append(self._raw("2013-01-02T00:00:00.000000Z"), StringIO("x" * (history.CHUNK_SIZE * 3 + 1)))
+        assert store.read_body(e2) == "x" * (history.CHUNK_SIZE * 3 + 1)
+
+    def test_14_body_size_limit(self):
+        policy = history.HistoryPolicy({"max_body_size" : 10, "dedupe" : False})
+        store = history.HistoryStore(HISTORY_DIR, policy=policy)
+
+        e1 = store.append(self._raw("2013-01-01T00:00:00.000000Z"), "0123456789abcdef")
+        assert e1["body"]["truncated"]
+        assert e1["body"]["original_length"] == 16
+        assert store.read_body(e1) == "0123456789"
+
+        e2 = store.append(self._raw("2013-01-01T00:00:00.000000Z"), "0123456789")
+        assert "truncated" not in e2["body"]
+        assert store.read_body(e2) == "0123456789"
+
+        policy.raw["oversize"] = "summarise"
+        xml = etree.fromstring("<receipt><id>1234</id></receipt>")
+        e3 = store.append(self._raw("2013-01-01T00:00:00.000000Z"), xml)
+        assert e3["body"]["summary"]
+        assert e3["body"]["root"] == "receipt"
+        assert e3["body"]["original_length"] == len("<receipt><id>1234</id></receipt>")
+        assert store.read_body(e3) is None
+        assert os.path.getsize(os.path.join(HISTORY_DIR, "body-000001.dat")) == 20
+
+    def test_15_body_compression(self):
+        policy = history.HistoryPolicy({"body_compression" : "gzip"})
+        store = history.HistoryStore(HISTORY_DIR, policy=policy)
+        body = "<entry>" + ("x" * 10000) + "</entry>"
+        e1 = store.append(self._raw("2013-01-01T00:00:00.000000Z"), body)
+        assert e1["body"]["encoding"] == "gzip"
+        assert e1["body"]["length"] < len(body)
+        assert store.read_body(e1) == body
+
+        # compaction leaves already compressed bodies alone
+        store.policy = history.HistoryPolicy({"compress_after_days" : 0})
+        store.compact()
+        assert store.read_body(store.entries()[0]) == body
+
+    def test_16_append_during_compaction(self):
+        store = history.HistoryStore(HISTORY_DIR)
+        store.append(self._raw("2013-01-01T00:00:00.000000Z"), "<entry/>")
+
+        # append the same body while the compaction is copying the records
+        appended = []
+        read_record = store.read_record
+        def append_then_read(entry):
+            if len(appended) == 0:
+                appended.append(store.append(self._raw("2013-01-02T00:00:00.000000Z"), "<entry/>"))
+            return read_record(entry)
+        store.read_record = append_then_read
+        store.compact()
+        del store.read_record
+
+        assert not os.path.exists(os.path.join(HISTORY_DIR, "body-000001.dat"))
+        entries = store.entries()
+        assert len(entries) == 2
+        assert entries[1]["body"]["segment"] == appended[0]["body"]["segment"] > 1
+        for e in entries:
+            assert store.read_body(e) == "<entry/>"
+            assert store.read_body(store.read_record(e)) == "<entry/>"
+
+        # and once it's done, appends share the compacted bodies again
+        e = store.append(self._raw("2013-01-03T00:00:00.000000Z"), "<entry/>")
+        assert e["body"] in [entries[0]["body"], entries[1]["body"]]
@@ -0,0 +1,143 @@
+from . import TestController
+
+import dip
+from dip.standin import StandInServer, SIMPLE_ZIP
+import os, shutil, glob, time, threading
+
+DIP_DIR = "dip_test_dir"
+
+class TestHttpCache(TestController):
+
+    def _cleanup(self):
+        if os.path.isdir(DIP_DIR):
+            shutil.rmtree(DIP_DIR)
+
+    def setUp(self):
+        self._cleanup()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        self._cleanup()
+
+    def _dip(self):
+        self.server = StandInServer().start()
+        self.metrics = dip.CollectingMetrics()
+        d = dip.DIP(DIP_DIR, metrics=self.metrics)
+        for i in range(2):
+            path = os.path.join(DIP_DIR, "file" + str(i) + ".txt")
+            self._write(path, "content " + str(i))
+            d.set_file(path)
+        e = dip.Endpoint(sd_iri=self.server.sd_iri, col_iri=self.server.col_iri(), package=SIMPLE_ZIP)
+        d.set_endpoint(endpoint=e)
+        d.deposit(e.id)
+        return d, e.id
+
+    def _write(self, path, content):
+        with open(path, "wb") as f:
+            f.write(content)
+
+    def _requests(self):
+        return self.server.stats["requests"]
+
+    def _cached(self, eid):
+        return glob.glob(os.path.join(DIP_DIR, "http_cache", eid, "*.json"))
+
+    def _count(self, result):
+        return self.metrics.get_counter("dip_http_cache_requests_total", result=result)
+
+    def test_01_conditional_get(self):
+        d, eid = self._dip()
+        first = d.get_repository_statement(eid)
+        # the receipt and the statement
+        assert len(self._cached(eid)) == 2
+        assert self._count("miss") == 2
+
+        before = self._requests()
+        second = d.get_repository_statement(eid)
+        assert self._requests() == before + 2
+        assert self.server.stats["statuses"].get(304) == 2
+        assert self._count("revalidated") == 2
+        assert [r.uri for r in second.resources] == [r.uri for r in first.resources]
+        assert second.states == first.states
+
+        # a change on the server is seen
+        container = self.server.get_container(os.path.basename(d.get_endpoint(eid).edit_iri))
+        container.in_progress = True
+        third = d.get_repository_statement(eid)
+        assert third.states != first.states
+        assert self.server.stats["statuses"].get(304) == 3
+
+    def test_02_ttl(self):
+        d, eid = self._dip()
+        d.set_http_cache_policy(ttl=60)
+        assert d.get_http_cache_policy(eid).ttl == 60
+        d.get_repository_statement(eid)
+        before = self._requests()
+        for i in range(3):
+            statement = d.get_repository_statement(eid)
+            assert len(statement.resources) > 0
+        assert self._requests() == before
+        assert self._count("hit") == 6
+
+        # a reconciliation runs from the cache too
+        assert d.reconcile(eid).in_sync
+        assert self._requests() == before
+
+        # and an update deposit only needs to send the package
+        d.deposit(eid)
+        assert self._requests() == before + 1
+        # which clears the cache, so the next statement comes from the server
+        assert self._cached(eid) == []
+        d.get_repository_statement(eid)
+        assert self._requests() == before + 3
+
+        # expired responses are revalidated
+        d.set_http_cache_policy(eid, ttl=0.5)
+        time.sleep(0.6)
+        d.get_repository_statement(eid)
+        assert self._requests() == before + 5
+        assert self._count("revalidated") == 2
+
+    def test_03_disabled(self):
+        d, eid = self._dip()
+        d.set_http_cache_policy(eid, enabled=False)
+        assert d.get_http_cache_policy().enabled
+        assert not d.get_http_cache_policy(eid).enabled
+        before = self._requests()
+        d.get_repository_statement(eid)
+        d.get_repository_statement(eid)
+        assert self._requests() == before + 4
+        assert self.server.stats["statuses"].get(304) is None
+        assert self._cached(eid) == []
+
+        # removing an endpoint removes its cache
+        d.set_http_cache_policy(eid, enabled=True)
+        d.get_repository_statement(eid)
+        assert len(self._cached(eid)) == 2
+        d.remove_endpoint(eid)
+        assert not os.path.exists(os.path.join(DIP_DIR, "http_cache", eid))
+
+    def test_04_clear_while_writing(self):
+        cache = dip.ResponseCache(os.path.join(DIP_DIR, "http_cache", "e"))
+        errors = []
+        def write(n):
+            try:
+                for i in range(50):
+                    uri = "http://example.com/" + str(n) + "/" + str(i)
+                    cache.put(uri, None, 200, {"etag" : '"' + str(i) + '"'}, "content " + str(i))
+                    got = cache.get(uri)
+                    assert got is None or got[1] == "content " + str(i)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        while any([t.is_alive() for t in threads]):
+            cache.clear()
+        for t in threads:
+            t.join()
+        assert errors == [], errors
+        # nothing is left behind but the cache itself
+        assert os.listdir(os.path.join(DIP_DIR, "http_cache")) in [[], ["e"]]
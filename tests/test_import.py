@@ -0,0 +1,66 @@
+from . import TestController
+
+import dip
+import os, sys, shutil, subprocess
+
+DIP_DIR = "dip_test_dir"
+RESOURCES = os.path.join("tests", "resources")
+
+# the modules which must not be imported by local-only operations on a DIP
+HEAVY_MODULES = ["sword2", "httplib2", "lxml", "multiprocessing", "zipfile", "uuid",
+                 "hashlib", "ssl", "socket", "tempfile"]
+
+CHILD = """
+import sys
+import dip
+d = dip.DIP(sys.argv[1])
+d.set_file(sys.argv[2])
+d.get_state()
+print " ".join(sorted(set([m.split(".")[0] for m in sys.modules if sys.modules[m] is not None])))
+"""
+
+class TestImport(TestController):
+
+    def _cleanup(self):
+        if os.path.isdir(DIP_DIR):
+            shutil.rmtree(DIP_DIR)
+        elif os.path.isfile(DIP_DIR):
+            os.remove(DIP_DIR)
+
+    def setUp(self):
+        self._cleanup()
+
+    def tearDown(self):
+        self._cleanup()
+
+    def _child_modules(self):
+        # run in a fresh interpreter, so nothing we have already imported counts
+        out = subprocess.check_output([sys.executable, "-c", CHILD, DIP_DIR, os.path.join(RESOURCES, "testfile.txt")])
+        return out.strip().splitlines()[-1].split(" ")
+
+    def test_01_local_operations_are_light(self):
+        # set up a DIP with an endpoint and some dublin core first, so that the child
+        # has some state to look at
+        d = dip.DIP(DIP_DIR)
+        d.set_endpoint(sd_iri="sd", col_iri="col", package="package")
+        d.add_dublin_core("title", "A title")
+
+        modules = self._child_modules()
+        assert "dip" in modules
+        heavy = [m for m in HEAVY_MODULES if m in modules]
+        assert len(heavy) == 0, heavy
+
+        # and the work got done
+        d = dip.DIP(DIP_DIR)
+        assert len(d.get_files()) == 1
+
+    def test_02_dc_loaded_when_needed(self):
+        d = dip.DIP(DIP_DIR)
+
+        # the default dublin core is written out without lxml, and read back with it
+        assert os.path.isfile(os.path.join(DIP_DIR, "metadata", "dcterms.xml"))
+        assert len(d.get_dublin_core()) == 0
+        d.add_dublin_core("title", "A title")
+
+        d = dip.DIP(DIP_DIR)
+        assert d.get_dublin_core("title")[0][1] == "A title"
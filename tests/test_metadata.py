@@ -0,0 +1,113 @@
+from . import TestController
+
+import dip
+from dip import metadata
+from lxml import etree
+import os, shutil, time
+
+DIP_DIR = "dip_test_dir"
+RESOURCES = os.path.join("tests", "resources")
+STYLESHEET = os.path.join(RESOURCES, "dc_to_mods.xsl")
+SCHEMA = os.path.join(RESOURCES, "records.xsd")
+MODS_NS = "{http://www.loc.gov/mods/v3}"
+
+class TestMetadata(TestController):
+
+    def _cleanup(self):
+        if os.path.isdir(DIP_DIR):
+            shutil.rmtree(DIP_DIR)
+
+    def setUp(self):
+        self._cleanup()
+
+    def tearDown(self):
+        self._cleanup()
+
+    def test_01_add_metadata_string(self):
+        d = dip.DIP(DIP_DIR)
+        mf = d.add_metadata_file("mods", string="<mods xmlns='http://www.loc.gov/mods/v3'><genre>text</genre></mods>", deposit_includes_root=True)
+
+        assert mf.format == "mods"
+        assert mf.include_root
+        assert os.path.isfile(mf.path)
+        assert mf.path.endswith(os.path.join("metadata", "mods.xml"))
+
+        # the record has been saved
+        d2 = dip.DIP(DIP_DIR)
+        assert len(d2.get_metadata_files()) == 2
+        assert d2.get_metadata_file("mods").path == mf.path
+        assert etree.parse(mf.path).getroot().tag == MODS_NS + "mods"
+
+        # and can be turned into an atom entry for a metadata only deposit
+        assert "<genre>text</genre>" in d2._metadata_entry(d2.get_metadata_file("mods"))
+
+    def test_02_add_metadata_file_streaming(self):
+        d = dip.DIP(DIP_DIR)
+        os.makedirs(os.path.join(DIP_DIR, "source"))
+        source = os.path.join(DIP_DIR, "source", "records.xml")
+        with open(source, "wb") as f:
+            f.write("<records>")
+            for i in range(20000):
+                f.write("<record>" + str(i) + "</record>")
+            f.write("</records>")
+
+        mf = d.add_metadata_file("http://example.com/records", path=source, schema=SCHEMA)
+        assert os.path.basename(mf.path).startswith("http___example.com_records-")
+        with open(source) as a:
+            with open(mf.path) as b:
+                assert a.read() == b.read()
+
+        # adding the same format again replaces the first
+        d.add_metadata_file("http://example.com/records", string="<records/>")
+        assert len(d.get_metadata_files()) == 2
+        assert len(etree.parse(mf.path).getroot()) == 0
+
+    def test_03_add_invalid_metadata(self):
+        d = dip.DIP(DIP_DIR)
+
+        with self.assertRaises(metadata.MetadataException):
+            d.add_metadata_file("broken", string="<records><record></records>")
+        with self.assertRaises(metadata.MetadataException):
+            d.add_metadata_file("records", string="<records><other/></records>", schema=SCHEMA)
+        with self.assertRaises(dip.InitialiseException):
+            d.add_metadata_file("records")
+
+        # nothing has been added
+        assert len(d.get_metadata_files()) == 1
+        assert os.listdir(os.path.join(DIP_DIR, "metadata")) == ["dcterms.xml"]
+
+    def test_04_crosswalk(self):
+        d = dip.DIP(DIP_DIR)
+        d.add_dublin_core("title", "A title")
+        d.add_dublin_core("creator", "Richard")
+
+        mf = d.crosswalk_metadata("dcterms", "mods", STYLESHEET, genre="article")
+        mods = etree.parse(mf.path).getroot()
+        assert mods.tag == MODS_NS + "mods"
+        assert mods.find(MODS_NS + "titleInfo/" + MODS_NS + "title").text == "A title"
+        assert mods.find(MODS_NS + "name/" + MODS_NS + "namePart").text == "Richard"
+        assert mods.find(MODS_NS + "genre").text == "article"
+
+        # changes still waiting in a batch are included
+        with d.batch():
+            d.add_dublin_core("creator", "Mark")
+            mf = d.crosswalk_metadata("dcterms", "mods", STYLESHEET)
+        assert len(etree.parse(mf.path).getroot().findall(MODS_NS + "name")) == 2
+
+    def test_05_stylesheet_cache(self):
+        os.makedirs(DIP_DIR)
+        xsl = os.path.join(DIP_DIR, "copy.xsl")
+        shutil.copy(STYLESHEET, xsl)
+
+        x1 = metadata.load_stylesheet(xsl)
+        x2 = metadata.load_stylesheet(xsl)
+        assert x1 is x2
+
+        # a changed stylesheet is compiled again
+        later = os.path.getmtime(xsl) + 10
+        os.utime(xsl, (later, later))
+        x3 = metadata.load_stylesheet(xsl)
+        assert x3 is not x1
+
+        with self.assertRaises(metadata.MetadataException):
+            metadata.load_stylesheet(os.path.join(DIP_DIR, "missing.xsl"))
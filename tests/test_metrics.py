@@ -0,0 +1,99 @@
+from . import TestController
+
+import dip
+from dip.standin import StandInServer, SIMPLE_ZIP
+from sword2 import exceptions
+import os, shutil
+
+DIP_DIR = "dip_test_dir"
+PROM_FILE = "dip_test_metrics.prom"
+RESOURCES = os.path.join("tests", "resources")
+
+class TestMetrics(TestController):
+
+    def _cleanup(self):
+        if os.path.isdir(DIP_DIR):
+            shutil.rmtree(DIP_DIR)
+        if os.path.isfile(PROM_FILE):
+            os.remove(PROM_FILE)
+
+    def setUp(self):
+        self._cleanup()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        self._cleanup()
+
+    def test_01_default_metrics(self):
+        # by default the metrics go nowhere, and cost nothing
+        d = dip.DIP(DIP_DIR)
+        assert isinstance(d.metrics, dip.Metrics)
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        with d.metrics.timer("anything", some="label"):
+            pass
+
+    def test_02_hash_and_package(self):
+        metrics = dip.CollectingMetrics()
+        d = dip.DIP(DIP_DIR, metrics=metrics)
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        d.set_file(os.path.join(RESOURCES, "testfile2.txt"))
+        size = os.path.getsize(os.path.join(RESOURCES, "testfile.txt")) + os.path.getsize(os.path.join(RESOURCES, "testfile2.txt"))
+
+        assert metrics.get_counter("dip_hash_bytes_total") == size
+        assert metrics.get_histogram("dip_hash_seconds")[0] == 2
+        assert metrics.get_histogram("dip_deposit_info_save_seconds")[0] >= 2
+
+        package_info = d.package(package_format=SIMPLE_ZIP)
+        count, total = metrics.get_histogram("dip_package_bytes", format=SIMPLE_ZIP)
+        assert count == 1
+        assert total == os.path.getsize(package_info.path)
+        assert metrics.get_histogram("dip_package_seconds", format=SIMPLE_ZIP)[0] == 1
+
+    def test_03_deposit(self):
+        self.server = StandInServer().start()
+        metrics = dip.CollectingMetrics()
+        d = dip.DIP(DIP_DIR, metrics=metrics)
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        d.add_dublin_core("title", "A title")
+        e = dip.Endpoint(sd_iri=self.server.sd_iri, col_iri=self.server.col_iri(), package=SIMPLE_ZIP)
+        d.set_endpoint(endpoint=e)
+
+        d.deposit(e.id)
+        d.deposit(e.id, metadata_only=True)
+        assert metrics.get_histogram("dip_upload_seconds", kind="binary", method="POST")[0] == 1
+        assert metrics.get_histogram("dip_upload_seconds", kind="metadata", method="PUT")[0] == 1
+        assert metrics.get_counter("dip_upload_bytes_total", kind="binary") > 0
+        assert metrics.get_counter("dip_upload_bytes_total", kind="metadata") > 0
+        assert metrics.get_counter("dip_http_responses_total", method="POST", code=201) == 1
+        assert metrics.get_counter("dip_http_responses_total", method="PUT", code=200) == 1
+        assert metrics.get_histogram("dip_history_write_seconds", mode="direct")[0] == 4
+
+        # errors are counted too
+        self.server.error_rate = 1.0
+        self.server.error_status = 503
+        try:
+            d.deposit(e.id, metadata_only=True)
+            assert False, "deposit should have failed"
+        except exceptions.ServerError:
+            pass
+        assert metrics.get_counter("dip_http_responses_total", method="PUT", code=503) == 1
+
+    def test_04_prometheus_textfile(self):
+        metrics = dip.PrometheusTextfileMetrics(PROM_FILE, buckets={"dip_hash_seconds" : [1, 10]}, write_at_exit=False)
+        d = dip.DIP(DIP_DIR, metrics=metrics)
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        metrics.increment("dip_http_responses_total", method="GET", code=200)
+        metrics.write()
+
+        with open(PROM_FILE) as f:
+            text = f.read()
+        lines = text.splitlines()
+        assert "# TYPE dip_hash_seconds histogram" in lines
+        assert "# TYPE dip_hash_bytes_total counter" in lines
+        assert 'dip_hash_seconds_bucket{le="1"} 1' in lines
+        assert 'dip_hash_seconds_bucket{le="+Inf"} 1' in lines
+        assert "dip_hash_seconds_count 1" in lines
+        assert 'dip_http_responses_total{code="200",method="GET"} 1' in lines
+        assert not os.path.exists(PROM_FILE + ".tmp." + str(os.getpid()))
@@ -1,12 +1,14 @@
 from . import TestController
 
 import dip
+from dip import packagers
 from datetime import datetime
 import os, shutil, zipfile
 
 DIP_DIR = "dip_test_dir"
 PRES_DIR = "dip_preserve_dir"
 RESOURCES = os.path.join("tests", "resources")
+SIMPLE_ZIP = "http://purl.org/net/sword/package/SimpleZip"
 TESTFILE_MD5 = "6fd9af1196c0f77e463bf2dcfdbef852"
 TESTFILE2_MD5 = "8a86db9c36f1f7a0d8905afe3649b886"
 
@@ -48,9 +50,13 @@ class TestPackager(TestController):
         t2 = os.path.join(RESOURCES, "testfile2.txt")
         d.set_file(t2)
         
-        path = d.package(package_format="http://purl.org/net/sword/package/SimpleZip")
+        info = d.package(package_format="http://purl.org/net/sword/package/SimpleZip")
         
-        z = zipfile.ZipFile(path)
+        # the md5 streamed out while packaging is that of the zip on disk
+        import hashlib
+        assert hashlib.md5(open(info.path, "rb").read()).hexdigest() == info.md5
+        
+        z = zipfile.ZipFile(info.path)
         contents = z.namelist()
         
         assert len(contents) == 3
@@ -59,3 +65,439 @@ class TestPackager(TestController):
         assert "testfile2.txt" in contents
         
         self._preserve_result()
+
+    def test_02_packager_factory(self):
+        simple_zip = "http://purl.org/net/sword/package/SimpleZip"
+        
+        # packagers are shared, not rebuilt on every request
+        p1 = dip.PackagerFactory.load_packager(simple_zip)
+        p2 = dip.PackagerFactory.load_packager(simple_zip)
+        assert isinstance(p1, packagers.SimpleZipPackager)
+        assert p1 is p2
+        
+        # unknown formats are reported properly
+        with self.assertRaises(dip.PackagerException):
+            dip.PackagerFactory.load_packager("http://example.com/package/Unknown")
+        
+        d = dip.DIP(DIP_DIR)
+        e = d.set_endpoint(sd_iri="sd", col_iri="col", package="http://example.com/package/Unknown")
+        with self.assertRaises(dip.PackagerException):
+            d.package(e.id)
+        assert d.get_packager(package_format=simple_zip) is p1
+    
+    def test_03_register_lazy_packager(self):
+        fmt = "http://example.com/package/Lazy"
+        try:
+            dip.PackagerFactory.register(fmt, "tests.test_packager:RecordingPackager")
+            p = dip.PackagerFactory.load_packager(fmt)
+            assert isinstance(p, RecordingPackager)
+            
+            dip.PackagerFactory.register(fmt, "tests.test_packager:NoSuchPackager")
+            with self.assertRaises(dip.PackagerException):
+                dip.PackagerFactory.load_packager(fmt)
+        finally:
+            packagers.PACKAGERS.pop(fmt, None)
+            packagers.PackagerFactory._instances.pop(fmt, None)
+    
+    def test_04_entry_point_packager(self):
+        fmt = "http://example.com/package/Plugin"
+        
+        class EntryPoint(object):
+            def load(self):
+                return RecordingPackager
+        
+        def iter_entry_points(group, name=None):
+            if group == packagers.ENTRY_POINT_GROUP and name == fmt:
+                yield EntryPoint()
+        
+        import pkg_resources
+        original = pkg_resources.iter_entry_points
+        pkg_resources.iter_entry_points = iter_entry_points
+        try:
+            p = dip.PackagerFactory.load_packager(fmt)
+            assert isinstance(p, RecordingPackager)
+        finally:
+            pkg_resources.iter_entry_points = original
+            packagers.PackagerFactory._instances.pop(fmt, None)
+
+    def _bag_dip(self):
+        d = dip.DIP(DIP_DIR)
+        d.add_dublin_core("creator", "Richard")
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        d.set_file(os.path.join(RESOURCES, "testfile2.txt"))
+        return d
+    
+    def _bag_manifest(self, text):
+        return dict([(line.split("  ", 1)[1], line.split("  ", 1)[0]) for line in text.splitlines()])
+    
+    def test_05_bagit_zip(self):
+        from dip.bagit import BAGIT, BagItPackager
+        d = self._bag_dip()
+        assert isinstance(d.get_packager(package_format=BAGIT), BagItPackager)
+        
+        info = d.package(package_format=BAGIT)
+        assert info.filename == "BagIt.zip"
+        assert info.mimetype == "application/zip"
+        assert len(info.file_paths) == 2
+        assert info.metadata_formats == ["dcterms"]
+        
+        z = zipfile.ZipFile(info.path)
+        contents = z.namelist()
+        assert contents == ["bag/bagit.txt", "bag/data/testfile.txt", "bag/data/testfile2.txt", "bag/manifest-md5.txt",
+                            "bag/bag-info.txt", "bag/metadata/dcterms.xml", "bag/tagmanifest-md5.txt"], contents
+        assert z.read("bag/bagit.txt").startswith("BagIt-Version: 1.0\n")
+        manifest = self._bag_manifest(z.read("bag/manifest-md5.txt"))
+        assert manifest == {"data/testfile.txt" : TESTFILE_MD5, "data/testfile2.txt" : TESTFILE2_MD5}
+        size = os.path.getsize(os.path.join(RESOURCES, "testfile.txt")) + os.path.getsize(os.path.join(RESOURCES, "testfile2.txt"))
+        assert "Payload-Oxum: " + str(size) + ".2" in z.read("bag/bag-info.txt")
+        
+        # the tag manifest covers every tag file, with the right checksums
+        import hashlib
+        tags = self._bag_manifest(z.read("bag/tagmanifest-md5.txt"))
+        assert sorted(tags.keys()) == ["bag-info.txt", "bagit.txt", "manifest-md5.txt", "metadata/dcterms.xml"]
+        for name, md5 in tags.items():
+            assert hashlib.md5(z.read("bag/" + name)).hexdigest() == md5
+    
+    def test_06_bagit_tar_verify(self):
+        from dip.bagit import BAGIT
+        import tarfile
+        d = self._bag_dip()
+        info = d.package(package_format=BAGIT, archive="tgz", bag_name="mybag", verify=True, metadata_files=False)
+        assert info.filename == "BagIt.tar.gz"
+        t = tarfile.open(info.path)
+        names = t.getnames()
+        assert "mybag/data/testfile.txt" in names
+        assert "mybag/metadata/dcterms.xml" not in names
+        assert t.extractfile("mybag/data/testfile2.txt").read() == open(os.path.join(RESOURCES, "testfile2.txt")).read()
+        
+        # a record which doesn't match its file is caught when verifying...
+        d.get_file(os.path.join(RESOURCES, "testfile.txt")).raw["md5"] = "0" * 32
+        with self.assertRaises(dip.PackagerException):
+            d.package(package_format=BAGIT, archive="tar", verify=True)
+        # ...but otherwise the manifest has the checksum of what went in the bag
+        info = d.package(package_format=BAGIT, archive="tar")
+        manifest = self._bag_manifest(tarfile.open(info.path).extractfile("bag/manifest-md5.txt").read())
+        assert manifest["data/testfile.txt"] == TESTFILE_MD5
+        assert d.get_file(os.path.join(RESOURCES, "testfile.txt")).md5 == TESTFILE_MD5
+        
+        # unless the file has been modified since it was hashed
+        testfile = os.path.join(RESOURCES, "testfile.txt")
+        shutil.copy(testfile, testfile + ".bak")
+        with open(testfile, "ab") as f:
+            f.write("more")
+        os.utime(testfile, (2000000000, 2000000000))
+        info = d.package(package_format=BAGIT, archive="tar")
+        manifest = self._bag_manifest(tarfile.open(info.path).extractfile("bag/manifest-md5.txt").read())
+        assert manifest["data/testfile.txt"] == d.get_file(testfile).md5 != TESTFILE_MD5
+        
+        with self.assertRaises(dip.PackagerException):
+            d.package(package_format=BAGIT, archive="rar")
+    
+    def test_07_mets_dspace_sip(self):
+        from dip.mets import METS_DSPACE_SIP, METSDSpaceSIPPackager
+        from lxml import etree
+        d = self._bag_dip()
+        assert isinstance(d.get_packager(package_format=METS_DSPACE_SIP), METSDSpaceSIPPackager)
+        
+        info = d.package(package_format=METS_DSPACE_SIP)
+        assert info.filename == "METSDSpaceSIP.zip"
+        assert len(info.file_paths) == 2
+        assert info.metadata_formats == ["dcterms"]
+        z = zipfile.ZipFile(info.path)
+        assert z.namelist() == ["testfile.txt", "testfile2.txt", "mets.xml"], z.namelist()
+        assert not os.path.exists(os.path.join(os.path.dirname(info.path), "mets.xml"))
+        
+        ns = {"m" : "http://www.loc.gov/METS/", "x" : "http://www.w3.org/1999/xlink",
+              "dcterms" : "http://purl.org/dc/terms/"}
+        mets = etree.fromstring(z.read("mets.xml"))
+        assert mets.get("PROFILE") == "DSpace METS SIP Profile 1.0"
+        assert mets.xpath("m:dmdSec/m:mdWrap/m:xmlData/dcterms:creator/text()", namespaces=ns) == ["Richard"]
+        files = mets.xpath("m:fileSec/m:fileGrp/m:file", namespaces=ns)
+        checksums = dict([(f.xpath("m:FLocat/@x:href", namespaces=ns)[0], f.get("CHECKSUM")) for f in files])
+        assert checksums == {"testfile.txt" : TESTFILE_MD5, "testfile2.txt" : TESTFILE2_MD5}
+        assert files[0].get("MIMETYPE") == "text/plain"
+        assert files[0].get("SIZE") == str(os.path.getsize(os.path.join(RESOURCES, "testfile.txt")))
+        div = mets.xpath("m:structMap/m:div", namespaces=ns)[0]
+        assert div.get("DMDID") == "dmd_1"
+        assert div.xpath("m:div/m:fptr/@FILEID", namespaces=ns) == ["file_1", "file_2"]
+        
+        # a record which doesn't match its file doesn't make it into mets.xml
+        d.get_file(os.path.join(RESOURCES, "testfile.txt")).raw["md5"] = "0" * 32
+        info = d.package(package_format=METS_DSPACE_SIP)
+        mets = etree.fromstring(zipfile.ZipFile(info.path).read("mets.xml"))
+        assert mets.xpath("m:fileSec/m:fileGrp/m:file/@CHECKSUM", namespaces=ns) == [TESTFILE_MD5, TESTFILE2_MD5]
+    
+    def test_08_mets_many_files(self):
+        from dip.mets import METS_DSPACE_SIP
+        from lxml import etree
+        d = dip.DIP(DIP_DIR)
+        content = os.path.join(DIP_DIR, "content")
+        os.makedirs(content)
+        for i in range(500):
+            path = os.path.join(content, "file" + str(i) + ".bin")
+            with open(path, "wb") as f:
+                f.write(str(i))
+            d.set_file(path)
+        
+        info = d.package(package_format=METS_DSPACE_SIP, metadata_files=False)
+        mets = etree.fromstring(zipfile.ZipFile(info.path).read("mets.xml"))
+        ns = {"m" : "http://www.loc.gov/METS/"}
+        assert len(mets.xpath("m:fileSec/m:fileGrp/m:file", namespaces=ns)) == 500
+        assert len(mets.xpath("m:dmdSec", namespaces=ns)) == 0
+        assert mets.xpath("m:structMap/m:div", namespaces=ns)[0].get("DMDID") is None
+        
+        # the files all go in the root of the zip, so their names have to be unique
+        other = os.path.join(DIP_DIR, "file0.bin")
+        with open(other, "wb") as f:
+            f.write("other")
+        d.set_file(other)
+        with self.assertRaises(dip.PackagerException):
+            d.package(package_format=METS_DSPACE_SIP)
+    
+    def test_09_tar(self):
+        from dip.tarball import TAR, TAR_GZ, TarPackager, TarGzPackager
+        import tarfile
+        d = self._bag_dip()
+        assert isinstance(d.get_packager(package_format=TAR), TarPackager)
+        assert isinstance(d.get_packager(package_format=TAR_GZ), TarGzPackager)
+        
+        info = d.package(package_format=TAR)
+        assert info.filename == "Tar.tar"
+        assert info.mimetype == "application/x-tar"
+        assert info.metadata_formats == ["dcterms"]
+        assert len(info.file_paths) == 2
+        t = tarfile.open(info.path)
+        assert t.getnames() == ["dcterms.xml", "testfile.txt", "testfile2.txt"], t.getnames()
+        assert t.extractfile("testfile.txt").read() == open(os.path.join(RESOURCES, "testfile.txt")).read()
+        
+        info = d.package(package_format=TAR_GZ, metadata_files=False, processes=1)
+        assert info.filename == "Tar.tar.gz"
+        assert tarfile.open(info.path).getnames() == ["testfile.txt", "testfile2.txt"]
+        
+        # the package can be written to anything with a write method
+        from StringIO import StringIO
+        out = StringIO()
+        file_paths, metadata_formats = d.get_packager(package_format=TAR).write(d, out, metadata_files=False)
+        assert len(file_paths) == 2 and metadata_formats == []
+        assert tarfile.open(fileobj=StringIO(out.getvalue())).getnames() == ["testfile.txt", "testfile2.txt"]
+    
+    def test_10_parallel_gzip(self):
+        from dip import tarball
+        from dip.tarball import TAR_GZ, ParallelGzipWriter
+        from StringIO import StringIO
+        import gzip, zlib, tarfile
+        data = "".join([os.urandom(1000) + "a" * 3000 for i in range(100)])
+        for processes in [1, 3]:
+            out = StringIO()
+            gz = ParallelGzipWriter(out, block_size=64 * 1024, processes=processes)
+            for i in range(0, len(data), 10000):
+                gz.write(data[i:i + 10000])
+            gz.close()
+            compressed = out.getvalue()
+            assert len(compressed) < len(data)
+            assert gzip.GzipFile(fileobj=StringIO(compressed)).read() == data
+            
+            # it is a series of independent members, one per block, in order
+            members = []
+            while compressed:
+                z = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                members.append(z.decompress(compressed))
+                compressed = z.unused_data
+            assert len(members) == 7
+            assert "".join(members) == data
+        
+        # a single write of many blocks is compressed a block at a time, keeping only the rest
+        from dip.tarball import shared_pool
+        out = StringIO()
+        gz = ParallelGzipWriter(out, block_size=64 * 1024, processes=2)
+        gz.write(data)
+        assert gz._buffered == len(data) % (64 * 1024) == len("".join(gz._buffer))
+        gz.close()
+        assert gzip.GzipFile(fileobj=StringIO(out.getvalue())).read() == data
+        
+        # the writers share a pool, which outlives them, unless they are given one
+        assert gz._pool is shared_pool(2)
+        assert shared_pool(2).apply(len, ("abc",)) == 3
+        import multiprocessing
+        pool = multiprocessing.Pool(1)
+        try:
+            out = StringIO()
+            gz = ParallelGzipWriter(out, block_size=64 * 1024, processes=2, pool=pool)
+            gz.write(data)
+            gz.close()
+            assert gz._pool is pool
+            assert gzip.GzipFile(fileobj=StringIO(out.getvalue())).read() == data
+        finally:
+            pool.terminate()
+        
+        # an empty stream is still a gzip file
+        out = StringIO()
+        ParallelGzipWriter(out, processes=1).close()
+        assert gzip.GzipFile(fileobj=StringIO(out.getvalue())).read() == ""
+        
+        # a tar.gz of several blocks, built in parallel
+        d = dip.DIP(DIP_DIR)
+        for i in range(3):
+            path = os.path.join(DIP_DIR, "file" + str(i) + ".bin")
+            with open(path, "wb") as f:
+                f.write(data)
+            d.set_file(path)
+        pools = dict(tarball._pools)
+        info = d.package(package_format=TAR_GZ, block_size=128 * 1024, processes=2, metadata_files=False)
+        t = tarfile.open(info.path)
+        assert t.getnames() == ["file0.bin", "file1.bin", "file2.bin"], t.getnames()
+        assert t.extractfile("file2.bin").read() == data
+        # in the pool which was already running
+        assert tarball._pools == pools
+    
+    def test_11_single_pass(self):
+        from dip.tarball import TAR_GZ
+        import hashlib, tarfile
+        d = dip.DIP(DIP_DIR)
+        content = os.path.join(DIP_DIR, "content.txt")
+        with open(content, "wb") as f:
+            f.write("some content")
+        d.set_file(content)
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        
+        # the package's md5 comes with it, and the zip is a good one
+        info = d.package(package_format=SIMPLE_ZIP)
+        assert info.md5 == hashlib.md5(open(info.path, "rb").read()).hexdigest()
+        z = zipfile.ZipFile(info.path)
+        assert z.testzip() is None
+        assert z.read("content.txt") == "some content"
+        assert sorted(z.namelist()) == ["content.txt", "dcterms.xml", "testfile.txt"]
+        
+        # a file which has changed without the DIP knowing has its record put right as it is packaged
+        with open(content, "wb") as f:
+            f.write("some other content")
+        os.utime(content, (1000000000, 1000000000))
+        info = d.package(package_format=SIMPLE_ZIP)
+        assert d.get_file(content).md5 == hashlib.md5("some other content").hexdigest()
+        assert zipfile.ZipFile(info.path).read("content.txt") == "some other content"
+        
+        # and the same goes for tarballs
+        with open(content, "wb") as f:
+            f.write("yet more content")
+        os.utime(content, (1000000000, 1000000000))
+        info = d.package(package_format=TAR_GZ, processes=1)
+        assert info.md5 == hashlib.md5(open(info.path, "rb").read()).hexdigest()
+        assert d.get_file(content).md5 == hashlib.md5("yet more content").hexdigest()
+        assert tarfile.open(info.path).extractfile("content.txt").read() == "yet more content"
+    
+    def test_12_package_many(self):
+        from dip.bagit import BAGIT
+        from dip.mets import METS_DSPACE_SIP
+        from dip.tarball import TAR
+        import tarfile, hashlib
+        metrics = dip.CollectingMetrics()
+        d = dip.DIP(DIP_DIR, metrics=metrics)
+        d.add_dublin_core("creator", "Richard")
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        d.set_file(os.path.join(RESOURCES, "testfile2.txt"))
+        
+        # count the reads of the dip's files
+        reads = []
+        def counting_open(path, *args):
+            if "resources" in path:
+                reads.append(os.path.basename(path))
+            return open(path, *args)
+        fmt = "http://example.com/package/Standalone"
+        dip.PackagerFactory.register(fmt, StandalonePackager)
+        packagers.open = counting_open
+        try:
+            infos = d.package_many([SIMPLE_ZIP, BAGIT, METS_DSPACE_SIP, TAR, fmt])
+        finally:
+            del packagers.open
+            packagers.PACKAGERS.pop(fmt, None)
+            packagers.PackagerFactory._instances.pop(fmt, None)
+        assert sorted(reads) == ["testfile.txt", "testfile2.txt"], reads
+        
+        assert sorted(infos.keys()) == sorted([SIMPLE_ZIP, BAGIT, METS_DSPACE_SIP, TAR, fmt])
+        for f in [SIMPLE_ZIP, BAGIT, METS_DSPACE_SIP, TAR]:
+            info = infos[f]
+            assert len(info.file_paths) == 2, f
+            assert info.md5 == hashlib.md5(open(info.path, "rb").read()).hexdigest(), f
+            assert os.path.isfile(os.path.join(info.package_dir, dip.cache.INFO_FILE)), f
+        assert zipfile.ZipFile(infos[SIMPLE_ZIP].path).read("testfile.txt") == open(os.path.join(RESOURCES, "testfile.txt")).read()
+        bag = zipfile.ZipFile(infos[BAGIT].path)
+        assert self._bag_manifest(bag.read("bag/manifest-md5.txt"))["data/testfile2.txt"] == TESTFILE2_MD5
+        assert zipfile.ZipFile(infos[METS_DSPACE_SIP].path).namelist() == ["testfile.txt", "testfile2.txt", "mets.xml"]
+        assert tarfile.open(infos[TAR].path).getnames() == ["dcterms.xml", "testfile.txt", "testfile2.txt"]
+        assert open(infos[fmt].path).read() == "standalone"
+        
+        # the packages are the ones which packaging each format on its own finds
+        assert d.package(package_format=BAGIT).path == infos[BAGIT].path
+        assert metrics.get_counter("dip_package_cache_requests_total", result="hit") == 1
+        again = d.package_many({TAR : {}, BAGIT : {"archive" : "tar"}})
+        assert again[TAR].path == infos[TAR].path
+        assert again[BAGIT].filename == "BagIt.tar"
+        assert metrics.get_counter("dip_package_cache_requests_total", result="hit") == 2
+    
+    def test_13_bagit_reads_once(self):
+        # a file modified since it was hashed is read once, as it goes into the bag, and
+        # its record brought up to date from that
+        from dip.bagit import BAGIT
+        import __builtin__, hashlib, tarfile
+        d = dip.DIP(DIP_DIR)
+        path = os.path.join(DIP_DIR, "content.txt")
+        with open(path, "wb") as f:
+            f.write("original")
+        d.set_file(path)
+        with open(path, "wb") as f:
+            f.write("modified")
+        os.utime(path, (2000000000, 2000000000))
+        
+        reads = []
+        real_open = __builtin__.open
+        def counting_open(name, mode="r", *args):
+            if os.path.abspath(name) == os.path.abspath(path) and "w" not in mode and "a" not in mode:
+                reads.append(mode)
+            return real_open(name, mode, *args)
+        __builtin__.open = counting_open
+        try:
+            info = d.package(package_format=BAGIT, archive="tar", verify=True, metadata_files=False)
+        finally:
+            __builtin__.open = real_open
+        assert len(reads) == 1, reads
+        manifest = self._bag_manifest(tarfile.open(info.path).extractfile("bag/manifest-md5.txt").read())
+        assert manifest["data/content.txt"] == hashlib.md5("modified").hexdigest()
+        assert d.get_file(path).md5 == hashlib.md5("modified").hexdigest()
+
+    def test_14_streaming_zip(self):
+        from StringIO import StringIO
+        testfile = os.path.join(RESOURCES, "testfile.txt")
+        content = open(testfile, "rb").read()
+        limit = packagers.ZIP64_LIMIT
+        try:
+            # and with everything big enough to need zip64 extensions
+            for packagers.ZIP64_LIMIT in [limit, 10]:
+                out = StringIO()
+                z = packagers.StreamingZipFile(out)
+                z.writestr("tag.txt", "a tag file\n")
+                assert packagers.write_zip_entry(z, testfile, u"caf\xe9.txt") == TESTFILE_MD5
+                with self.assertRaises(dip.PackagerException):
+                    z.writestr("tag.txt", "again")
+                z.close()
+                
+                zf = zipfile.ZipFile(StringIO(out.getvalue()))
+                assert zf.testzip() is None
+                assert zf.namelist() == ["tag.txt", u"caf\xe9.txt"]
+                assert zf.read(u"caf\xe9.txt") == content
+                # only deflated entries have data descriptors, which some readers can't take on stored entries
+                for info in zf.infolist():
+                    assert info.compress_type == zipfile.ZIP_DEFLATED or not info.flag_bits & 0x08
+                assert zf.getinfo(u"caf\xe9.txt").flag_bits & 0x08
+        finally:
+            packagers.ZIP64_LIMIT = limit
+    
+class RecordingPackager(packagers.Packager):
+    pass
+
+class StandalonePackager(packagers.Packager):
+    # one without a writer, which package_many has to leave to itself
+    def package(self, dip, out_dir, **packager_args):
+        path = os.path.join(out_dir, "standalone.txt")
+        with open(path, "wb") as f:
+            f.write("standalone")
+        return packagers.PackageInfo(path, [], [], "standalone.txt", "text/plain")
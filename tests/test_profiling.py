@@ -0,0 +1,88 @@
+from . import TestController
+
+import dip
+from dip.standin import StandInServer, SIMPLE_ZIP
+import os, shutil, json, glob, pstats
+
+DIP_DIR = "dip_test_dir"
+RESOURCES = os.path.join("tests", "resources")
+
+class TestProfiling(TestController):
+
+    def _cleanup(self):
+        if os.path.isdir(DIP_DIR):
+            shutil.rmtree(DIP_DIR)
+
+    def setUp(self):
+        self._cleanup()
+        self.server = None
+        self.env = os.environ.pop(dip.profiling.PROFILE_ENV, None)
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        if self.env is not None:
+            os.environ[dip.profiling.PROFILE_ENV] = self.env
+        else:
+            os.environ.pop(dip.profiling.PROFILE_ENV, None)
+        self._cleanup()
+
+    def _profiles(self, *path):
+        return sorted(glob.glob(os.path.join(DIP_DIR, "history", *(path + ("*_profile.prof",)))))
+
+    def test_01_off_by_default(self):
+        d = dip.DIP(DIP_DIR)
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        d.get_state()
+        d.package(package_format=SIMPLE_ZIP)
+        assert self._profiles() == []
+
+    def test_02_get_state_and_package(self):
+        d = dip.DIP(DIP_DIR, profile=True)
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        d.get_state()
+        d.package(package_format=SIMPLE_ZIP)
+
+        profiles = self._profiles()
+        assert len(profiles) == 2, profiles
+        assert profiles[0].endswith("_get_state_profile.prof")
+        assert profiles[1].endswith("_package_profile.prof")
+
+        # the stats can be loaded, and include the operation itself
+        stats = pstats.Stats(profiles[0])
+        assert len([f for f in stats.stats.keys() if f[2] == "_get_state"]) == 1
+
+        prefix = profiles[0][:-len("_profile.prof")]
+        with open(prefix + "_profile.txt") as f:
+            assert "cumulative" in f.read()
+        with open(prefix + "_memory.json") as f:
+            memory = json.loads(f.read())
+        assert memory["operation"] == "get_state"
+        assert memory["peak_rss_kb_after"] >= memory["peak_rss_kb_before"] > 0
+        assert memory["comms_timestamp"] is None
+
+    def test_03_deposit_by_environment(self):
+        os.environ[dip.profiling.PROFILE_ENV] = "1"
+        self.server = StandInServer().start()
+        d = dip.DIP(DIP_DIR)
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        e = dip.Endpoint(sd_iri=self.server.sd_iri, col_iri=self.server.col_iri(), package=SIMPLE_ZIP)
+        d.set_endpoint(endpoint=e)
+        cm, receipt = d.deposit(e.id)
+
+        # one profile for the deposit, which includes the packaging, named after the
+        # timestamp of its history records
+        profiles = self._profiles(e.id)
+        assert len(profiles) == 1, profiles
+        assert os.path.basename(profiles[0]) == cm.raw["timestamp"] + "_deposit_profile.prof"
+        stats = pstats.Stats(profiles[0])
+        assert len([f for f in stats.stats.keys() if f[2] == "_deposit_binary"]) == 1
+        assert len([f for f in stats.stats.keys() if f[2] == "package"]) > 0
+
+        # and it doesn't get in the way of the history
+        assert len(d.get_history(e.id)) == 2
+
+        # the environment can be overridden
+        d = dip.DIP(DIP_DIR, profile=False)
+        d.get_state()
+        assert len(self._profiles()) == 0
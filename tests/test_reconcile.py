@@ -0,0 +1,205 @@
+from . import TestController
+
+import dip
+from dip import reconcile
+from dip.reconcile import Reconciler
+from dip.standin import StandInServer, Resource, SIMPLE_ZIP
+import os, shutil, hashlib, time
+
+DIP_DIR = "dip_test_dir"
+
+STATEMENT = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:sword="http://purl.org/net/sword/terms/">
+    <id>http://localhost/statement/1</id>
+    <title>Statement</title>
+    <updated>2012-01-01T00:00:00Z</updated>
+    <entry>
+        <id>http://localhost/em/1/one.txt</id>
+        <title>one.txt</title>
+        <updated>2012-01-01T00:00:00Z</updated>
+        <content type="text/plain" src="http://localhost/em/1/one.txt"/>
+        <category scheme="http://purl.org/net/sword/terms/" term="http://purl.org/net/sword/terms/originalDeposit"/>
+        <sword:packaging>http://purl.org/net/sword/package/Binary</sword:packaging>
+    </entry>
+    <entry>
+        <id>http://localhost/em/1/two%%20words.txt</id>
+        <title>two words.txt</title>
+        <updated>2012-01-01T00:00:00Z</updated>
+        <content type="text/plain" src="http://localhost/em/1/two%%20words.txt"/>
+        <sword:md5>%(md5)s</sword:md5>
+    </entry>
+</feed>
+"""
+
+class TestReconcile(TestController):
+
+    def _cleanup(self):
+        if os.path.isdir(DIP_DIR):
+            shutil.rmtree(DIP_DIR)
+
+    def setUp(self):
+        self._cleanup()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        self._cleanup()
+
+    def _write(self, path, content, changed=False):
+        with open(path, "wb") as f:
+            f.write(content)
+        if changed:
+            # records are kept to the second, so make sure the change shows
+            mtime = time.time() + 2
+            os.utime(path, (mtime, mtime))
+
+    def _dip(self, name, files=3):
+        d = dip.DIP(os.path.abspath(os.path.join(DIP_DIR, name)))
+        for i in range(files):
+            path = os.path.join(d.base_dir, "file" + str(i) + ".txt")
+            self._write(path, name + " content " + str(i))
+            d.set_file(path)
+        return d
+
+    def _endpoint(self, d):
+        e = dip.Endpoint(sd_iri=self.server.sd_iri, col_iri=self.server.col_iri(), package=SIMPLE_ZIP)
+        d.set_endpoint(endpoint=e)
+        return e.id
+
+    def test_01_compare(self):
+        import sword2
+        d = self._dip("a", files=0)
+        one = os.path.join(d.base_dir, "one.txt")
+        two = os.path.join(d.base_dir, "two words.txt")
+        self._write(one, "one")
+        self._write(two, "two")
+        d.set_file(one)
+        d.set_file(two)
+        local = hashlib.md5("two").hexdigest()
+
+        # the Binary original deposit is a file, and has no md5 to check
+        statement = sword2.Atom_Sword_Statement(STATEMENT % {"md5" : local.upper()})
+        diff = reconcile.compare(d, "e", statement)
+        assert diff.in_sync
+        assert diff.unverified == [one]
+        assert diff.delta_files == []
+
+        statement = sword2.Atom_Sword_Statement(STATEMENT % {"md5" : "0" * 32})
+        diff = reconcile.compare(d, "e", statement)
+        assert not diff.in_sync
+        assert diff.mismatched == [(two, local, "0" * 32)]
+        assert diff.delta_files == [two]
+
+        # nothing deposited yet
+        diff = reconcile.compare(d, "e", None)
+        assert sorted(diff.missing) == sorted([one, two])
+        assert diff.extra == []
+
+    def test_02_reconcile(self):
+        self.server = StandInServer().start()
+        d = self._dip("a")
+        eid = self._endpoint(d)
+
+        # nothing has been deposited, so everything is missing, without asking the server
+        diff = d.reconcile(eid)
+        assert len(diff.missing) == 3
+        assert self.server.stats["requests"] == 0
+
+        d.deposit(eid)
+        diff = d.reconcile(eid)
+        assert diff.in_sync, str(diff)
+        assert diff.unverified == []
+
+        # a changed file, a new one, and something in the repository the DIP doesn't have
+        changed = d.get_files()[0].path
+        self._write(changed, "different content", changed=True)
+        added = os.path.join(d.base_dir, "new.txt")
+        self._write(added, "new")
+        d.set_file(added)
+        container = self.server.get_container(os.path.basename(d.get_endpoint(eid).edit_iri))
+        container.resources.append(Resource("stray.txt", hashlib.md5("stray").hexdigest(), 5, "text/plain"))
+
+        diff = d.reconcile(eid)
+        assert not diff.in_sync
+        assert diff.missing == [added]
+        assert diff.extra == ["stray.txt"]
+        assert [m[0] for m in diff.mismatched] == [changed]
+        # the change was picked up without anyone calling set_file
+        assert diff.mismatched[0][1] == hashlib.md5("different content").hexdigest()
+        assert sorted(diff.delta_files) == sorted([added, changed])
+
+        # and once they are deposited, it's just the stray one
+        d.deposit(eid)
+        diff = d.reconcile(eid)
+        assert diff.delta_files == []
+        assert diff.extra == []
+
+    def test_03_reconciler(self):
+        self.server = StandInServer(latency=0.1).start()
+        dips = []
+        for name in ["a", "b", "c"]:
+            d = self._dip(name)
+            for i in range(2):
+                d.deposit(self._endpoint(d))
+            dips.append(d)
+        # one whose container has gone
+        broken = self._dip("d")
+        e = dip.Endpoint(sd_iri=self.server.sd_iri, col_iri=self.server.col_iri(), package=SIMPLE_ZIP,
+                         edit_iri=self.server.edit_iri("999"))
+        broken.set_endpoint(endpoint=e)
+        eid = e.id
+        self._write(dips[1].get_files()[0].path, "changed", changed=True)
+
+        seen = []
+        report = Reconciler(threads=8).reconcile([d.base_dir for d in dips] + [broken], progress=seen.append)
+        assert len(report.diffs) == 7
+        assert seen == report.diffs
+        assert [df.dip_dir for df in report.diffs] == [d.base_dir for d in dips for i in range(2)] + [broken.base_dir]
+        assert [df.dip_dir for df in report.out_of_sync] == [dips[1].base_dir] * 2 + [broken.base_dir]
+        assert len(report.errors) == 1
+        assert report.errors[0].endpoint_id == eid
+        # the record was brought up to date on disk too
+        assert dip.DIP(dips[1].base_dir).get_files()[0].md5 == hashlib.md5("changed").hexdigest()
+
+        # the statements were fetched at once, not one after another
+        assert self.server.stats["max_concurrency"] > 1
+
+        # only some of the endpoints
+        report = Reconciler(threads=1).reconcile(dips, endpoint_ids=[dips[0].get_endpoints()[0].id])
+        assert len(report.diffs) == 1
+        assert report.diffs[0].in_sync
+
+        # a path which isn't a DIP isn't made into one
+        missing = os.path.join(DIP_DIR, "nothing")
+        with self.assertRaises(dip.InitialiseException):
+            Reconciler().reconcile([missing])
+        assert not os.path.exists(missing)
+
+    def test_04_checksum_elements(self):
+        import sword2
+        d = self._dip("a", files=0)
+        two = os.path.join(d.base_dir, "two words.txt")
+        self._write(two, "two")
+        d.set_file(two)
+        local = hashlib.md5("two").hexdigest()
+
+        # a repository which gives its checksums in an element of its own
+        checksum = "{http://example.org/terms/}checksum"
+        xml = STATEMENT.replace("<sword:md5>%(md5)s</sword:md5>",
+                                '<ex:checksum xmlns:ex="http://example.org/terms/">' + local + '</ex:checksum>')
+        statement = sword2.Atom_Sword_Statement(xml % {})
+        diff = reconcile.compare(d, "e", statement)
+        assert diff.unverified == [two]
+        diff = reconcile.compare(d, "e", statement, checksum_elements=[checksum] + reconcile.CHECKSUM_ELEMENTS)
+        assert diff.unverified == []
+        assert diff.mismatched == []
+
+        # and through the Reconciler, where the stand-in's sword:md5 is then not looked at
+        self.server = StandInServer().start()
+        d = self._dip("b")
+        d.deposit(self._endpoint(d))
+        report = Reconciler(threads=1, checksum_elements=[checksum]).reconcile([d])
+        assert report.diffs[0].in_sync
+        assert len(report.diffs[0].unverified) == 3
+        assert Reconciler(threads=1).reconcile([d]).diffs[0].unverified == []
@@ -0,0 +1,175 @@
+from . import TestController
+
+import dip
+from dip.standin import StandInServer, SIMPLE_ZIP
+from dip.transport import DepositHttpLayer
+import sword2
+from sword2 import exceptions
+import os, shutil, time, hashlib
+
+DIP_DIR = "dip_test_dir"
+RESOURCES = os.path.join("tests", "resources")
+TESTFILE_MD5 = "6fd9af1196c0f77e463bf2dcfdbef852"
+TESTFILE2_MD5 = "8a86db9c36f1f7a0d8905afe3649b886"
+
+class TestStandIn(TestController):
+
+    def _cleanup(self):
+        if os.path.isdir(DIP_DIR):
+            shutil.rmtree(DIP_DIR)
+        elif os.path.isfile(DIP_DIR):
+            os.remove(DIP_DIR)
+
+    def setUp(self):
+        self._cleanup()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        self._cleanup()
+
+    def _start(self, **kwargs):
+        self.server = StandInServer(**kwargs).start()
+        return self.server
+
+    def _dip(self, server, **endpoint_args):
+        d = dip.DIP(DIP_DIR)
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        d.set_file(os.path.join(RESOURCES, "testfile2.txt"))
+        d.add_dublin_core("title", "A title")
+        e = dip.Endpoint(sd_iri=server.sd_iri, col_iri=server.col_iri(), package=SIMPLE_ZIP, **endpoint_args)
+        d.set_endpoint(endpoint=e)
+        # read it back, so that the endpoint comes from deposit.json as it would in real life
+        return dip.DIP(DIP_DIR), e.id
+
+    def test_01_service_document(self):
+        server = self._start(collections=["one", "two"], max_body_size=1024 * 1024)
+        conn = sword2.Connection(server.sd_iri, http_impl=DepositHttpLayer())
+        conn.get_service_document()
+        sd = conn.sd
+        assert sd.valid
+        assert sd.maxUploadSize == 1024
+        hrefs = [c.href for c in sd.workspaces[0][1]]
+        assert hrefs == [server.col_iri("one"), server.col_iri("two")], hrefs
+
+    def test_02_binary_create_replace_delete(self):
+        server = self._start(keep_content=True)
+        d, eid = self._dip(server)
+
+        # create
+        cm, receipt = d.deposit(eid)
+        assert receipt.code == 201
+        assert receipt.location == server.edit_iri("1")
+        assert d.get_endpoint(eid).edit_iri == receipt.location
+        container = server.get_container("1")
+        md5s = dict([(r.name, r.md5) for r in container.resources if not r.original])
+        assert md5s["testfile.txt"] == TESTFILE_MD5
+        assert md5s["testfile2.txt"] == TESTFILE2_MD5
+        package = [r for r in container.resources if r.original][0]
+        assert package.packaging == SIMPLE_ZIP
+        assert hashlib.md5(container.content).hexdigest() == package.md5
+
+        # replace the content
+        cm, receipt = d.deposit(eid)
+        assert receipt.code == 204
+        assert server.stats["statuses"][204] == 1
+
+        # the statement lists the package and what was in it
+        statement = d.get_repository_statement(eid)
+        assert len(statement.resources) == 4, len(statement.resources)
+        assert len(statement.original_deposits) == 1
+        assert statement.original_deposits[0].packaging == [SIMPLE_ZIP]
+
+        # and delete
+        cm, receipt = d.delete(eid)
+        assert server.get_container("1") is None
+
+    def test_03_metadata_create_update(self):
+        server = self._start()
+        d, eid = self._dip(server)
+
+        cm, receipt = d.deposit(eid, metadata_only=True)
+        assert receipt.code == 201
+        assert "A title" in server.get_container("1").metadata
+        assert receipt.title == "Container 1"
+
+        d.add_dublin_core("creator", "Someone")
+        cm, receipt = d.deposit(eid, metadata_only=True)
+        assert receipt.code == 200
+        assert "Someone" in server.get_container("1").metadata
+        assert len(server.containers) == 1
+
+    def test_04_injected_errors(self):
+        server = self._start(error_rate=1.0, error_status=503)
+        d, eid = self._dip(server)
+        try:
+            d.deposit(eid)
+            assert False, "deposit should have failed"
+        except exceptions.ServerError:
+            pass
+        assert server.stats["errors_injected"] == 1
+        assert server.stats["statuses"][503] == 1
+        assert len(server.containers) == 0
+
+        # a seeded server fails the same requests every time
+        server.stop()
+        first = StandInServer(error_rate=0.5, seed=1)
+        second = StandInServer(error_rate=0.5, seed=1)
+        assert [first._inject_error() for i in range(20)] == [second._inject_error() for i in range(20)]
+
+    def test_05_body_size_limit(self):
+        server = self._start(max_body_size=100)
+        d, eid = self._dip(server)
+        try:
+            d.deposit(eid)
+            assert False, "deposit should have been too big"
+        except exceptions.HTTPResponseError as e:
+            assert e.response["status"] == 413
+        assert len(server.containers) == 0
+
+        # metadata is small enough to get through... just
+        server.max_body_size = 10000
+        cm, receipt = d.deposit(eid, metadata_only=True)
+        assert receipt.code == 201
+
+    def test_06_latency_and_bandwidth(self):
+        server = self._start(latency=0.3)
+        conn = sword2.Connection(server.sd_iri, http_impl=DepositHttpLayer())
+        start = time.time()
+        conn.get_service_document()
+        assert time.time() - start >= 0.3
+
+        # 64kB at 128kB/s takes at least half a second to send
+        server.latency = 0
+        server.bandwidth = 128 * 1024
+        start = time.time()
+        receipt = conn.create(col_iri=server.col_iri(), payload="x" * 64 * 1024, filename="x.txt",
+                              mimetype="text/plain", packaging="http://purl.org/net/sword/package/Binary")
+        assert receipt.code == 201
+        assert time.time() - start >= 0.5
+        assert server.stats["bytes_received"] >= 64 * 1024
+
+    def test_07_authentication(self):
+        server = self._start(username="sword", password="sword")
+        d, eid = self._dip(server, username="sword")
+        try:
+            d.deposit(eid, user_pass="wrong")
+            assert False, "deposit should not have been authorised"
+        except exceptions.NotAuthorised:
+            pass
+
+        cm, receipt = d.deposit(eid, user_pass="sword")
+        assert receipt.code == 201
+        assert server.get_container("1").username == "sword"
+
+    def test_08_checksum_and_concurrency(self):
+        server = self._start()
+        conn = sword2.Connection(server.sd_iri, http_impl=DepositHttpLayer())
+        try:
+            conn.create(col_iri=server.col_iri(), payload="some content", filename="x.txt", md5sum="0" * 32,
+                        mimetype="text/plain", packaging="http://purl.org/net/sword/package/Binary")
+            assert False, "checksum mismatch should have been rejected"
+        except exceptions.HTTPResponseError as e:
+            assert e.response["status"] == 412
+        assert server.stats["max_concurrency"] == 1
@@ -0,0 +1,137 @@
+from . import TestController
+
+import dip
+from dip.standin import StandInServer, SIMPLE_ZIP
+from sword2 import exceptions
+import os, shutil, json
+
+DIP_DIR = "dip_test_dir"
+TRACE_FILE = "dip_test_traces.jsonl"
+RESOURCES = os.path.join("tests", "resources")
+
+class TestTracing(TestController):
+
+    def _cleanup(self):
+        if os.path.isdir(DIP_DIR):
+            shutil.rmtree(DIP_DIR)
+        if os.path.isfile(TRACE_FILE):
+            os.remove(TRACE_FILE)
+
+    def setUp(self):
+        self._cleanup()
+        self.server = StandInServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+        self._cleanup()
+
+    def _dip(self, exporter):
+        d = dip.DIP(DIP_DIR, tracer=dip.Tracer(exporter))
+        d.set_file(os.path.join(RESOURCES, "testfile.txt"))
+        d.set_file(os.path.join(RESOURCES, "testfile2.txt"))
+        d.add_dublin_core("title", "A title")
+        e = dip.Endpoint(sd_iri=self.server.sd_iri, col_iri=self.server.col_iri(), package=SIMPLE_ZIP)
+        d.set_endpoint(endpoint=e)
+        return d, e.id
+
+    def test_01_no_tracing(self):
+        # by default there is no exporter, and no spans are made
+        d = dip.DIP(DIP_DIR)
+        with d.tracer.span("anything", some="attribute") as span:
+            span.set_attribute("more", 1)
+            assert d.tracer.current() is span
+        d.tracer.set_trace_attributes(ignored=True)
+
+    def test_02_deposit_spans(self):
+        exporter = dip.CollectingExporter()
+        d, eid = self._dip(exporter)
+        cm, receipt = d.deposit(eid)
+
+        names = [s.name for s in exporter.spans]
+        assert names == ["package", "history_save", "upload", "mark_deposited", "history_save", "cleanup", "dip.deposit"], names
+        root = exporter.spans[-1]
+        assert root.parent_id is None
+        assert root.attributes["endpoint_id"] == eid
+        for span in exporter.spans[:-1]:
+            assert span.trace_id == root.trace_id
+            assert span.parent_id == root.span_id
+            assert span.start >= root.start and span.end <= root.end
+
+        byname = dict([(s.name, s) for s in exporter.spans])
+        assert byname["package"].attributes["file_count"] == 2
+        assert byname["package"].attributes["bytes"] > 0
+        assert byname["upload"].attributes["bytes"] == byname["package"].attributes["bytes"]
+        assert byname["upload"].attributes["status_code"] == 201
+        assert byname["mark_deposited"].attributes["file_count"] == 3
+
+        # the history spans count what was written to the history store
+        saves = [s.attributes["bytes"] for s in exporter.spans if s.name == "history_save"]
+        history_dir = os.path.join(DIP_DIR, "history", eid)
+        assert sum(saves) == sum([os.path.getsize(os.path.join(history_dir, f)) for f in os.listdir(history_dir)])
+        assert saves[1] > saves[0]
+
+        # the trace can be found from the history, and vice versa
+        assert root.attributes["comms_timestamp"] == cm.raw["timestamp"]
+        history = d.get_history(eid)
+        assert cm.raw["timestamp"] in [h.raw["timestamp"] for h in history]
+
+        # an update fetches the deposit receipt first
+        del exporter.spans[:]
+        d.deposit(eid)
+        names = [s.name for s in exporter.spans]
+        assert names[:2] == ["package", "get_deposit_receipt"], names
+
+    def test_03_delete_and_statement(self):
+        exporter = dip.CollectingExporter()
+        d, eid = self._dip(exporter)
+        d.deposit(eid, metadata_only=True)
+        del exporter.spans[:]
+
+        d.get_repository_statement(eid)
+        names = [s.name for s in exporter.spans]
+        assert names == ["get_deposit_receipt", "get_statement", "dip.get_repository_statement"], names
+
+        del exporter.spans[:]
+        d.delete(eid)
+        names = [s.name for s in exporter.spans]
+        assert names == ["history_save", "delete", "history_save", "cleanup", "dip.delete"], names
+        assert exporter.spans[1].attributes["status_code"] == 204
+
+    def test_04_errors(self):
+        exporter = dip.CollectingExporter()
+        d, eid = self._dip(exporter)
+        self.server.error_rate = 1.0
+        try:
+            d.deposit(eid, metadata_only=True)
+            assert False, "deposit should have failed"
+        except exceptions.ServerError:
+            pass
+        upload = [s for s in exporter.spans if s.name == "upload"][0]
+        assert upload.error is not None
+        assert upload.attributes["status_code"] == 500
+        assert exporter.spans[-1].name == "dip.deposit"
+        assert exporter.spans[-1].error is not None
+
+    def test_05_otlp_json_file(self):
+        d, eid = self._dip(dip.OTLPJsonFileExporter(TRACE_FILE, service_name="test"))
+        d.deposit(eid, metadata_only=True)
+        d.deposit(eid, metadata_only=True)
+
+        with open(TRACE_FILE) as f:
+            lines = f.readlines()
+        assert len(lines) == 2
+        doc = json.loads(lines[0])
+        resource = doc["resourceSpans"][0]
+        assert resource["resource"]["attributes"] == [{"key" : "service.name", "value" : {"stringValue" : "test"}}]
+        spans = resource["scopeSpans"][0]["spans"]
+        root = spans[-1]
+        assert root["name"] == "dip.deposit"
+        assert "parentSpanId" not in root
+        assert len(root["traceId"]) == 32 and len(root["spanId"]) == 16
+        assert int(root["endTimeUnixNano"]) >= int(root["startTimeUnixNano"])
+        assert root["status"]["code"] == 1
+        upload = [s for s in spans if s["name"] == "upload"][0]
+        assert upload["parentSpanId"] == root["spanId"]
+        attributes = dict([(a["key"], a["value"]) for a in upload["attributes"]])
+        assert attributes["status_code"] == {"intValue" : "201"}
+        assert attributes["method"] == {"stringValue" : "POST"}
@@ -0,0 +1,199 @@
+from . import TestController
+
+import dip
+from dip.standin import StandInServer, SIMPLE_ZIP, BINARY
+from dip.transport import Progress, ProgressReporter, Payload, DepositHttpLayer
+import os, shutil, hashlib, functools
+
+DIP_DIR = "dip_test_dir"
+RESOURCES = os.path.join("tests", "resources")
+
+class TestTransport(TestController):
+
+    def _cleanup(self):
+        if os.path.isdir(DIP_DIR):
+            shutil.rmtree(DIP_DIR)
+
+    def setUp(self):
+        self._cleanup()
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stop()
+        self._cleanup()
+
+    def _dip(self, dip_args=None, **server_args):
+        self.server = StandInServer(**server_args).start()
+        d = dip.DIP(DIP_DIR, **(dip_args or {}))
+        # something big enough to take a while to send at the server's bandwidth
+        path = os.path.join(DIP_DIR, "content.bin")
+        with open(path, "wb") as f:
+            f.write(os.urandom(256 * 1024))
+        d.set_file(path)
+        d.add_dublin_core("title", "A title")
+        e = dip.Endpoint(sd_iri=self.server.sd_iri, col_iri=self.server.col_iri(), package=SIMPLE_ZIP)
+        d.set_endpoint(endpoint=e)
+        return d, e.id
+
+    def test_01_progress(self):
+        p = Progress(Progress.UPLOADING, bytes_sent=100, total_bytes=400, elapsed=2.0)
+        assert p.rate == 50
+        assert p.eta == 6
+        p = Progress(Progress.PACKAGING)
+        assert p.rate is None
+        assert p.eta is None
+
+        # while uploading, the callback hears no more often than the interval
+        reports = []
+        reporter = ProgressReporter(reports.append, interval=0)
+        reporter.start_upload(30)
+        for i in range(3):
+            reporter.sent(10)
+        assert [r.bytes_sent for r in reports] == [0, 10, 20, 30]
+        reports = []
+        reporter = ProgressReporter(reports.append, interval=60)
+        reporter.start_upload(30)
+        for i in range(3):
+            reporter.sent(10)
+        reporter.awaiting_receipt()
+        assert [(r.phase, r.bytes_sent) for r in reports] == [(Progress.UPLOADING, 0), (Progress.AWAITING_RECEIPT, 30)]
+
+    def test_02_binary_deposit_progress(self):
+        d, eid = self._dip(bandwidth=512 * 1024)
+        reports = []
+        cm, receipt = d.deposit(eid, progress=reports.append)
+        assert receipt.code == 201
+
+        phases = [r.phase for r in reports]
+        assert phases[0] == Progress.PACKAGING
+        assert phases[-2:] == [Progress.AWAITING_RECEIPT, Progress.DONE], phases
+        uploading = [r for r in reports if r.phase == Progress.UPLOADING]
+        assert len(uploading) >= 1, phases
+
+        # the whole package was sent, and the reports along the way were sensible
+        size = reports[-1].total_bytes
+        assert size > 256 * 1024
+        assert reports[-1].bytes_sent == size
+        sent = [r.bytes_sent for r in uploading]
+        assert sent == sorted(sent)
+        assert reports[-2].rate > 0
+        assert reports[-2].eta == 0
+
+        # the throughput is recorded in the response, and in the history
+        assert cm.throughput["bytes"] == size
+        assert cm.throughput["seconds"] >= 0.25
+        assert cm.throughput["bytes_per_second"] < 1024 * 1024
+        responses = d.get_history(eid, method="POST")
+        assert [r.throughput for r in responses if r.type == "response"][0] == cm.throughput
+
+    def test_03_metadata_deposit_progress(self):
+        d, eid = self._dip()
+        reports = []
+        cm, receipt = d.deposit(eid, metadata_only=True, progress=reports.append)
+        assert [r.phase for r in reports] == [Progress.UPLOADING, Progress.AWAITING_RECEIPT, Progress.DONE]
+        assert cm.throughput["bytes"] == reports[-1].total_bytes > 0
+
+        # an update works the same way, and the deposit needs no callback
+        cm, receipt = d.deposit(eid, metadata_only=True)
+        assert receipt.code == 200
+        assert cm.throughput["bytes"] > 0
+
+    def test_04_authenticated_upload(self):
+        # credentials go with the request, as the payload can't be sent twice
+        d, eid = self._dip(username="sword", password="sword")
+        e = d.get_endpoint(eid)
+        e.username = "sword"
+        d._save_deposit_info()
+        reports = []
+        cm, receipt = d.deposit(eid, user_pass="sword", progress=reports.append)
+        assert receipt.code == 201
+        assert self.server.stats["statuses"].get(401) is None
+        assert reports[-1].bytes_sent == reports[-1].total_bytes
+
+        # an update fetches the receipt first, also authenticated
+        cm, receipt = d.deposit(eid, user_pass="sword")
+        assert receipt.code == 204
+
+    def test_05_chunked_upload(self):
+        # the payload goes to the socket in chunks of no more than the chunk size
+        from dip.transport import _ChunkedBody
+        class Socket(object):
+            def __init__(self):
+                self.chunks = []
+            def sendall(self, data):
+                self.chunks.append(str(data))
+        path = os.path.join(RESOURCES, "testfile.txt")
+        content = open(path, "rb").read()
+        for use_mmap in [False, True]:
+            sock = Socket()
+            with Payload(path) as payload:
+                _ChunkedBody(payload, payload.size, ProgressReporter(), chunk_size=10, use_mmap=use_mmap).send(sock)
+                # a retry sends it all again
+                _ChunkedBody(payload, payload.size, ProgressReporter(), chunk_size=10, use_mmap=use_mmap).send(sock)
+            assert max([len(c) for c in sock.chunks]) == 10
+            assert "".join(sock.chunks) == content * 2
+        
+        # and a whole deposit, from an mmap of the package
+        layer = functools.partial(DepositHttpLayer, chunk_size=4096, use_mmap=True)
+        d, eid = self._dip(dip_args={"http_layer" : layer}, keep_content=True)
+        reports = []
+        cm, receipt = d.deposit(eid, progress=reports.append)
+        assert receipt.code == 201
+        info = d.package(eid)
+        assert self.server.get_container("1").content == open(info.path, "rb").read()
+        assert reports[-1].bytes_sent == os.path.getsize(info.path)
+    
+    def test_06_known_md5(self):
+        # a payload whose md5 is known isn't read by sword2 before it is sent, if the layer sends the file
+        import sword2
+        from sword2 import exceptions
+        self.server = StandInServer(keep_content=True).start()
+        path = os.path.join(RESOURCES, "testfile.txt")
+        content = open(path, "rb").read()
+        md5 = hashlib.md5(content).hexdigest()
+        with Payload(path, md5=md5) as payload:
+            assert payload.read() == content
+        with self.assertRaises(ValueError):
+            Payload(path, skip_read=True)
+        with Payload(path, md5=md5, skip_read=True) as payload:
+            assert payload.read() == ""
+            conn = sword2.Connection(self.server.sd_iri, http_impl=DepositHttpLayer())
+            receipt = conn.create(col_iri=self.server.col_iri(), payload=payload, filename="testfile.txt",
+                                  mimetype="text/plain", packaging=BINARY)
+        assert receipt.code == 201
+        assert self.server.get_container("1").content == content
+        
+        # the md5 given is the one which is sent
+        with Payload(path, md5="0" * 32, skip_read=True) as payload:
+            conn = sword2.Connection(self.server.sd_iri, http_impl=DepositHttpLayer())
+            with self.assertRaises(exceptions.HTTPResponseError) as cm:
+                conn.create(col_iri=self.server.col_iri(), payload=payload, filename="testfile.txt",
+                            mimetype="text/plain", packaging=BINARY)
+        assert int(cm.exception.response.get("status")) == 412
+
+    def test_07_package_md5_sent(self):
+        # the md5 worked out while packaging is the one sent, without the package being read for it
+        sent = []
+        class RecordingLayer(DepositHttpLayer):
+            def request(self, uri, method, headers=None, payload=None):
+                if isinstance(payload, Payload):
+                    sent.append((headers.get("Content-MD5"), payload.file.tell()))
+                return super(RecordingLayer, self).request(uri, method, headers=headers, payload=payload)
+        d, eid = self._dip(dip_args={"http_layer" : RecordingLayer})
+        cm, receipt = d.deposit(eid)
+        assert receipt.code == 201
+        info = d.package(eid)
+        assert sent == [(info.md5, 0)], sent
+        assert info.md5 == hashlib.md5(open(info.path, "rb").read()).hexdigest()
+
+    def test_08_sword2_layer(self):
+        # sword2's own layer sends what the payload reads, so it must read as the package
+        import sword2
+        d, eid = self._dip(dip_args={"http_layer" : lambda reporter: sword2.http_layer.HttpLib2Layer(None)},
+                           keep_content=True)
+        cm, receipt = d.deposit(eid)
+        assert receipt.code == 201
+        info = d.package(eid)
+        container = self.server.get_container(os.path.basename(d.get_endpoint(eid).edit_iri))
+        assert container.content == open(info.path, "rb").read()